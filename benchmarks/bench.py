@@ -0,0 +1,246 @@
+""" Benchmarks
+
+Times each stage of the arbitrage pipeline against the fixtures, tracks peak memory, compares against a
+stored baseline and checks that the fast paths give the same profit and ROI as the Decimal path.
+
+    python -m benchmarks.bench                  # run and compare against benchmarks/baseline.json
+    python -m benchmarks.bench --save-baseline  # run and store the results as the new baseline
+    python -m benchmarks.bench --sizes 100 1000
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import fixtures
+from bitrader.arbitrage_tools import (
+    arbitrage, coin_exchange, find_optimum, optimal, parse_fnb_forex, prepare_order_book, roi_sweep,
+)
+from bitrader.fees import schedule as fee_schedule
+from bitrader.order_book import OrderBook
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+EXCHANGE_RATE = Decimal('16.4831')
+SIMULATE_AMOUNT = 100000
+MAX_INVEST = 1000000
+STEP = 5000
+
+# Allowed difference between the fast paths and the Decimal path, per roi_sweep() engine.
+# The fixed point engine rounds Euro amounts and fees to the cent, which is up to ~R0.20 each.
+TOLERANCES = {
+    'float': dict(roi=1e-6, profit=1e-4),
+    'fixed': dict(roi=1e-2, profit=1.),
+}
+
+
+def load_payloads(size) -> dict:
+    fnb = 'fnb_forex_live.html' if size == 'live' else 'fnb_forex.html'
+    return dict(
+        kraken=fixtures.load(f'kraken_depth_{size}.json'),
+        luno=fixtures.load(f'luno_orderbook_{size}.json'),
+        ice3x=fixtures.load(f'ice3x_bid_{size}.json'),
+        fnb=fixtures.load(fnb).decode('utf-8'),
+    )
+
+
+def legacy_books(payloads):
+    """Order books as DataFrames, the way the fetchers built them before OrderBook"""
+    kraken = json.loads(payloads['kraken'])['result'][fixtures.KRAKEN_PAIR]['asks']
+    eur_asks = prepare_order_book(pd.DataFrame(kraken, columns=['price', 'volume', 'timestamp']), 'asks')
+
+    luno = pd.DataFrame(json.loads(payloads['luno'])['bids'])
+    zar_bids = prepare_order_book(luno, 'bids')
+
+    return eur_asks, zar_bids
+
+
+def order_books(payloads):
+    kraken = json.loads(payloads['kraken'])['result'][fixtures.KRAKEN_PAIR]['asks']
+    eur_asks = OrderBook.from_levels(kraken, 'asks')
+
+    luno = json.loads(payloads['luno'])['bids']
+    zar_bids = OrderBook.from_levels(luno, 'bids', price_key='price', volume_key='volume')
+
+    return eur_asks, zar_bids
+
+
+def ice3x_book(payloads):
+    entities = json.loads(payloads['ice3x'])['response']['entities']
+    return OrderBook.from_levels(entities, 'bids', price_key='price', volume_key='amount')
+
+
+def legacy_forex(html: str, currency_code: str = 'EUR'):
+    """parse_fnb_forex() as it was before forex.FNBRatesParser: pandas.read_html over the whole page"""
+    df = pd.read_html(StringIO(html), index_col=1, header=0, match=currency_code)[0]
+    return Decimal('%.4f' % float(df.loc[currency_code, 'Bank Selling Rate']))
+
+
+def legacy_optimal(books, exchange_rate, max_invest: int = MAX_INVEST):
+    """optimal() as it was before roi_sweep(): one Decimal arbitrage() per step"""
+    results = []
+    for amount in range(STEP, max_invest, STEP):
+        result = arbitrage(amount, exchange_rate=exchange_rate, books=books)
+        if not isinstance(result, dict):
+            break
+        results.append(dict(amount=amount, roi=result['roi']))
+
+    return pd.DataFrame(results)
+
+
+def time_stage(func, min_time: float = 0.2, repeat: int = 3) -> float:
+    """Best seconds per call over repeat runs of at least min_time each"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or number >= 1000000:
+            break
+        number *= 10
+
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+
+    return best
+
+
+def peak_memory(func) -> int:
+    """Peak bytes allocated by one call"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stages(payloads) -> dict:
+    """Stage name: callable without arguments"""
+    books = order_books(payloads)
+    frames = legacy_books(payloads)
+
+    return {
+        'parse_legacy': lambda: legacy_books(payloads),
+        'parse': lambda: order_books(payloads),
+        'parse_ice3x': lambda: ice3x_book(payloads),
+        'forex_legacy': lambda: legacy_forex(payloads['fnb']),
+        'forex': lambda: parse_fnb_forex(StringIO(payloads['fnb'])),
+        'coin_exchange_legacy': lambda: coin_exchange(frames[0], Decimal(SIMULATE_AMOUNT) / EXCHANGE_RATE, 'buy'),
+        'coin_exchange': lambda: coin_exchange(books[0], Decimal(SIMULATE_AMOUNT) / EXCHANGE_RATE, 'buy'),
+        'arbitrage_legacy': lambda: arbitrage(SIMULATE_AMOUNT, exchange_rate=EXCHANGE_RATE, books=frames),
+        'arbitrage': lambda: arbitrage(SIMULATE_AMOUNT, exchange_rate=EXCHANGE_RATE, books=books),
+        'optimal_legacy': lambda: legacy_optimal(frames, EXCHANGE_RATE),
+        'optimal_float': lambda: optimal(
+            max_invest=MAX_INVEST, books=books, exchange_rate=EXCHANGE_RATE, return_format='raw', engine='float'),
+        'optimal_fixed': lambda: optimal(
+            max_invest=MAX_INVEST, books=books, exchange_rate=EXCHANGE_RATE, return_format='raw', engine='fixed'),
+        'optimum_exact': lambda: find_optimum(books, EXCHANGE_RATE, max_invest=MAX_INVEST),
+    }
+
+
+def check_equivalence(payloads, engine: str) -> dict:
+    """Largest ROI and profit difference between roi_sweep() and the Decimal arbitrage() path"""
+    books = order_books(payloads)
+    frames = legacy_books(payloads)
+
+    amounts = np.arange(STEP, MAX_INVEST, STEP)
+    roi = roi_sweep(amounts, books, EXCHANGE_RATE, engine=engine)
+    capital = amounts + fee_schedule('fnb', 'commission', amounts) + fee_schedule('fnb', 'swift')
+
+    roi_error = profit_error = 0.
+    for i, amount in enumerate(amounts):
+        result = arbitrage(int(amount), exchange_rate=EXCHANGE_RATE, books=frames)
+        if not isinstance(result, dict):
+            # Decimal path ran out of order book, the sweep has to agree
+            if not np.isnan(roi[i]):
+                roi_error = float('inf')
+            break
+        roi_error = max(roi_error, abs(float(result['roi']) - roi[i]))
+        profit_error = max(profit_error, abs(float(result['profit']) - roi[i] * capital[i] / 100))
+
+    return dict(
+        roi_error=roi_error,
+        profit_error=profit_error,
+        ok=roi_error <= TOLERANCES[engine]['roi'] and profit_error <= TOLERANCES[engine]['profit'])
+
+
+def run(sizes, memory: bool = True) -> dict:
+    results = {}
+    for size in sizes:
+        payloads = load_payloads(size)
+        for name, func in stages(payloads).items():
+            key = f'{name}/{size}'
+            results[key] = dict(seconds=time_stage(func))
+            if memory:
+                results[key]['peak_bytes'] = peak_memory(func)
+            print(f'{key:<28} {results[key]["seconds"] * 1000:>12.3f} ms'
+                  f'{results[key].get("peak_bytes", 0) / 1024:>12.1f} KiB')
+
+        for engine in TOLERANCES:
+            key = f'equivalence_{engine}/{size}'
+            results[key] = equivalence = check_equivalence(payloads, engine)
+            print(f'{key:<28} roi error {equivalence["roi_error"]:.2e}, '
+                  f'profit error {equivalence["profit_error"]:.2e}: {"OK" if equivalence["ok"] else "MISMATCH"}')
+
+    return results
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """Stages that got more than max_regression times slower than the baseline"""
+    regressions = []
+    print('\nCompared to baseline:')
+    for key, result in results.items():
+        if 'seconds' not in result or key not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[key]['seconds']
+        flag = ' REGRESSION' if ratio > max_regression else ''
+        print(f'{key:<28} {ratio:>8.2f}x{flag}')
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='*', help='Fixture sizes to run. Default: all available.')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store results as the new baseline.')
+    parser.add_argument('--max-regression', type=float, default=1.5,
+                        help='Fail if a stage is this many times slower than the baseline.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip peak memory measurement.')
+    args = parser.parse_args(argv)
+
+    fixtures.generate()
+    sizes = args.sizes or fixtures.fixture_sizes()
+
+    results = run(sizes, memory=not args.no_memory)
+
+    failed = [key for key, result in results.items() if key.startswith('equivalence') and not result['ok']]
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'\nBaseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            failed += compare(results, json.load(f), args.max_regression)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
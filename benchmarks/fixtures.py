@@ -0,0 +1,160 @@
+""" Benchmark fixtures
+
+Recorded and synthetic exchange responses for running the benchmarks offline.
+
+Synthetic fixtures are generated deterministically in the exact response formats of the Kraken Depth,
+Luno orderbook and Ice3x orderbook/info APIs and the FNB forex rates page. Live responses can be
+recorded next to them with:
+
+    python -m benchmarks.fixtures record
+
+"""
+import json
+import os
+import random
+import sys
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SIZES = (100, 1000, 10000)
+
+KRAKEN_PAIR = 'XXBTZEUR'
+
+FNB_TEMPLATE = """<html><body>
+<table>
+<tr><th>Currency</th><th>Code</th><th>Bank Selling Rate</th><th>Bank Buying Rate</th></tr>
+{rows}
+</table>
+</body></html>
+"""
+
+FNB_RATES = {
+    'USD': ('US Dollar', 13.9512, 13.4409),
+    'EUR': ('Euro', 16.4831, 15.8120),
+    'GBP': ('British Pound', 18.6325, 17.9047),
+}
+
+
+def synthetic_levels(size: int, best_price: float, tick: float, book_type: str, seed: int):
+    """Price levels moving away from best_price, with lognormal volumes"""
+    rng = random.Random(seed)
+    direction = 1 if book_type == 'asks' else -1
+    price = best_price
+    levels = []
+    for _ in range(size):
+        levels.append((round(price, 2), round(rng.lognormvariate(-1, 1.2), 8)))
+        price += direction * tick * rng.expovariate(1)
+    return levels
+
+
+def kraken_depth(size: int) -> dict:
+    book = {}
+    for seed, book_type in enumerate(('asks', 'bids')):
+        best_price = 6000.1 if book_type == 'asks' else 5999.9
+        book[book_type] = [
+            [f'{price:.5f}', f'{volume:.8f}', 1509900000 + i]
+            for i, (price, volume) in enumerate(synthetic_levels(size, best_price, 2, book_type, seed))]
+    return {'error': [], 'result': {KRAKEN_PAIR: book}}
+
+
+def luno_orderbook(size: int) -> dict:
+    book = {'timestamp': 1509900000000}
+    for seed, book_type in enumerate(('asks', 'bids'), start=10):
+        best_price = 110001 if book_type == 'asks' else 109999
+        book[book_type] = [
+            {'price': f'{price:.2f}', 'volume': f'{volume:.6f}'}
+            for price, volume in synthetic_levels(size, best_price, 40, book_type, seed)]
+    return book
+
+
+def ice3x_orderbook(size: int, book_type: str) -> dict:
+    best_price = 111001 if book_type == 'ask' else 110999
+    seed = 20 if book_type == 'ask' else 21
+    entities = [
+        {'pair_id': '3', 'type': book_type, 'price': f'{price:.2f}', 'amount': f'{volume:.8f}'}
+        for price, volume in synthetic_levels(size, best_price, 40, book_type + 's', seed)]
+    return {'errors': False, 'response': {'entities': entities}}
+
+
+def fnb_forex() -> str:
+    rows = '\n'.join(
+        f'<tr><td>{name}</td><td>{code}</td><td>{selling}</td><td>{buying}</td></tr>'
+        for code, (name, selling, buying) in FNB_RATES.items())
+    return FNB_TEMPLATE.format(rows=rows)
+
+
+def fixture_path(name: str) -> str:
+    return os.path.join(FIXTURE_DIR, name)
+
+
+def generate(sizes=SIZES):
+    """Write synthetic fixtures for all sizes to FIXTURE_DIR (if not there yet)"""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+
+    for size in sizes:
+        payloads = {
+            f'kraken_depth_{size}.json': lambda: kraken_depth(size),
+            f'luno_orderbook_{size}.json': lambda: luno_orderbook(size),
+            f'ice3x_bid_{size}.json': lambda: ice3x_orderbook(size, 'bid'),
+            f'ice3x_ask_{size}.json': lambda: ice3x_orderbook(size, 'ask'),
+        }
+        for name, payload in payloads.items():
+            if not os.path.exists(fixture_path(name)):
+                with open(fixture_path(name), 'w') as f:
+                    json.dump(payload(), f)
+
+    if not os.path.exists(fixture_path('fnb_forex.html')):
+        with open(fixture_path('fnb_forex.html'), 'w') as f:
+            f.write(fnb_forex())
+
+
+def load(name: str):
+    """Raw response body of a fixture, e.g. load('kraken_depth_1000.json')"""
+    with open(fixture_path(name), 'rb') as f:
+        return f.read()
+
+
+def fixture_sizes():
+    """Sizes available in FIXTURE_DIR, including 'live' if responses were recorded"""
+    sizes = [size for size in SIZES if os.path.exists(fixture_path(f'kraken_depth_{size}.json'))]
+    if os.path.exists(fixture_path('kraken_depth_live.json')):
+        sizes.append('live')
+    return sizes
+
+
+def record():
+    """Record live responses from all exchanges and FNB as the 'live' fixtures"""
+    import requests
+
+    from bitrader import clients
+    from bitrader.arbitrage_tools import FNB_FOREX_URL
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+
+    responses = {
+        'kraken_depth_live.json': lambda: requests.get(
+            'https://api.kraken.com/0/public/Depth', params={'pair': KRAKEN_PAIR}).json(),
+        'luno_orderbook_live.json': lambda: clients.bitx().get_order_book(kind='basic'),
+        'ice3x_bid_live.json': lambda: clients.ice3x().get_resource(
+            'generic', api_method='orderbook', api_action='info', api_params='type=bid&pair_id=3',
+            data_format='raw')['response'].json(),
+        'ice3x_ask_live.json': lambda: clients.ice3x().get_resource(
+            'generic', api_method='orderbook', api_action='info', api_params='type=ask&pair_id=3',
+            data_format='raw')['response'].json(),
+    }
+
+    for name, fetch in responses.items():
+        with open(fixture_path(name), 'w') as f:
+            json.dump(fetch(), f)
+        print('Recorded', name)
+
+    with open(fixture_path('fnb_forex_live.html'), 'w') as f:
+        f.write(requests.get(FNB_FOREX_URL).text)
+    print('Recorded fnb_forex_live.html')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['record']:
+        record()
+    else:
+        generate()
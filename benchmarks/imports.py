@@ -0,0 +1,140 @@
+""" Import time
+
+Cold import cost of the package entry points, per module, measured with python -X importtime in a fresh
+interpreter per run. Fails when an entry point imports a heavy dependency at load (they belong on the code
+paths that use them), or got more than --max-regression times slower than the stored baseline.
+
+    python -m benchmarks.imports                  # report and compare against benchmarks/imports_baseline.json
+    python -m benchmarks.imports --save-baseline  # store the results as the new baseline
+    python -m benchmarks.imports bitrader.main --top 30
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imports_baseline.json')
+
+ENTRY_POINTS = (
+    'bitrader.main',  # arbot
+    'bitrader.arbitrage_tools',
+    'bitrader.api_tools',
+    'bitrader.bitx',
+    'bitrader.backtest',
+    'bitrader.fixed_point',
+)
+
+# Only imported by the functions that need them
+HEAVY = ('pandas', 'matplotlib', 'telepot', 'dotenv', 'redis', 'requests_cache', 'requests_futures', 'seaborn')
+
+MARKER = 'bitrader-import-start'
+
+
+def import_times(module: str) -> list:
+    """Modules imported by import module in a fresh interpreter
+
+    Returns: List of (name, self_us, cumulative_us), in the order -X importtime reports them.
+
+    """
+    code = f'import sys; sys.stderr.write({MARKER!r} + "\\n"); import {module}'
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, cwd=os.getcwd())
+    if process.returncode:
+        raise ImportError(f'Could not import {module}: {process.stderr.strip().splitlines()[-1]}')
+
+    lines = process.stderr.split(MARKER, 1)[1].splitlines()
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def package(name: str) -> str:
+    """Group modules by top level package, and bitrader by module"""
+    parts = name.split('.')
+    return '.'.join(parts[:2]) if parts[0] == 'bitrader' else parts[0]
+
+
+def measure(module: str, repeat: int = 3) -> dict:
+    """Fastest of repeat cold imports of module, with its cost per package"""
+    runs = [import_times(module) for _ in range(repeat)]
+    modules = min(runs, key=lambda run: sum(self_us for _, self_us, _ in run))
+
+    packages = defaultdict(int)
+    for name, self_us, _ in modules:
+        packages[package(name)] += self_us
+
+    return dict(
+        seconds=sum(self_us for _, self_us, _ in modules) * 1e-6,
+        modules=len(modules),
+        packages={name: us * 1e-6 for name, us in sorted(packages.items(), key=lambda item: -item[1])},
+        heavy=sorted({name.split('.')[0] for name, _, _ in modules} & set(HEAVY)),
+    )
+
+
+def run(entry_points, repeat: int = 3, top: int = 10) -> dict:
+    results = {}
+    for module in entry_points:
+        try:
+            results[module] = result = measure(module, repeat)
+        except ImportError as e:
+            print(f'{module}: {e}')
+            continue
+
+        flag = f' HEAVY: {", ".join(result["heavy"])}' if result['heavy'] else ''
+        print(f'{module:<28} {result["seconds"] * 1000:>9.1f} ms {result["modules"]:>5} modules{flag}')
+        for name, seconds in list(result['packages'].items())[:top]:
+            print(f'    {name:<32} {seconds * 1000:>9.1f} ms')
+
+    return results
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    """Entry points that got more than max_regression times slower than the baseline"""
+    regressions = []
+    print('\nCompared to baseline:')
+    for module, result in results.items():
+        if module not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[module]['seconds']
+        flag = ' REGRESSION' if ratio > max_regression else ''
+        print(f'{module:<28} {ratio:>8.2f}x {result["modules"] - baseline[module]["modules"]:>+5} modules{flag}')
+        if flag:
+            regressions.append(module)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', help='Modules to import. Default: the package entry points.')
+    parser.add_argument('--repeat', type=int, default=3, help='Cold imports per module, the fastest counts.')
+    parser.add_argument('--top', type=int, default=10, help='Packages to list per module.')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store results as the new baseline.')
+    parser.add_argument('--max-regression', type=float, default=2.,
+                        help='Fail if an import is this many times slower than the baseline.')
+    args = parser.parse_args(argv)
+
+    results = run(args.modules or ENTRY_POINTS, repeat=args.repeat, top=args.top)
+
+    failed = [module for module, result in results.items() if result['heavy']]
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'\nBaseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            failed += compare(results, json.load(f), args.max_regression)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+""" API cache
+
+Layered response cache for BaseAPI.
+
+A TieredCache checks its stores in order, e.g. an in-process MemoryStore in front of a SQLiteStore or a
+RedisStore, and copies what it finds in a slower tier into the faster ones. How long a response stays fresh
+is set per resource template (see BaseAPI.resource_ttls), from seconds for order books to forever for
+historical rates. A response that is a little past its TTL can still be served while it is refreshed in the
+background (stale-while-revalidate, see BaseAPI.resource_stale).
+
+Pick the stores with the BITRADER_API_CACHE environment variable, see from_url().
+
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MemoryStore:
+    """Thread safe in-process LRU store"""
+
+    name = 'memory'
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str):
+        """(value, stored_at) for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def set(self, key: str, value, stored_at: float, expires_at: float = None):
+        with self._lock:
+            self._entries[key] = (value, stored_at, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteStore:
+    """Store in a local SQLite file, shared by processes on the same machine"""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = 'api_cache.sqlite'):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(key TEXT PRIMARY KEY, value BLOB, stored_at REAL, expires_at REAL)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return connection
+
+    def get(self, key: str):
+        row = self._connection().execute(
+            'SELECT value, stored_at FROM responses WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, key: str, value, stored_at: float, expires_at: float = None):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), stored_at, expires_at))
+
+    def delete(self, key: str):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM responses')
+
+
+class RedisStore:
+    """Store in Redis, shared by every process using the same server"""
+
+    name = 'redis'
+
+    def __init__(self, connection=None, url: str = 'redis://redis:6379/0', prefix: str = 'bitrader:api:'):
+        """
+
+        Args:
+            connection: Optional. Client with the redis-py get / set / delete interface, e.g. a
+                fakeredis.FakeStrictRedis(). Default: a client for url.
+            url: Redis server to connect to if no connection is given.
+            prefix: Prepended to every key.
+        """
+        if connection is None:
+            import redis
+
+            connection = redis.StrictRedis.from_url(url)
+        self.connection = connection
+        self.prefix = prefix
+
+    def get(self, key: str):
+        data = self.connection.get(self.prefix + key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key: str, value, stored_at: float, expires_at: float = None):
+        data = pickle.dumps((value, stored_at), protocol=pickle.HIGHEST_PROTOCOL)
+        if expires_at is None:
+            self.connection.set(self.prefix + key, data)
+        else:
+            self.connection.set(self.prefix + key, data, px=max(int((expires_at - time.time()) * 1000), 1))
+
+    def delete(self, key: str):
+        self.connection.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.connection.scan_iter(match=self.prefix + '*'):
+            self.connection.delete(key)
+
+
+class TieredCache:
+    """Read through cache over a list of stores, fastest first"""
+
+    def __init__(self, stores: list = None, refresh_workers: int = 2):
+        """
+
+        Args:
+            stores: Stores to check in order. Default: a MemoryStore only.
+            refresh_workers: Threads for stale-while-revalidate refreshes.
+        """
+        self.stores = list(stores) if stores else [MemoryStore()]
+
+        self.hits = {store.name: 0 for store in self.stores}
+        self.misses = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.errors = 0
+
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers)
+
+    def __repr__(self):
+        return f'<TieredCache {" > ".join(store.name for store in self.stores)}>'
+
+    def get(self, key: str, fetch, ttl: float = None, stale: float = 0, cacheable=None):
+        """Value for key from the first store that has it, or from fetch()
+
+        Args:
+            key: Cache key, e.g. the URL.
+            fetch: Callable without arguments that returns the value.
+            ttl: Seconds the value is fresh. None: forever.
+            stale: Seconds after ttl during which the old value is returned while fetch() refreshes it
+                in the background.
+            cacheable: Optional. Callable that returns False for values that must not be stored, e.g. errors.
+
+        Returns: The value.
+
+        """
+        now = time.time()
+
+        for i, store in enumerate(self.stores):
+            try:
+                entry = store.get(key)
+            except Exception:
+                # A cache that is down must not take the API calls down with it
+                self.errors += 1
+                continue
+            if entry is None:
+                continue
+
+            value, stored_at = entry
+            age = now - stored_at
+            if ttl is not None and age >= ttl + stale:
+                continue
+
+            with self._lock:
+                self.hits[store.name] += 1
+            self._store(key, value, stored_at, ttl, stale, self.stores[:i])
+
+            if ttl is not None and age >= ttl:
+                self._refresh(key, fetch, ttl, stale, cacheable)
+
+            return value
+
+        with self._lock:
+            self.misses += 1
+
+        return self._fetch(key, fetch, ttl, stale, cacheable)
+
+    def _fetch(self, key, fetch, ttl, stale, cacheable):
+        value = fetch()
+        if cacheable is None or cacheable(value):
+            self._store(key, value, time.time(), ttl, stale, self.stores)
+        return value
+
+    def _store(self, key, value, stored_at, ttl, stale, stores):
+        expires_at = None if ttl is None else stored_at + ttl + stale
+        for store in stores:
+            try:
+                store.set(key, value, stored_at, expires_at)
+            except Exception:
+                self.errors += 1
+
+    def _refresh(self, key, fetch, ttl, stale, cacheable):
+        """Fetch key again in the background, once at a time"""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            self.stale += 1
+
+        def refresh():
+            try:
+                self._fetch(key, fetch, ttl, stale, cacheable)
+                with self._lock:
+                    self.refreshes += 1
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(refresh)
+
+    def invalidate(self, key: str):
+        for store in self.stores:
+            store.delete(key)
+
+    def clear(self):
+        for store in self.stores:
+            store.clear()
+
+    def stats(self) -> dict:
+        requests = sum(self.hits.values()) + self.misses
+        return dict(
+            hits=dict(self.hits),
+            misses=self.misses,
+            stale=self.stale,
+            refreshes=self.refreshes,
+            errors=self.errors,
+            hit_rate=sum(self.hits.values()) / requests if requests else 0.,
+        )
+
+
+def from_url(url: str = None, maxsize: int = 256) -> TieredCache:
+    """TieredCache with a MemoryStore in front of the store described by url
+
+    Args:
+        url: memory, sqlite:<path> or redis://<host>:<port>/<db>. Default: BITRADER_API_CACHE, or
+            sqlite:api_cache.sqlite if that isn't set.
+        maxsize: Entries kept in memory.
+
+    """
+    url = url or os.environ.get('BITRADER_API_CACHE', 'sqlite:api_cache.sqlite')
+
+    stores = [MemoryStore(maxsize)]
+    if url.startswith('sqlite:'):
+        stores.append(SQLiteStore(url[len('sqlite:'):]))
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        stores.append(RedisStore(url=url))
+    elif url != 'memory':
+        raise KeyError(f'{url} is not a valid cache. Options are: memory, sqlite:<path>, redis://<host>')
+
+    return TieredCache(stores)
@@ -1,21 +1,26 @@
 import json
 import os
+import threading
+import time
 from functools import partial
 from itertools import chain
 from logging import getLogger
 from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-import redis as redis
-import requests_cache
+import numpy as np
 from requests import session
-from requests_futures.sessions import FuturesSession
 
 logger = getLogger()
 
+try:
+    # Optional, parses depth responses about 2x faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-# TODO: Allow cache backend to be configurable
-# if True:
-#     requests_cache.install_cache(os.path.join('./', 'api2'), backend='sqlite', expire_after=2592000)
+
+DEFAULT_TTL = 60 * 60 * 24 * 30  # Seconds responses of resources without a TTL are cached
 
 
 def flatten_dict(response: dict):
@@ -37,6 +42,93 @@ class ExternalAPIException(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
+_depth_stats = {}
+_depth_lock = threading.Lock()
+
+
+def level_arrays(levels, price_key=0, volume_key=1):
+    """Typed price and volume arrays from a list of levels as returned by the exchange APIs
+
+    Args:
+        levels: List of lists (Kraken) or list of dicts (Luno, Ice3x), with numbers or numeric strings.
+        price_key: Index or key of the price in each level.
+        volume_key: Index or key of the volume in each level.
+
+    Returns: Tuple of (price, volume) float64 arrays.
+
+    """
+    price = np.fromiter((float(level[price_key]) for level in levels), dtype=np.float64, count=len(levels))
+    volume = np.fromiter((float(level[volume_key]) for level in levels), dtype=np.float64, count=len(levels))
+    return price, volume
+
+
+def decode_depth(content: bytes, source: str, path: tuple, book_types: tuple, price_key=0, volume_key=1) -> dict:
+    """Price and volume arrays straight from the body of a depth response
+
+    Skips response.json(), DataFrames and string columns: the body is parsed once (with orjson if it is
+    installed) and only the requested sides are converted. Bytes and decode time are added to depth_stats().
+
+    Args:
+        content: Response body.
+        source: Name to report the response under, e.g. kraken.
+        path: Keys from the top of the response to the object holding the sides, e.g. ('result', pair).
+        book_types: Keys of the sides to decode, e.g. ('asks', 'bids').
+        price_key: Index or key of the price in each level.
+        volume_key: Index or key of the volume in each level.
+
+    Returns: Dict of book_type: (price, volume)
+
+    """
+    started = time.perf_counter()
+    payload = json_loads(content)
+    parsed = time.perf_counter()
+
+    node = payload
+    try:
+        for key in path:
+            node = node[key]
+        sides = {book_type: level_arrays(node[book_type], price_key, volume_key) for book_type in book_types}
+    except (KeyError, IndexError, TypeError) as e:
+        error = payload.get('error') if isinstance(payload, dict) else None
+        raise ExternalAPIException(f'{source} depth response has no {e}: {error or content[:100]}')
+
+    finished = time.perf_counter()
+    levels = sum(len(price) for price, volume in sides.values())
+
+    logger.debug('%s depth: %d bytes, %d levels, parsed in %.1f ms, converted in %.1f ms',
+                 source, len(content), levels, (parsed - started) * 1000, (finished - parsed) * 1000)
+
+    with _depth_lock:
+        stats = _depth_stats.setdefault(
+            source, dict(responses=0, bytes=0, levels=0, parse_seconds=0., convert_seconds=0.))
+        stats['responses'] += 1
+        stats['bytes'] += len(content)
+        stats['levels'] += levels
+        stats['parse_seconds'] += parsed - started
+        stats['convert_seconds'] += finished - parsed
+
+    from bitrader import profiling
+    profiling.record(f'decode.{source}', finished - started)
+
+    return sides
+
+
+def depth_stats() -> dict:
+    """Source: dict(responses, bytes, levels, parse_seconds, convert_seconds), totals since start"""
+    with _depth_lock:
+        return {source: dict(stats) for source, stats in _depth_stats.items()}
+
+
+def depth_summary() -> str:
+    """Human readable depth decoding costs, e.g. for the /stats bot command"""
+    lines = [f'JSON parser: {json_loads.__module__}']
+    for source, s in sorted(depth_stats().items()):
+        lines.append(
+            f'{source}: {s["bytes"] / s["responses"] / 1024:.0f} KiB, '
+            f'{(s["parse_seconds"] + s["convert_seconds"]) / s["responses"] * 1000:.1f} ms per response')
+    return '\n'.join(lines)
+
+
 class BaseAPI:
     token = ''
     url_template = 'https://httpbin.org/{resource}'
@@ -48,24 +140,60 @@ class BaseAPI:
         'status': 'status/{code}',
     }
     endpoint_options = {}
+    # Seconds responses stay fresh per resource, None for forever. Default: DEFAULT_TTL.
+    resource_ttls = {}
+    # Seconds after the TTL that a response is still returned while it is refreshed in the background
+    resource_stale = {}
+    # Query parameters left out of cache keys, as they change with every request
+    volatile_params = ('nonce',)
+
+    def __init__(self, cache=False, future: bool = True):
+        """
 
-    def __init__(self, cache: bool = False, future: bool = True):
-        if cache:
-            redis_conn = redis.StrictRedis(host='redis')
-            self.session = requests_cache.core.CachedSession(
-                cache_name='api_cache',
-                backend='redis', expire_after=60 * 60 * 24 * 30,
-                allowable_codes=(200,),
-                allowable_methods=('GET',),
-                old_data_on_error=False,
-                connection=redis_conn,
-            )
-        else:
-            self.session = session()
-        if future:
-            self.future_session = FuturesSession(max_workers=10, session=self.session)
+        Args:
+            cache: Default = False. True for api_cache.from_url() (configured with BITRADER_API_CACHE),
+                or a api_cache.TieredCache to share between APIs.
+            future: Default = True. Allow get_resource(future=True), with a FuturesSession created on first use.
+        """
+        if cache is True:
+            from bitrader import api_cache
+            cache = api_cache.from_url()
+        self.cache = cache or None
+
+        self.session = session()
+        self.future = future
+        self._future_session = None
+        self._future_lock = threading.Lock()
         self.url = self.url_template.format(resource='', token=self.token)
 
+    @property
+    def future_session(self):
+        """FuturesSession sharing self.session, so requests_futures is only imported by parallel requests"""
+        if not self.future:
+            raise AttributeError(f'{type(self).__name__} was created with future=False')
+        with self._future_lock:
+            if self._future_session is None:
+                from requests_futures.sessions import FuturesSession
+
+                self._future_session = FuturesSession(max_workers=10, session=self.session)
+        return self._future_session
+
+    def cache_key(self, url: str) -> str:
+        """url without its volatile_params, so requests that only differ in e.g. a nonce share a cache entry"""
+        parts = urlsplit(url)
+        query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                 if name not in self.volatile_params]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def cached_get(self, url: str, resource: str, hook=None):
+        """GET url through self.cache with the TTL of resource, then call hook(response) like requests would"""
+        response = self.cache.get(
+            self.cache_key(url), partial(self.session.get, url), ttl=self.resource_ttls.get(resource, DEFAULT_TTL),
+            stale=self.resource_stale.get(resource, 0), cacheable=lambda r: r.status_code == 200)
+        if hook is not None:
+            hook(response)
+        return response
+
     def get_resource(self, resource: str, processor: Callable[[dict], dict] = None,
                      data_format: str = 'raw', future: bool = False, **kwargs):
         """Method doing the actual heavy lifting
@@ -103,10 +231,17 @@ class BaseAPI:
             hooks = dict(response=callback)
             request_session = self.future_session if future else self.session
 
+            if self.cache is None:
+                result = request_session.get(self.url, hooks=hooks)
+            elif future:
+                result = self.future_session.executor.submit(self.cached_get, self.url, resource, callback)
+            else:
+                result = self.cached_get(self.url, resource, callback)
+
             response = {
                 'url': self.url_template.format(
                     token=self.token, resource=self.resource_templates[resource].format(**kwargs)),
-                'response': request_session.get(self.url, hooks=hooks),
+                'response': result,
                 'resource': resource,
                 'kwargs': kwargs,
             }
@@ -170,6 +305,15 @@ class OpenExchangeAPI(BaseAPI):
         'currencies': 'currencies.json',
         'latest': 'latest.json',
     }
+    resource_ttls = {
+        'historical': None,
+        'currencies': 60 * 60 * 24,
+        'latest': 60 * 60,
+    }
+    resource_stale = {
+        'currencies': 60 * 60 * 24,
+        'latest': 60 * 10,
+    }
 
 
 class HTTPBinAPI(BaseAPI):
@@ -185,6 +329,11 @@ class Ice3xAPI(BaseAPI):
         'orderbook': 'orderbook/info?nonce={nonce}&type=bid&pair_id=6',
 
     }
+    resource_ttls = {
+        'generic': 5,
+        'stats': 5,
+        'orderbook': 5,
+    }
 
 
 pair_ids = [{'pair_id': '3', 'pair_name': 'btc/zar', },
@@ -4,9 +4,21 @@ Tools for determining the
 
 """
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from decimal import Decimal
+from functools import partial
+from typing import TYPE_CHECKING
 
-import pandas as pd
+import numpy as np
+
+from bitrader import clients, forex, profiling
+from bitrader.cache import TTLCache
+from bitrader.fees import schedule as fee_schedule
+from bitrader.order_book import OrderBook, fill
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Removed as it complicates the bot on server deploys (?)
 # import seaborn as sns
@@ -21,6 +33,38 @@ BITX_SECRET = os.environ.get('BITX_SECRET')
 ICE3X_KEY = os.getenv('ICE3X_KEY')  # .encode('utf-8')
 ICE3X_PUBLIC = os.getenv('ICE3X_PUBLIC')  # .encode('utf-8')
 
+FNB_FOREX_URL = forex.FNB_FOREX_URL
+
+# Seconds to wait for each market data source before giving up on a snapshot
+SOURCE_TIMEOUTS = {
+    'kraken': 10,
+    'luno': 10,
+    'ice3x': 10,
+    'fnb': 20,
+}
+
+# Seconds market data from each source is reused before fetching it again
+SOURCE_TTLS = {
+    'kraken': 5,
+    'luno': 5,
+    'ice3x': 10,
+}  # Forex quotes are kept by forex.fnb, see forex.REFRESH_INTERVAL
+
+# Shared by all bot commands. Change TTLs with e.g. market_data_cache.ttls['ice3x'] = 30
+market_data_cache = TTLCache(maxsize=64, ttl=5, ttls=SOURCE_TTLS)
+
+# Most order book levels per side each source returns. None: only the full book is available.
+MAX_DEPTH = {
+    'kraken': 500,
+    'luno': 100,  # orderbook_top, more than that means the full book
+    'ice3x': None,
+}
+MIN_DEPTH = 25  # Fewest levels to ask for
+DEPTH_MARGIN = 1.5  # Fetch this much more value (and levels) than an amount needs
+
+# Last order book fetched per (source, book_type, coin_code), to size the next fetch by
+_fetched_books = {}
+
 COIN_MAP = {
     'ice3x': {
         'bitcoin': dict(
@@ -58,69 +102,122 @@ COIN_MAP = {
     },
 }
 
+# Snapshot names of the (buy side, sell side) order books per direction
+DIRECTION_BOOKS = {
+    'forward': ('eur_asks', 'zar_bids'),  # ZAR -> EUR -> coin on Kraken -> ZAR exchange
+    'reverse': ('zar_asks', 'eur_bids'),  # ZAR -> coin on ZAR exchange -> EUR on Kraken -> ZAR
+}
+
+# Snapshot name and FNB order type of the exchange rate per direction: forward buys Euros from the bank at
+# its selling rate, reverse sells them back at its (lower) buying rate
+DIRECTION_RATES = {
+    'forward': ('exchange_rate', 'buy'),
+    'reverse': ('exchange_rate_sell', 'sell'),
+}
+
 
 def get_forex_buy_quote(currency_code: str = 'EUR', source: str = 'FNB', order_type: str = 'buy'):
     """Get latest forex from FNB website
 
+    Reads the quotes kept by forex.fnb, so the website is only scraped when they are too old.
+
     """
-    if source == 'FNB':
-        tables = pd.read_html(
-            'https://www.fnb.co.za/Controller?nav=rates.forex.list.ForexRatesList',
-            index_col=1, header=0, match=currency_code)
+    exchange_rate, captured_at = forex_quote_source(currency_code, source=source, order_type=order_type)[1]()
 
-        df = tables[0]
+    return exchange_rate
 
-        types = {
-            'buy': 'Bank Selling Rate',
-            'sell': 'Bank Buying Rate',
-        }
 
-        exhange_rate = df.loc[currency_code, types[order_type]]
+def parse_fnb_forex(io, currency_code: str = 'EUR', order_type: str = 'buy'):
+    """Read forex quote from the FNB rates page
+
+    :param io: URL, text or binary file, or HTML string of the FNB forex rates page
+    """
+    if isinstance(io, str) and io.startswith(('http://', 'https://')):
+        quotes = forex.fetch_fnb_rates(url=io, timeout=SOURCE_TIMEOUTS['fnb'])
+    elif isinstance(io, str):
+        quotes = forex.parse_fnb_rates(io)
+    else:
+        quotes = forex.parse_fnb_rates(forex.read_chunks(io))
 
-        return Decimal("%.4f" % float(exhange_rate))
+    try:
+        return quotes[currency_code][order_type]
+    except KeyError:
+        raise KeyError(f'No {order_type} quote for {currency_code} on the FNB rates page')
 
 
-def kraken_order_book(book_type: str, currency_code: str = 'EUR', coin_code: str = 'XBT'):
+@profiling.timed('fetch.kraken')
+def kraken_order_book(book_type: str, currency_code: str = 'EUR', coin_code: str = 'XBT', depth: int = None):
     """Kraken specific orderbook retrieval
 
-    """
-    import krakenex
+    Args:
+        book_type: 'asks' or 'bids'
+        currency_code: Default = 'EUR'.
+        coin_code: XBT, LTC or ETH
+        depth: Optional. Number of levels to fetch. Default: MAX_DEPTH['kraken'].
+
+    Returns: OrderBook, not complete if depth levels came back.
 
-    kraken_api = krakenex.API(key=KRAKEN_API_KEY, secret=KRAKEN_PRIVATE_KEY, conn=krakenex.Connection())
+    """
+    kraken_api = clients.kraken(KRAKEN_API_KEY, KRAKEN_PRIVATE_KEY)
 
     pair = f'X{coin_code}Z{currency_code}'
-    orders = kraken_api.query_public('Depth', {'pair': pair})
+    count = min(depth or MAX_DEPTH['kraken'], MAX_DEPTH['kraken'])
+    params = {'pair': pair, 'count': count}
 
-    df = pd.DataFrame(
-        orders['result'][pair][book_type],
-        columns=['price', 'volume', 'timestamp'])
+    if not hasattr(kraken_api, 'session'):
+        # krakenex < 2 has no requests session to get the raw response from
+        orders = kraken_api.query_public('Depth', params)
+        book = OrderBook.from_levels(orders['result'][pair][book_type], book_type)
+    else:
+        from bitrader.api_tools import decode_depth
 
-    return df
+        response = kraken_api.session.get(
+            f'{kraken_api.uri}/{kraken_api.apiversion}/public/Depth', params=params,
+            timeout=SOURCE_TIMEOUTS['kraken'])
+        response.raise_for_status()
+        price, volume = decode_depth(response.content, 'kraken', ('result', pair), (book_type,))[book_type]
+        book = OrderBook(price, volume, book_type)
 
+    # Kraken returns at most MAX_DEPTH levels, so a book of that size is as complete as it gets
+    book.complete = len(book) < count or count == MAX_DEPTH['kraken']
 
-def luno_order_book(book_type: str, currency_code: str = 'ZAR'):
+    return book
+
+
+@profiling.timed('fetch.luno')
+def luno_order_book(book_type: str, currency_code: str = 'ZAR', depth: int = None):
     """
 
     Args:
         book_type: 'asks' or 'bids'
         currency_code: Default = 'ZAR'.
+        depth: Optional. Number of levels needed. Up to MAX_DEPTH['luno'] only the top of the book is
+            fetched. Default: the full book.
 
-    Returns: Dataframe with order book.
+    Returns: OrderBook
 
     """
-    from bitrader import bitx
-
-    bitx_api = bitx.BitX(BITX_KEY, BITX_SECRET)
-    df = bitx_api.get_order_book_frame()
+    bitx_api = clients.bitx(BITX_KEY, BITX_SECRET)
+    top = depth is not None and depth <= MAX_DEPTH['luno']
+    price, volume = bitx_api.get_order_book_arrays((book_type,), top=top)[book_type]
 
-    return df[book_type]
+    return OrderBook(price, volume, book_type, complete=not top or len(price) < MAX_DEPTH['luno'])
 
 
-def ice3x_order_book(book_type: str, coin_code: str = 'BTC', currency_code: str = 'ZAR'):
+@profiling.timed('fetch.ice3x')
+def ice3x_order_book(book_type: str, coin_code: str = 'BTC', currency_code: str = 'ZAR', depth: int = None):
     """Ice3X specific orderbook retrieval
+
+    Args:
+        book_type: 'ask' or 'bid'
+        coin_code: XBT, LTC or ETH
+        currency_code: Default = 'ZAR'.
+        depth: Ignored, Ice3x always returns the full book.
+
+    Returns: OrderBook
+
     """
-    from bitrader.api_tools import Ice3xAPI
-    ice = Ice3xAPI(cache=False, future=False)
+    ice = clients.ice3x()
 
     pair_map = {
         'XBT': 3,
@@ -136,11 +233,15 @@ def ice3x_order_book(book_type: str, coin_code: str = 'BTC', currency_code: str
         api_params=f'type={book_type}&pair_id={pair_id}',
         data_format='raw')
 
-    bids = pd.DataFrame(r['response'].json()['response']['entities'])
+    from bitrader.api_tools import decode_depth
 
-    return bids
+    price, volume = decode_depth(
+        r['response'].content, 'ice3x', ('response',), ('entities',), price_key='price', volume_key='amount')['entities']
 
+    return OrderBook(price, volume, f'{book_type}s')
 
+
+@profiling.timed('prepare_order_book')
 def prepare_order_book(order_book, book_type: str, bitcoin_column: str = 'volume', currency_column: str = 'price'):
     """Function for getting order book in standard form
 
@@ -175,6 +276,11 @@ def coin_exchange(df, limit, order_type: str, bitcoin_column: str = 'volume', cu
         sell exchanges bitcoins for currency
 
     """
+    if isinstance(df, OrderBook):
+        result = df.fill(float(limit), order_type)
+        if np.isnan(result):
+            raise KeyError(f'Order book exhausted at {limit}')
+        return Decimal(float(result))
 
     options = {
         'buy': {'from': currency_column, 'to': bitcoin_column},
@@ -197,25 +303,317 @@ def coin_exchange(df, limit, order_type: str, bitcoin_column: str = 'volume', cu
     return result
 
 
-def get_books(coin_code: str = 'XBT', exchange_name: str = 'Luno'):
+class MarketDataError(Exception):
+    """Raised when a market data snapshot could not be taken in time"""
+    pass
+
+
+class MarketSnapshot:
+    """Order books and quotes fetched together, with the time each source was captured
+
+    Items are accessed by name, e.g. snapshot['eur_asks'].
+
     """
 
-    :param coin_code: BTC, LTC, or ETH
-    :param exchange_name: Luno or Ice3x
-    :return:
+    def __init__(self, data: dict, captured_at: dict):
+        self.data = data
+        self.captured_at = captured_at
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __repr__(self):
+        return f'<MarketSnapshot {", ".join(self.data)}: skew {self.skew:.2f}s>'
+
+    @property
+    def skew(self) -> float:
+        """Seconds between the first and last source captured"""
+        if not self.captured_at:
+            return 0.
+        return max(self.captured_at.values()) - min(self.captured_at.values())
+
+    def check_skew(self, max_skew: float):
+        """Raise MarketDataError if the sources were captured more than max_skew seconds apart"""
+        if self.skew > max_skew:
+            raise MarketDataError(f'Snapshot skew of {self.skew:.2f}s is more than {max_skew:.2f}s')
+        return self
+
+
+_snapshot_executor = ThreadPoolExecutor(max_workers=8)
+
+# Keeps every order book and quote fetched when set, see set_recorder()
+_recorder = None
+
+
+def set_recorder(recorder):
+    """Record every fetched order book and forex quote, e.g. with a recorder.SnapshotRecorder
+
+    :param recorder: Object with a record(key, value) method, or None to stop recording
+    """
+    global _recorder
+    _recorder = recorder
+
+
+def recorded(key: tuple, fetch):
+    """Wrap fetch to pass each value it fetches on to the recorder set with set_recorder()"""
+
+    def wrapper():
+        value = fetch()
+        _record(key, value)
+        return value
+
+    return wrapper
+
+
+def _record(key: tuple, value, timestamp: float = None):
+    if _recorder is not None:
+        try:
+            _recorder.record(key, value, timestamp)
+        except OSError as e:
+            print(f'Could not record {key}: {e}')
+
+
+def _timed_fetch(fetch):
+    result = fetch()
+    return result, time.time()
+
+
+def cached_fetch(key: tuple, fetch, valid=None):
+    """Callable returning (value, captured_at) for key, read through market_data_cache
+
+    :param key: Tuple with the source as first item, e.g. ('kraken', 'asks', 'XBT')
+    :param fetch: Callable without arguments that does the actual fetch
+    :param valid: Optional. Callable that returns False for cached values that have to be fetched again
+    """
+    return partial(market_data_cache.get_entry, key, fetch, valid=valid)
+
+
+@profiling.timed('snapshot')
+def fetch_snapshot(sources: dict, max_skew: float = None) -> MarketSnapshot:
+    """Fetch all sources in parallel, each with its own deadline
+
+    Args:
+        sources: Dict of name: (source, fetch) where source is a key of SOURCE_TIMEOUTS
+            (or a timeout in seconds) and fetch a callable without arguments that returns
+            a tuple of (value, captured_at), like cached_fetch().
+        max_skew: Optional. Reject snapshots with sources captured further apart than this (seconds).
+
+    Returns: MarketSnapshot
+
+    """
+    started = time.time()
+    futures = {
+        name: (_snapshot_executor.submit(profiling.in_context(fetch)), SOURCE_TIMEOUTS.get(source, source))
+        for name, (source, fetch) in sources.items()}
+
+    data = {}
+    captured_at = {}
+    # Wait on the shortest deadline first, so every source is held to its own deadline
+    for name, (future, timeout) in sorted(futures.items(), key=lambda item: item[1][1]):
+        try:
+            data[name], captured_at[name] = future.result(timeout=max(started + timeout - time.time(), 0))
+        except TimeoutError:
+            raise MarketDataError(f'Timed out after {timeout}s fetching {name}')
+
+    snapshot = MarketSnapshot(data, captured_at)
+
+    if max_skew is not None:
+        snapshot.check_skew(max_skew)
+
+    return snapshot
+
+
+def book_value(source: str, max_invest, exchange_rate=None):
+    """Value in the currency of a source's order books (EUR for Kraken, ZAR for the rest) that max_invest needs
+
+    :param source: kraken, luno or ice3x
+    :param max_invest: Amount in ZAR, or None
+    :param exchange_rate: Optional. The ZAR / EURO Exchange rate. Default: the last one fetched.
+    :return: The value, or None if max_invest is None or no exchange rate is known yet
     """
-    eur_asks = prepare_order_book(kraken_order_book('asks', coin_code=coin_code), 'asks')
+    if max_invest is None:
+        return None
+    if source != 'kraken':
+        return float(max_invest)
 
-    if exchange_name.lower() == 'luno':
-        zar_bids = prepare_order_book(luno_order_book('bids'), 'bids')
-    elif exchange_name.lower() == 'ice3x':
-        zar_bids = prepare_order_book(ice3x_order_book('bid', coin_code=coin_code), 'bids', bitcoin_column='amount')
+    exchange_rate = exchange_rate or forex.fnb.peek('EUR', 'buy')
+    return float(max_invest) / float(exchange_rate) if exchange_rate else None
+
+
+def depth_for(key: tuple, value: float = None):
+    """Levels to fetch for the order book at key to cover value, going by the last book fetched for it
+
+    :param key: (source, book_type, coin_code)
+    :param value: Value in the book's currency, or None for the full book
+    :return: Number of levels, or None for as many as the source returns
+    """
+    book = _fetched_books.get(key)
+    if value is None or book is None or MAX_DEPTH[key[0]] is None:
+        return None
+
+    levels = int(np.searchsorted(book.cumulative_value, value * DEPTH_MARGIN)) + 1
+    if levels > len(book):
+        if book.complete:
+            return None
+        levels = 2 * len(book)
+
+    return max(int(levels * DEPTH_MARGIN), MIN_DEPTH)
+
+
+def fetch_order_book(source: str, book_type: str, coin_code: str = 'XBT', value: float = None):
+    """Fetch one side of an order book, with just enough levels to cover value
+
+    Starts with depth_for() levels, and fetches more for as long as the book is truncated before value,
+    so simulations don't run off the end of a partial book.
+
+    :param source: kraken, luno or ice3x
+    :param book_type: asks or bids
+    :param coin_code: XBT, LTC, or ETH
+    :param value: Optional. Value in the book's currency to cover, see book_value(). Default: the full book.
+    :return: OrderBook
+    """
+    if source == 'kraken':
+        fetch = partial(kraken_order_book, book_type, coin_code=coin_code)
+    elif source == 'luno':
+        fetch = partial(luno_order_book, book_type)
+    elif source == 'ice3x':
+        fetch = partial(ice3x_order_book, book_type[:-1], coin_code=coin_code)
     else:
+        raise KeyError(f'{source} is not a valid exchange_name')
+
+    key = (source, book_type, coin_code)
+    required = np.inf if value is None else value * DEPTH_MARGIN
+
+    book = fetch(depth=depth_for(key, value))
+    while not book.covers(required):
+        book = fetch(depth=4 * len(book))
+
+    _fetched_books[key] = book
+
+    return book
+
+
+def order_book_source(exchange_name: str, book_type: str, coin_code: str = 'XBT', cache: bool = True,
+                      value: float = None):
+    """Source name and fetch callable for one side of an exchange's order book
+
+    :param exchange_name: Kraken, Luno or Ice3x
+    :param book_type: asks or bids
+    :param coin_code: XBT, LTC, or ETH
+    :param cache: Default = True. Read through market_data_cache.
+    :param value: Optional. Value in the book's currency it has to cover, see book_value(). Default: the full book.
+    :return: Tuple of (source, fetch) as used by fetch_snapshot()
+    """
+    source = exchange_name.lower()
+
+    if source not in MAX_DEPTH:
         raise KeyError(f'{exchange_name} is not a valid exchange_name')
 
-    return eur_asks, zar_bids
+    fetch = partial(fetch_order_book, source, book_type, coin_code=coin_code, value=value)
+    fetch = recorded((source, book_type, coin_code), fetch)
+
+    if cache:
+        required = np.inf if value is None else value * DEPTH_MARGIN
+        return source, cached_fetch((source, book_type, coin_code), fetch, valid=lambda book: book.covers(required))
+
+    return source, partial(_timed_fetch, fetch)
+
+
+def forex_quote_source(currency_code: str = 'EUR', source: str = 'FNB', order_type: str = 'buy', cache: bool = True):
+    """Source name and fetch callable for a forex quote
+
+    The quote comes from the quotes kept by forex.fnb, with the time they were fetched as captured_at.
+
+    :param cache: Default = True. Use the kept quote if it is recent enough, instead of scraping again.
+    :return: Tuple of (source, fetch) as used by fetch_snapshot()
+    """
+    if source != 'FNB':
+        raise KeyError(f'{source} is not a valid forex source')
+
+    key = (source.lower(), currency_code, order_type)
+
+    def fetch():
+        if not cache:
+            forex.fnb.refresh()
+        exchange_rate, fetched_at = forex.fnb.entry(currency_code, order_type)
+        # The recorder skips quotes it already has, going by fetched_at
+        _record(key, exchange_rate, fetched_at)
+        return exchange_rate, fetched_at
+
+    return source.lower(), fetch
+
+
+def get_snapshot(coin_code: str = 'XBT', exchange_name: str = 'Luno', exchange_rate: Decimal = None,
+                 max_skew: float = None, directions=('forward',), max_invest: float = None,
+                 exchange_rate_sell: Decimal = None) -> MarketSnapshot:
+    """Fetch everything needed to simulate arbitrage in parallel
+
+    :param coin_code: BTC, LTC, or ETH
+    :param exchange_name: Luno or Ice3x
+    :param exchange_rate: The ZAR / EURO Exchange rate Euros are bought at. Fetched from FNB if not given.
+    :param max_skew: Optional. Maximum seconds between sources.
+    :param directions: Default = ('forward',). Fetch the books for forward and / or reverse arbitrage.
+    :param max_invest: Optional. Largest amount in ZAR that will be simulated, to only fetch the order book
+        levels it needs. Default: full order books.
+    :param exchange_rate_sell: The ZAR / EURO Exchange rate Euros are sold at, for reverse. Fetched from FNB
+        if not given.
+    :return: MarketSnapshot with the books of DIRECTION_BOOKS and the rate of DIRECTION_RATES for each direction
+    """
+    book_sources = {
+        'eur_asks': ('kraken', 'asks'),
+        'zar_bids': (exchange_name, 'bids'),
+        'zar_asks': (exchange_name, 'asks'),
+        'eur_bids': ('kraken', 'bids'),
+    }
+
+    sources = {}
+    for direction in directions:
+        for name in DIRECTION_BOOKS[direction]:
+            source, book_type = book_sources[name]
+            sources[name] = order_book_source(
+                source, book_type, coin_code=coin_code,
+                value=book_value(source.lower(), max_invest, exchange_rate or exchange_rate_sell))
+
+    return _fetch_with_rates(sources, directions, exchange_rate, exchange_rate_sell, max_skew)
+
 
+def _fetch_with_rates(sources: dict, directions, exchange_rate=None, exchange_rate_sell=None, max_skew=None):
+    """fetch_snapshot() of sources and the forex quotes of DIRECTION_RATES the directions need"""
+    rates = {'exchange_rate': exchange_rate, 'exchange_rate_sell': exchange_rate_sell}
 
+    for direction in directions:
+        name, order_type = DIRECTION_RATES[direction]
+        if not rates[name]:
+            sources[name] = forex_quote_source('EUR', order_type=order_type)
+
+    snapshot = fetch_snapshot(sources, max_skew=max_skew)
+
+    for name, rate in rates.items():
+        if rate:
+            snapshot.data[name] = rate
+
+    return snapshot
+
+
+def get_books(coin_code: str = 'XBT', exchange_name: str = 'Luno'):
+    """
+
+    :param coin_code: BTC, LTC, or ETH
+    :param exchange_name: Luno or Ice3x
+    :return: Tuple of (eur_asks, zar_bids) OrderBooks
+    """
+    snapshot = fetch_snapshot({
+        'eur_asks': order_book_source('kraken', 'asks', coin_code=coin_code),
+        'zar_bids': order_book_source(exchange_name, 'bids', coin_code=coin_code),
+    })
+
+    return snapshot['eur_asks'], snapshot['zar_bids']
+
+
+@profiling.timed('simulate')
 def arbitrage(amount, coin_code='XBT', coin_name='bitcoin', exchange_name='Luno',
               exchange_rate=None, transfer_fees: bool = True, verbose: bool = False, books=None, trade_fees: bool = True):
     """
@@ -235,27 +633,32 @@ def arbitrage(amount, coin_code='XBT', coin_name='bitcoin', exchange_name='Luno'
         Even better, make Exchange, Bank, Coin classes and build in stuff like exchange rates.
     """
 
+    try:
+        transfer_amount = Decimal(amount)
+    except (ValueError, AttributeError):
+        return 'Sorry, could not read reply.'
+
     if not books:
         try:
-            eur_asks, zar_bids = get_books(coin_code=coin_code, exchange_name=exchange_name)
-        except KeyError:
+            snapshot = get_snapshot(
+                coin_code=coin_code, exchange_name=exchange_name, exchange_rate=exchange_rate,
+                max_invest=transfer_amount)
+        except (KeyError, MarketDataError):
             return 'Error processing order books. Check if the exchanges are working and that there are open orders.'
+        eur_asks, zar_bids, exchange_rate = snapshot['eur_asks'], snapshot['zar_bids'], snapshot['exchange_rate']
     else:
         eur_asks, zar_bids = books
 
-    try:
-        transfer_amount = Decimal(amount)
-    except (ValueError, AttributeError):
-        return 'Sorry, could not read reply.'
-
     try:
         if not exchange_rate:
             exchange_rate = get_forex_buy_quote('EUR')
 
+        zar_exchange = exchange_name.lower()
+
         if transfer_fees:
-            _swift_fee = Decimal(110)
-            _fnb_comission = min(max(transfer_amount * Decimal(0.0055), Decimal(140)), Decimal(650))
-            _kraken_deposit_fee = Decimal(15)  # Fees: https://www.kraken.com/en-us/help/faq
+            _swift_fee = fee_schedule('fnb', 'swift', transfer_amount)
+            _fnb_comission = fee_schedule('fnb', 'commission', transfer_amount)
+            _kraken_deposit_fee = fee_schedule('kraken', 'deposit', transfer_amount)
         else:
             _swift_fee = Decimal(0)
             _fnb_comission = Decimal(0)
@@ -264,20 +667,20 @@ def arbitrage(amount, coin_code='XBT', coin_name='bitcoin', exchange_name='Luno'
         capital = transfer_amount + _fnb_comission + _swift_fee
 
         euros = transfer_amount / exchange_rate - _kraken_deposit_fee
-        _kraken_fee = euros * Decimal(0.0026) # TODO: Allow to specify lower tier, e.g. over $50k = 0.0024
+        _kraken_fee = fee_schedule('kraken', 'trade', euros)
 
-        _kraken_withdrawal_fee = Decimal(0.001)
-        _luno_deposit_fee = Decimal(0.0002)
+        _kraken_withdrawal_fee = fee_schedule('kraken', 'withdrawal', euros)
+        _luno_deposit_fee = fee_schedule(zar_exchange, 'deposit', euros)
 
         bitcoins = coin_exchange(eur_asks, euros - _kraken_fee , 'buy') - _kraken_withdrawal_fee - _luno_deposit_fee
 
         if trade_fees:
-            _luno_fees = bitcoins * Decimal(0.01)  # TODO: Allow to specify lower tier, e.g. over 10 BTC = 0.0075
+            _luno_fees = fee_schedule(zar_exchange, 'trade', bitcoins)
         else:
             _luno_fees = Decimal(0)
 
         if transfer_fees:
-            _luno_withdrawel_fee = Decimal(8.5)  # TODO: Check Ice3x fees
+            _luno_withdrawel_fee = fee_schedule(zar_exchange, 'withdrawal', bitcoins)
         else:
             _luno_withdrawel_fee = Decimal(0)
 
@@ -321,98 +724,603 @@ def arbitrage(amount, coin_code='XBT', coin_name='bitcoin', exchange_name='Luno'
         if verbose:
             print('\n'.join(response))
 
-        return {'roi': ((return_value - capital) / capital) * 100, 'summary': '\n'.join(response)}
+        return {
+            'roi': ((return_value - capital) / capital) * 100,
+            'profit': return_value - capital,
+            'summary': '\n'.join(response)}
 
     except KeyError:
         return "Don't be greedy, that's too much!"
 
 
+def fill_sweep(df, limits, order_type: str, bitcoin_column: str = 'volume', currency_column: str = 'value'):
+    """Vectorised version of coin_exchange for a whole array of limits at once
+
+    :param: order_type buy or sell
+        buy exchanges currency for bitcoin
+        sell exchanges bitcoins for currency
+
+    Returns: float array of converted amounts. NaN where the order book is exhausted.
+
+    """
+    if isinstance(df, OrderBook):
+        return df.fill(limits, order_type)
+
+    options = {
+        'buy': {'from': currency_column, 'to': bitcoin_column},
+        'sell': {'from': bitcoin_column, 'to': currency_column}
+    }
+
+    return fill(
+        df['cumulative_%s' % options[order_type]['from']].values,
+        df['cumulative_%s' % options[order_type]['to']].values,
+        df['price'].values,
+        limits, order_type)
+
+
+@profiling.timed('sweep')
+def roi_sweep(amounts, books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+              engine: str = 'float', exchange_name: str = 'Luno'):
+    """Simulate arbitrage() for a whole grid of ZAR amounts in one pass
+
+    Uses the same fees as arbitrage(), but without building the summary.
+
+    Args:
+        amounts: Array of amounts in ZAR.
+        books: Tuple of (eur_asks, zar_bids) as returned by get_books(). OrderBooks or prepared DataFrames.
+        exchange_rate: The ZAR / EURO Exchange rate.
+        transfer_fees: Whether to include FOREX fees or not.
+        trade_fees: Whether to include the ZAR exchange trade fee or not.
+        engine: Default = float. float arithmetic, or fixed for the integer cent / satoshi engine in
+            bitrader.fixed_point, with its rounding rules for exchange_name (OrderBooks only).
+        exchange_name: Luno or Ice3x.
+
+    Returns: ROI (in %) for each amount. NaN where one of the order books is exhausted.
+
+    """
+    eur_asks, zar_bids = books
+
+    if engine == 'fixed':
+        from bitrader import fixed_point
+
+        result = fixed_point.simulate(
+            np.rint(np.asarray(amounts, dtype=float) * fixed_point.CENTS),
+            (fixed_point.FixedPointBook(eur_asks), fixed_point.FixedPointBook(zar_bids)),
+            exchange_rate, transfer_fees=transfer_fees, trade_fees=trade_fees, exchange_name=exchange_name)
+
+        return fixed_point.roi(result)
+    elif engine != 'float':
+        raise KeyError(f'{engine} is not a valid engine')
+
+    transfer_amount = np.asarray(amounts, dtype=float)
+    exchange_rate = float(exchange_rate)
+    zar_exchange = exchange_name.lower()
+
+    if transfer_fees:
+        _swift_fee = fee_schedule('fnb', 'swift', transfer_amount)
+        _fnb_comission = fee_schedule('fnb', 'commission', transfer_amount)
+        _kraken_deposit_fee = fee_schedule('kraken', 'deposit')
+        _luno_withdrawel_fee = fee_schedule(zar_exchange, 'withdrawal')
+    else:
+        _swift_fee = 0.
+        _fnb_comission = 0.
+        _kraken_deposit_fee = 0.
+        _luno_withdrawel_fee = 0.
+
+    capital = transfer_amount + _fnb_comission + _swift_fee
+
+    euros = transfer_amount / exchange_rate - _kraken_deposit_fee
+    _kraken_fee = fee_schedule('kraken', 'trade', euros)
+
+    _kraken_withdrawal_fee = fee_schedule('kraken', 'withdrawal')
+    _luno_deposit_fee = fee_schedule(zar_exchange, 'deposit')
+
+    bitcoins = fill_sweep(eur_asks, euros - _kraken_fee, 'buy') - _kraken_withdrawal_fee - _luno_deposit_fee
+
+    if trade_fees:
+        _luno_fees = fee_schedule(zar_exchange, 'trade', bitcoins)
+    else:
+        _luno_fees = 0.
+
+    rands = fill_sweep(zar_bids, bitcoins - _luno_fees, 'sell')
+
+    return_value = rands - _luno_withdrawel_fee
+
+    return (return_value - capital) / capital * 100
+
+
+def _invest_for(euros_spent, exchange_rate: float, transfer_fees: bool = True):
+    """Inverse of roi_sweep() from Euros spent on coins to ZAR invested"""
+    _kraken_deposit_fee = fee_schedule.amount('kraken', 'deposit') if transfer_fees else 0.
+    return (euros_spent / (1 - fee_schedule.rate('kraken', 'trade')) + _kraken_deposit_fee) * exchange_rate
+
+
+def _coin_transfer_cost(exchange_name: str = 'Luno'):
+    """Coins lost moving coins between Kraken and the ZAR exchange"""
+    return fee_schedule.amount('kraken', 'withdrawal') + fee_schedule.amount(exchange_name, 'deposit')
+
+
+def _coins_needed(coins_sold, trade_fees: bool = True, exchange_name: str = 'Luno'):
+    """Inverse of roi_sweep() from coins sold on the ZAR exchange to coins bought on Kraken"""
+    _luno_fee_rate = fee_schedule.rate(exchange_name, 'trade') if trade_fees else 0.
+    return coins_sold / (1 - _luno_fee_rate) + _coin_transfer_cost(exchange_name)
+
+
+def _reverse_coins_needed(coins_sold, transfer_fees: bool = True, trade_fees: bool = True,
+                          exchange_name: str = 'Luno'):
+    """Inverse of reverse_sweep() from coins sold on Kraken to coins bought on the ZAR exchange"""
+    _transfer_fee = _coin_transfer_cost(exchange_name) if transfer_fees else 0.
+    _zar_fee_rate = fee_schedule.rate(exchange_name, 'trade') if trade_fees else 0.
+    return (coins_sold + _transfer_fee) / (1 - _zar_fee_rate)
+
+
+def _reverse_invest_for(coins_bought, zar_asks):
+    """Inverse of reverse_sweep() from coins bought to ZAR spent. NaN where zar_asks is exhausted."""
+    return fill(zar_asks.cumulative_volume, zar_asks.cumulative_value, zar_asks.price, coins_bought, 'sell')
+
+
+def reverse_breakpoints(books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+                        exchange_name: str = 'Luno'):
+    """ZAR amounts where the profit curve of reverse_sweep() changes slope, see breakpoints()
+
+    Args:
+        books: Tuple of (zar_asks, eur_bids) OrderBooks.
+        exchange_rate: The ZAR / EURO Exchange rate Euros are sold at, FNB's sell quote (exchange_rate_sell).
+        transfer_fees: Whether to include coin transfer and FOREX fees or not.
+        trade_fees: Whether to include the trade fees or not.
+        exchange_name: Luno or Ice3x.
+
+    Returns: Sorted array of amounts in ZAR.
+
+    """
+    zar_asks, eur_bids = books
+    exchange_rate = float(exchange_rate)
+
+    # Each ZAR ask level filled completely
+    ask_breakpoints = zar_asks.cumulative_value
+
+    # Each Kraken bid level filled completely
+    coins_bought = _reverse_coins_needed(eur_bids.cumulative_volume, transfer_fees, trade_fees, exchange_name)
+    bid_breakpoints = _reverse_invest_for(coins_bought, zar_asks)
+
+    # FNB commission clamped at its minimum and maximum, on the Rands received
+    if transfer_fees:
+        _kraken_fee_rate = fee_schedule.rate('kraken', 'trade') if trade_fees else 0.
+        rands = fee_schedule.breakpoints('fnb', 'commission')
+        euros = (rands / exchange_rate + fee_schedule.amount('kraken', 'eur_withdrawal')) / (1 - _kraken_fee_rate)
+        coins_sold = fill(eur_bids.cumulative_value, eur_bids.cumulative_volume, eur_bids.price, euros, 'buy')
+        coins_bought = _reverse_coins_needed(coins_sold, transfer_fees, trade_fees, exchange_name)
+        fee_breakpoints = _reverse_invest_for(coins_bought, zar_asks)
+    else:
+        fee_breakpoints = np.array([])
+
+    candidates = np.concatenate([ask_breakpoints, bid_breakpoints, fee_breakpoints])
+
+    return np.unique(candidates[~np.isnan(candidates)])
+
+
+def breakpoints(books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+                exchange_name: str = 'Luno'):
+    """ZAR amounts where the profit curve of roi_sweep() changes slope
+
+    Between two breakpoints both the capital and the return are linear in the amount, so the ROI
+    (a ratio of two linear functions) is monotonic and its maximum lies on a breakpoint.
+
+    Args:
+        books: Tuple of (eur_asks, zar_bids) OrderBooks.
+        exchange_rate: The ZAR / EURO Exchange rate.
+        transfer_fees: Whether to include FOREX fees or not.
+        trade_fees: Whether to include the ZAR exchange trade fee or not.
+        exchange_name: Luno or Ice3x.
+
+    Returns: Sorted array of amounts in ZAR.
+
+    """
+    eur_asks, zar_bids = books
+    exchange_rate = float(exchange_rate)
+
+    # Each Kraken ask level filled completely
+    ask_breakpoints = _invest_for(eur_asks.cumulative_value, exchange_rate, transfer_fees)
+
+    # Each ZAR bid level filled completely: coins needed, then what those coins cost on Kraken
+    coins = _coins_needed(zar_bids.cumulative_volume, trade_fees, exchange_name)
+    euros_spent = fill(eur_asks.cumulative_volume, eur_asks.cumulative_value, eur_asks.price, coins, 'sell')
+    bid_breakpoints = _invest_for(euros_spent[~np.isnan(euros_spent)], exchange_rate, transfer_fees)
+
+    # FNB commission clamped at its minimum and maximum
+    fee_breakpoints = fee_schedule.breakpoints('fnb', 'commission') if transfer_fees else np.array([])
+
+    return np.unique(np.concatenate([ask_breakpoints, bid_breakpoints, fee_breakpoints]))
+
+
+def find_optimum(books, exchange_rate, max_invest: float = 1000000, min_invest: float = 5000,
+                 transfer_fees: bool = True, trade_fees: bool = True, engine: str = 'float',
+                 exchange_name: str = 'Luno', direction: str = 'forward'):
+    """Amount with the highest ROI, evaluated only at the breakpoints of the profit curve
+
+    Takes time proportional to the order book depth instead of max_invest / step.
+
+    Args:
+        books: Tuple of OrderBooks, (eur_asks, zar_bids) for forward or (zar_asks, eur_bids) for reverse.
+        exchange_rate: The ZAR / EURO Exchange rate of the direction, see DIRECTION_RATES.
+        max_invest: Largest amount in ZAR to consider.
+        min_invest: Smallest amount in ZAR to consider.
+        transfer_fees: Whether to include FOREX fees or not.
+        trade_fees: Whether to include the ZAR exchange trade fee or not.
+        engine: Simulation engine of roi_sweep(), float or fixed. Forward only.
+        exchange_name: Luno or Ice3x.
+        direction: forward (roi_sweep()) or reverse (reverse_sweep()).
+
+    Returns: Tuple of (amount, roi). Both NaN if not even min_invest can be filled.
+
+    """
+    if direction == 'forward':
+        candidates = breakpoints(
+            books, exchange_rate, transfer_fees=transfer_fees, trade_fees=trade_fees, exchange_name=exchange_name)
+    elif direction == 'reverse':
+        candidates = reverse_breakpoints(
+            books, exchange_rate, transfer_fees=transfer_fees, trade_fees=trade_fees, exchange_name=exchange_name)
+    else:
+        raise KeyError(f'{direction} is not a valid direction')
+
+    candidates = candidates[(candidates > min_invest) & (candidates < max_invest)]
+    candidates = np.concatenate([[min_invest], candidates, [max_invest]])
+
+    if direction == 'forward':
+        roi = roi_sweep(
+            candidates, books, exchange_rate, transfer_fees=transfer_fees, trade_fees=trade_fees, engine=engine,
+            exchange_name=exchange_name)
+    else:
+        roi = reverse_sweep(
+            candidates, books, exchange_rate, transfer_fees=transfer_fees, trade_fees=trade_fees,
+            exchange_name=exchange_name)
+
+    if np.isnan(roi).all():
+        return np.nan, np.nan
+
+    best = np.nanargmax(roi)
+
+    return candidates[best], roi[best]
+
+
+def fillable_depth(books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+                   direction: str = 'forward', exchange_name: str = 'Luno') -> float:
+    """Largest amount in ZAR that both order books can fill
+
+    Args:
+        books: Tuple of OrderBooks, (eur_asks, zar_bids) for forward or (zar_asks, eur_bids) for reverse.
+        exchange_rate: The ZAR / EURO Exchange rate of the direction, see DIRECTION_RATES.
+        transfer_fees: Whether to include FOREX fees or not.
+        trade_fees: Whether to include the ZAR exchange trade fee or not.
+        direction: forward or reverse.
+        exchange_name: Luno or Ice3x.
+
+    Returns: Amount in ZAR, 0 if one of the books is empty.
+
+    """
+    if not len(books[0]) or not len(books[1]):
+        return 0.
+
+    if direction == 'reverse':
+        zar_asks, eur_bids = books
+        # Buying the whole ZAR ask side, or as much as it takes to sell into the whole Kraken bid side
+        coins = _reverse_coins_needed(eur_bids.cumulative_volume[-1], transfer_fees, trade_fees, exchange_name)
+        return float(np.nanmin([zar_asks.cumulative_value[-1], _reverse_invest_for(coins, zar_asks)]))
+    elif direction != 'forward':
+        raise KeyError(f'{direction} is not a valid direction')
+
+    eur_asks, zar_bids = books
+    exchange_rate = float(exchange_rate)
+
+    # Buying the whole Kraken ask side, or as much as it takes to sell into the whole ZAR bid side
+    coins = _coins_needed(zar_bids.cumulative_volume[-1], trade_fees, exchange_name)
+    euros_spent = np.nanmin([
+        eur_asks.cumulative_value[-1],
+        fill(eur_asks.cumulative_volume, eur_asks.cumulative_value, eur_asks.price, coins, 'sell')])
+
+    return float(_invest_for(euros_spent, exchange_rate, transfer_fees))
+
+
 def optimal(max_invest: int = 1000000, coin: str = 'bitcoin', exchange='luno', return_format: str = 'text',
-            exchange_rate: Decimal = None):
+            exchange_rate: Decimal = None, books=None, engine: str = 'fixed', direction: str = 'forward'):
     """
 
     Args:
         max_invest:
         coin: bitcoin, litecoin, ethereum
         exchange: luno, ice3x or kraken
-        return_format: text or picture
-        exchange_rate:
+        return_format: text, values, raw (DataFrame) or png (bytes)
+        exchange_rate: The ZAR / EURO Exchange rate of the direction, see DIRECTION_RATES: the rate Euros are
+            bought at for forward, sold at for reverse. Fetched from FNB if not given.
+        books: Optional. Tuple of the books in DIRECTION_BOOKS[direction], e.g. from an earlier snapshot.
+            Fetched if not given.
+        engine: Default = fixed. Simulation engine of roi_sweep(), fixed (integer) or float. Forward only.
+        direction: Default = forward. forward (Kraken -> exchange) or reverse (exchange -> Kraken).
     """
 
-    if not exchange_rate:
-        exchange_rate = get_forex_buy_quote('EUR')
+    rate_name, order_type = DIRECTION_RATES[direction]
 
-    books = get_books(
-        coin_code=COIN_MAP[exchange][coin]['coin_code'],
-        exchange_name=COIN_MAP[exchange][coin]['exchange_name']
-    )
+    if not books:
+        snapshot = get_snapshot(
+            coin_code=COIN_MAP[exchange][coin]['coin_code'],
+            exchange_name=COIN_MAP[exchange][coin]['exchange_name'],
+            directions=(direction,),
+            max_invest=max_invest,
+            **{rate_name: exchange_rate},
+        )
+        books = tuple(snapshot[name] for name in DIRECTION_BOOKS[direction])
+        exchange_rate = snapshot[rate_name]
+    elif not exchange_rate:
+        exchange_rate = get_forex_buy_quote('EUR', order_type=order_type)
+
+    amounts = np.arange(5000, max_invest, 5000)
+    if direction == 'forward':
+        roi = roi_sweep(
+            amounts, books=books, exchange_rate=exchange_rate, transfer_fees=True, engine=engine,
+            exchange_name=COIN_MAP[exchange][coin]['exchange_name'])
+    else:
+        roi = reverse_sweep(
+            amounts, books=books, exchange_rate=exchange_rate, transfer_fees=True,
+            exchange_name=COIN_MAP[exchange][coin]['exchange_name'])
 
-    results = []
-    for amount in range(5000, max_invest, 5000):
+    # Stop at the first amount the order books can't fill
+    exhausted = np.isnan(roi)
+    if exhausted.any():
+        amounts = amounts[:exhausted.argmax()]
+        roi = roi[:exhausted.argmax()]
 
-        try:
-            results.append(
-                dict(
-                    amount=amount, roi=arbitrage(
-                        amount=amount,
-                        exchange_rate=exchange_rate,
-                        books=books,
-                        transfer_fees=True,
-                        **COIN_MAP[exchange][coin],
-                    )['roi']))
-        except Exception as e:
-            print(e)
-            break
-
-    df = pd.DataFrame(results)
-    df.amount = df.amount.astype(float)
+    import pandas as pd
+
+    df = pd.DataFrame(dict(amount=amounts.astype(float), roi=roi))
     df = df.set_index('amount')
-    df.roi = df.roi.astype(float)
 
-    max_roi = df.max()
+    if return_format == 'raw':
+        return df
+    elif return_format == 'png':
+        from bitrader.charts import render_png
+        return render_png(df)
+
+    if return_format == 'text':
+        invest_amount, invest_roi = find_optimum(
+            books, exchange_rate, max_invest=max_invest, engine=engine,
+            exchange_name=COIN_MAP[exchange][coin]['exchange_name'], direction=direction)
+        if np.isnan(invest_amount):
+            return df
+        return f'Ideal invest amount: {invest_amount:.2f} with ROI of {invest_roi:.2f}'
+
+    max_roi = df.roi.max()
 
     try:
-        near_optimal = df.loc[df.roi > max_roi * (1 - 0.001)].reset_index()
+        near_optimal = df.loc[df.roi >= max_roi - abs(max_roi) * 0.001].reset_index()
         invest_amount = near_optimal.iloc[0].amount
         invest_roi = near_optimal.iloc[0].roi
     except:
         return df
 
-    if return_format == 'text':
-        return f'Ideal invest amount: {invest_amount} with ROI of {invest_roi:.2f}'
-    elif return_format == 'values':
+    if return_format == 'values':
         return invest_amount, near_optimal
-    elif return_format == 'raw':
-        return df
-    elif return_format == 'png':
-        raise NotImplementedError('Not yet implemented')
     else:
         raise KeyError(f'Invalid return_format selection {return_format}')
 
 
-def reverse_arb(amount, coin='litecoin', exchange_buy='ice3x', exchange_sell='kraken'):
-    """
+def reverse_arb(amount, coin='litecoin', exchange_buy='ice3x', exchange_sell='kraken', snapshot=None,
+                transfer_fees: bool = True, trade_fees: bool = True):
+    """Simulate buying coins with ZAR, selling them on Kraken and bringing the Euros home
 
-    :param amount:
-    :param coin:
-    :return:
+    :param amount: Amount in ZAR
+    :param coin: bitcoin, litecoin or ethereum
+    :param snapshot: Optional. MarketSnapshot with zar_asks, eur_bids and exchange_rate_sell, e.g. from
+        get_snapshot(directions=('forward', 'reverse')). Fetched if not given.
+    :param transfer_fees: Whether to include coin transfer and FOREX fees or not.
+    :param trade_fees: Whether to include the trade fees or not.
+    :return: Text with amount in, amount out and ROI
     """
     if coin in ['litecoin', 'ethereum']:
-        zar_asks = prepare_order_book(
-            ice3x_order_book(
-                'ask', coin_code=COIN_MAP[exchange_buy][coin]['coin_code']), 'asks', bitcoin_column='amount')
+        exchange_name = 'ice3x'
+    else:
+        exchange_name = 'luno'
+
+    def simulate(snapshot):
+        books = tuple(snapshot[name] for name in DIRECTION_BOOKS['reverse'])
+        roi = reverse_sweep(
+            [amount], books, snapshot['exchange_rate_sell'], transfer_fees=transfer_fees, trade_fees=trade_fees,
+            exchange_name=exchange_name)[0]
+        return books, roi
+
+    if snapshot is not None:
+        books, roi = simulate(snapshot)
+        if not np.isnan(roi) or all(book.complete for book in books):
+            return _reverse_arb_text(amount, roi)
+        # The books were fetched for a smaller amount: fetch more levels instead of giving up
+
+    try:
+        snapshot = get_snapshot(
+            coin_code=COIN_MAP[exchange_sell][coin]['coin_code'], exchange_name=exchange_name,
+            exchange_rate_sell=snapshot['exchange_rate_sell'] if snapshot is not None else None,
+            directions=('reverse',), max_invest=amount)
+    except (KeyError, MarketDataError):
+        return 'Error processing order books. Check if the exchanges are working and that there are open orders.'
+
+    return _reverse_arb_text(amount, simulate(snapshot)[1])
+
+
+def _reverse_arb_text(amount, roi) -> str:
+    if np.isnan(roi):
+        return "Don't be greedy, that's too much!"
+
+    rands = amount * (1 + roi / 100)
+
+    return f'R{amount:.0f}, R{rands:.0f}, {roi:.2f}%'
+
+
+def reverse_sweep(amounts, books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+                  exchange_name: str = 'Luno'):
+    """Simulate reverse_arb() (ZAR -> coin -> EUR -> ZAR) for a whole grid of ZAR amounts in one pass
+
+    Mirrors the fees of roi_sweep(): coin transfer, Kraken EUR withdrawal and FOREX fees with transfer_fees,
+    ZAR exchange and Kraken trade fees with trade_fees.
+
+    Args:
+        amounts: Array of amounts in ZAR.
+        books: Tuple of (zar_asks, eur_bids) OrderBooks or prepared DataFrames.
+        exchange_rate: The ZAR / EURO Exchange rate Euros are sold at, FNB's sell quote (exchange_rate_sell).
+        transfer_fees: Whether to include coin transfer and FOREX fees or not.
+        trade_fees: Whether to include the trade fees or not.
+        exchange_name: Luno or Ice3x.
+
+    Returns: ROI (in %) for each amount. NaN where one of the order books is exhausted.
+
+    """
+    zar_asks, eur_bids = books
+    capital = np.asarray(amounts, dtype=float)
+    exchange_rate = float(exchange_rate)
+
+    if transfer_fees:
+        _coin_transfer_fee = _coin_transfer_cost(exchange_name)
+        _kraken_withdrawal_fee = fee_schedule.amount('kraken', 'eur_withdrawal')
+        _swift_fee = fee_schedule.amount('fnb', 'swift')
+    else:
+        _coin_transfer_fee = 0.
+        _kraken_withdrawal_fee = 0.
+        _swift_fee = 0.
+
+    coins = fill_sweep(zar_asks, capital, 'buy')
+
+    if trade_fees:
+        _zar_exchange_fees = fee_schedule(exchange_name, 'trade', coins)
     else:
-        zar_asks = prepare_order_book(luno_order_book('asks'), 'asks')
+        _zar_exchange_fees = 0.
 
-    eur_bids = prepare_order_book(
-        kraken_order_book('bids', coin_code=COIN_MAP[exchange_sell][coin]['coin_code']), 'asks')
+    euros = fill_sweep(eur_bids, coins - _zar_exchange_fees - _coin_transfer_fee, 'sell')
 
-    coins = coin_exchange(zar_asks, amount, 'buy')
-    euro = coin_exchange(eur_bids, coins, 'sell')
+    if trade_fees:
+        _kraken_fee = fee_schedule('kraken', 'trade', euros)
+    else:
+        _kraken_fee = 0.
 
-    zar_asks = prepare_order_book(luno_order_book('bids'), 'bids')
+    rands = (euros - _kraken_fee - _kraken_withdrawal_fee) * exchange_rate
+
+    if transfer_fees:
+        _fnb_comission = fee_schedule('fnb', 'commission', rands)
+    else:
+        _fnb_comission = 0.
 
-    exchange_rate = get_forex_buy_quote('EUR')
-    rands = euro * exchange_rate
+    return_value = rands - _fnb_comission - _swift_fee
 
-    return f'R{amount:.0f}, R{rands:.0f}, {(rands - amount)/amount * 100:.2f}%'
+    return (return_value - capital) / capital * 100
+
+
+def arbitrage_routes(directions=('forward', 'reverse')) -> list:
+    """Every (direction, coin, exchange) route between Kraken and a ZAR exchange in COIN_MAP
+
+    forward buys coins on Kraken with Euros and sells them on the ZAR exchange, reverse the other way around.
+
+    """
+    return [
+        (direction, coin, exchange)
+        for exchange, coins in COIN_MAP.items() if exchange != 'kraken'
+        for coin in coins if coin in COIN_MAP['kraken']
+        for direction in directions]
+
+
+def route_books(direction: str, coin: str, exchange: str) -> tuple:
+    """Snapshot names of the (buy side, sell side) order books a route trades against"""
+    coin_code = COIN_MAP[exchange][coin]['coin_code']
+
+    if direction == 'forward':
+        return f'kraken_asks_{coin_code}', f'{exchange}_bids_{coin_code}'
+    elif direction == 'reverse':
+        return f'{exchange}_asks_{coin_code}', f'kraken_bids_{coin_code}'
+    else:
+        raise KeyError(f'{direction} is not a valid direction')
+
+
+def evaluate_route(snapshot: MarketSnapshot, route: tuple, max_invest: float = 1000000, engine: str = 'float'):
+    """Best amount, its ROI and the fillable depth for one route
+
+    Args:
+        snapshot: MarketSnapshot with the route's books (see route_books()) and the exchange rate of its
+            direction (see DIRECTION_RATES).
+        route: Tuple of (direction, coin, exchange) as returned by arbitrage_routes().
+        max_invest: Largest amount in ZAR to consider.
+        engine: roi_sweep() engine for forward routes.
+
+    Returns: Dict of direction, coin, buy, sell, amount, roi and depth. amount and roi are NaN if
+        the books can't fill the smallest amount.
+
+    """
+    direction, coin, exchange = route
+    books = tuple(snapshot[name] for name in route_books(direction, coin, exchange))
+    exchange_rate = snapshot[DIRECTION_RATES[direction][0]]
+
+    exchange_name = COIN_MAP[exchange][coin]['exchange_name']
+    amount, roi = find_optimum(
+        books, exchange_rate, max_invest=max_invest, engine=engine, exchange_name=exchange_name, direction=direction)
+    depth = fillable_depth(books, exchange_rate, direction=direction, exchange_name=exchange_name)
+
+    if direction == 'forward':
+        buy, sell = 'kraken', exchange
+    else:
+        buy, sell = exchange, 'kraken'
+
+    return dict(
+        direction=direction, coin=coin, buy=buy, sell=sell, amount=float(amount), roi=float(roi), depth=float(depth))
+
+
+_route_executor = ThreadPoolExecutor(max_workers=4)
+
+
+@profiling.timed('scan')
+def scan_routes(max_invest: float = 1000000, directions=('forward', 'reverse'), exchange_rate: Decimal = None,
+                max_skew: float = None, snapshot: MarketSnapshot = None, engine: str = 'float',
+                exchange_rate_sell: Decimal = None) -> 'pd.DataFrame':
+    """Evaluate every route in COIN_MAP on one market snapshot and rank them by ROI
+
+    Each distinct order book is fetched once, in parallel, and shared by all routes that trade against it.
+
+    Args:
+        max_invest: Largest amount in ZAR to consider per route.
+        directions: Route directions to include, forward and / or reverse.
+        exchange_rate: The ZAR / EURO Exchange rate Euros are bought at. Fetched from FNB if not given.
+        max_skew: Optional. Maximum seconds between sources.
+        snapshot: Optional. MarketSnapshot to use instead of fetching one.
+        engine: roi_sweep() engine for forward routes.
+        exchange_rate_sell: The ZAR / EURO Exchange rate Euros are sold at, for reverse routes. Fetched from
+            FNB if not given.
+
+    Returns: DataFrame with a row per route, best ROI first.
+
+    """
+    routes = arbitrage_routes(directions)
+
+    if snapshot is None:
+        sources = {}
+        for route in routes:
+            for name in route_books(*route):
+                exchange_name, book_type, coin_code = name.split('_')
+                sources[name] = order_book_source(
+                    exchange_name, book_type, coin_code=coin_code,
+                    value=book_value(exchange_name, max_invest, exchange_rate or exchange_rate_sell))
+
+        snapshot = _fetch_with_rates(sources, directions, exchange_rate, exchange_rate_sell, max_skew)
+
+    results = list(_route_executor.map(
+        partial(profiling.in_context(evaluate_route), snapshot, max_invest=max_invest, engine=engine), routes))
+
+    import pandas as pd
+
+    df = pd.DataFrame(results, columns=['direction', 'coin', 'buy', 'sell', 'amount', 'roi', 'depth'])
+
+    return df.sort_values('roi', ascending=False, na_position='last').reset_index(drop=True)
+
+
+def scan_summary(df: 'pd.DataFrame') -> str:
+    """scan_routes() table as text, e.g. for the /scan bot command"""
+    lines = ['Route: best amount, ROI (fillable depth)']
+    for row in df.itertuples():
+        route = f'{row.coin.capitalize()} {row.buy.capitalize()} -> {row.sell.capitalize()}'
+        if np.isnan(row.roi):
+            lines.append(f'{route}: not enough depth')
+        else:
+            lines.append(f'{route}: R{row.amount:.0f}, {row.roi:.2f}% (R{row.depth:.0f})')
+    return '\n'.join(lines)
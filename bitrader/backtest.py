@@ -0,0 +1,338 @@
+""" Backtest
+
+Replay arbitrage over snapshots stored by bitrader.recorder.
+
+The time range is sampled every interval seconds. At each sample time the latest recorded snapshot of every
+book the route needs (and the forex quote) is taken, and the ROI of a whole grid of amounts computed with
+roi_sweep() or reverse_sweep(). Streams are decoded incrementally in time order, and rows whose snapshots
+didn't change since the previous sample time are copied instead of recomputed. Days are spread over a
+process pool.
+
+    python -m bitrader.backtest records --start 2017-11-01 --end 2017-12-01 --out backtest.npz
+
+"""
+import argparse
+import calendar
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bitrader.recorder import Segment, segment_days
+
+
+def route_streams(coin: str = 'bitcoin', exchange: str = 'luno', direction: str = 'forward') -> list:
+    """Recorder streams (venue, book_type, code) a route needs: buy side book, sell side book, forex quote
+
+    The forex quote is FNB's buy quote for forward routes and its sell quote for reverse ones.
+
+    """
+    from bitrader.arbitrage_tools import COIN_MAP, DIRECTION_RATES
+
+    coin_code = COIN_MAP[exchange][coin]['coin_code']
+
+    if direction == 'forward':
+        books = [('kraken', 'asks', coin_code), (exchange, 'bids', coin_code)]
+    elif direction == 'reverse':
+        books = [(exchange, 'asks', coin_code), ('kraken', 'bids', coin_code)]
+    else:
+        raise KeyError(f'{direction} is not a valid direction')
+
+    return books + [('fnb', DIRECTION_RATES[direction][1], 'EUR')]
+
+
+def sample_times(day: str, start: float = None, end: float = None, interval: float = 60):
+    """Sample times within day (and start, end), on multiples of interval"""
+    day_start = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+    first = max(day_start, start if start is not None else day_start)
+    last = min(day_start + 86400, end if end is not None else day_start + 86400)
+
+    return np.arange(np.ceil(first / interval) * interval, last, interval)
+
+
+def backtest_segment(path: str, streams: list, times, amounts, direction: str = 'forward',
+                     exchange_name: str = 'Luno', max_age: float = 300):
+    """ROI surface for the sample times of one segment
+
+    Runs in a worker process.
+
+    Args:
+        path: Segment directory.
+        streams: Buy side book, sell side book and forex quote streams, see route_streams().
+        times: Array of sample times.
+        amounts: Array of amounts in ZAR.
+        direction: forward or reverse.
+        exchange_name: Luno or Ice3x.
+        max_age: Skip sample times where a snapshot is older than this (seconds).
+
+    Returns: Tuple of (times, roi, complete) for the sample times with data: roi as float32 array of times x
+        amounts, and complete as bool array, False where a book was recorded to a limited depth. The ROI of
+        amounts past the end of such a book is NaN, like that of amounts the market couldn't fill.
+
+    """
+    from bitrader.arbitrage_tools import reverse_sweep, roi_sweep
+    from bitrader.order_book import OrderBook
+
+    segment = Segment(path)
+    times = np.asarray(times, dtype=float)
+
+    # Row of the latest snapshot of each stream at each sample time, -1 if there is none recent enough
+    rows = []
+    for stream in streams:
+        stream_rows = segment.rows(*stream)
+        if not len(stream_rows):
+            rows.append(np.full(len(times), -1))
+            continue
+        timestamps = segment.index['timestamp'][stream_rows]
+        position = np.searchsorted(timestamps, times, side='right') - 1
+        latest = np.maximum(position, 0)
+        fresh = (position >= 0) & (times - timestamps[latest] <= max_age)
+        rows.append(np.where(fresh, stream_rows[latest], -1))
+
+    rows = np.array(rows).T
+    valid = (rows >= 0).all(axis=1)
+    times, rows = times[valid], rows[valid]
+
+    roi = np.empty((len(times), len(amounts)), dtype=np.float32)
+    complete = np.empty(len(times), dtype=bool)
+    cached = {}
+    previous = None
+
+    for i, sample_rows in enumerate(rows.tolist()):
+        if sample_rows == previous:
+            roi[i], complete[i] = roi[i - 1], complete[i - 1]
+            continue
+
+        values = []
+        for stream, row in zip(streams, sample_rows):
+            levels = segment.levels_at(row, cached=cached.get(stream))
+            cached[stream] = row, levels
+            values.append(levels)
+
+        buy_side, sell_side = (
+            OrderBook(levels['price'], levels['volume'], stream[1], complete=bool(segment.index['complete'][row]))
+            for stream, levels, row in zip(streams[:2], values[:2], sample_rows[:2]))
+        complete[i] = buy_side.complete and sell_side.complete
+        exchange_rate = float(values[2]['price'][0])
+
+        if direction == 'forward':
+            roi[i] = roi_sweep(amounts, (buy_side, sell_side), exchange_rate, exchange_name=exchange_name)
+        else:
+            roi[i] = reverse_sweep(amounts, (buy_side, sell_side), exchange_rate, exchange_name=exchange_name)
+
+        previous = sample_rows
+
+    return times, roi, complete
+
+
+class BacktestResult:
+    """ROI surface of a backtest: one row per sample time, one column per amount"""
+
+    def __init__(self, times, amounts, roi, meta: dict = None, complete=None):
+        """
+
+        Args:
+            times: Array of sample times (seconds since epoch).
+            amounts: Array of amounts in ZAR.
+            roi: float32 array of times x amounts. NaN where the books couldn't fill the amount.
+            meta: Optional dict of route and settings, stored with the result.
+            complete: Optional bool array, False at sample times where a book was recorded to a limited depth.
+                Default: all complete.
+        """
+        self.times = np.asarray(times, dtype=float)
+        self.amounts = np.asarray(amounts, dtype=float)
+        self.roi = np.asarray(roi, dtype=np.float32)
+        self.meta = dict(meta or {})
+        self.complete = np.ones(len(self.times), dtype=bool) if complete is None else np.asarray(complete, dtype=bool)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return f'<BacktestResult {len(self.times)} times x {len(self.amounts)} amounts>'
+
+    def best(self):
+        """Tuple of (amount, roi) arrays: the best amount and its ROI at each sample time, NaN if none fills"""
+        fillable = ~np.isnan(self.roi).all(axis=1)
+        best = np.zeros(len(self.times), dtype=int)
+        best[fillable] = np.nanargmax(self.roi[fillable], axis=1)
+
+        amount = np.where(fillable, self.amounts[best], np.nan)
+        roi = np.where(fillable, self.roi[np.arange(len(self.times)), best], np.nan)
+
+        return amount, roi
+
+    def known(self):
+        """Bool array of times x amounts: False where the ROI is NaN because a book was recorded to a limited
+        depth, so whether the market could fill the amount is unknown"""
+        return ~np.isnan(self.roi) | self.complete[:, None]
+
+    def summary(self, threshold: float = 0.) -> dict:
+        """Summary statistics
+
+        Args:
+            threshold: ROI (in %) above which a sample time counts as profitable.
+
+        The best amount at a sample time with a truncated book is the best of the amounts it covers. Each
+        amount's share of profitable sample times only counts the times its ROI is known.
+
+        """
+        amount, roi = self.best()
+        fillable = ~np.isnan(roi)
+        profitable = fillable & (roi > threshold)
+
+        if not fillable.any():
+            return dict(samples=len(self.times), fillable=0, profitable_fraction=0.)
+
+        best = np.nanargmax(roi)
+        known = self.known()
+        profitable_amounts = (np.nan_to_num(self.roi, nan=-np.inf) > threshold).sum(axis=0)
+
+        return dict(
+            samples=len(self.times),
+            start=float(self.times[0]),
+            end=float(self.times[-1]),
+            fillable=int(fillable.sum()),
+            truncated=int((~self.complete).sum()),
+            profitable_fraction=float(profitable.sum() / fillable.sum()),
+            roi_mean=float(np.mean(roi[fillable])),
+            roi_median=float(np.median(roi[fillable])),
+            roi_p95=float(np.percentile(roi[fillable], 95)),
+            roi_max=float(roi[best]),
+            roi_max_at=float(self.times[best]),
+            roi_max_amount=float(amount[best]),
+            amount_median=float(np.median(amount[profitable])) if profitable.any() else float('nan'),
+            # Share of the sample times each amount was profitable at, of those its ROI is known at
+            amount_profitable=dict(zip(
+                self.amounts.tolist(), (profitable_amounts / np.maximum(known.sum(axis=0), 1)).tolist())),
+        )
+
+    def summary_text(self, threshold: float = 0.) -> str:
+        """summary() as text, e.g. for the bot"""
+        s = self.summary(threshold)
+        if not s['fillable']:
+            return f'No usable snapshots in {s["samples"]} sample times.'
+
+        def when(timestamp):
+            return time.strftime('%Y-%m-%d %H:%M', time.gmtime(timestamp))
+
+        lines = [
+            f'{when(s["start"])} to {when(s["end"])} UTC, {s["fillable"]} sample times'
+            + (f' ({s["truncated"]} with partial books)' if s['truncated'] else ''),
+            f'Profitable: {s["profitable_fraction"] * 100:.1f}% of the time',
+            f'Best ROI: mean {s["roi_mean"]:.2f}%, median {s["roi_median"]:.2f}%, p95 {s["roi_p95"]:.2f}%',
+            f'Max ROI: {s["roi_max"]:.2f}% at R{s["roi_max_amount"]:.0f} on {when(s["roi_max_at"])}',
+        ]
+        if not np.isnan(s['amount_median']):
+            lines.append(f'Median best amount when profitable: R{s["amount_median"]:.0f}')
+
+        return '\n'.join(lines)
+
+    def to_frame(self):
+        """DataFrame of the best amount and ROI per sample time, indexed by time, e.g. for charts.render_png()"""
+        import pandas as pd
+
+        amount, roi = self.best()
+        return pd.DataFrame(dict(roi=roi, amount=amount), index=pd.to_datetime(self.times, unit='s'))
+
+    def save(self, path: str):
+        """Store as compressed npz. meta values are stored as strings."""
+        np.savez_compressed(
+            path, times=self.times, amounts=self.amounts, roi=self.roi, complete=self.complete,
+            meta=np.array(sorted(self.meta.items()), dtype=str))
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(data['times'], data['amounts'], data['roi'], meta=dict(data['meta'].tolist()),
+                       complete=data['complete'] if 'complete' in data else None)
+
+
+def backtest(root: str, start: float = None, end: float = None, coin: str = 'bitcoin', exchange: str = 'luno',
+             direction: str = 'forward', amounts=None, interval: float = 60, max_age: float = 300,
+             processes: int = None) -> BacktestResult:
+    """Replay arbitrage over the recorded snapshots under root
+
+    Args:
+        root: Recorder directory.
+        start: Optional. First time (seconds since epoch).
+        end: Optional. Last time (seconds since epoch).
+        coin: bitcoin, litecoin or ethereum.
+        exchange: luno or ice3x.
+        direction: forward or reverse.
+        amounts: Array of amounts in ZAR. Default = 5000 to 1000000 in steps of 5000.
+        interval: Seconds between sample times.
+        max_age: Skip sample times where a snapshot is older than this (seconds).
+        processes: Worker processes. Default = one per CPU, 1 runs in this process.
+
+    Returns: BacktestResult
+
+    """
+    from bitrader.arbitrage_tools import COIN_MAP
+
+    amounts = np.arange(5000, 1000000, 5000, dtype=float) if amounts is None else np.asarray(amounts, dtype=float)
+    streams = route_streams(coin, exchange, direction)
+    exchange_name = COIN_MAP[exchange][coin]['exchange_name']
+
+    jobs = []
+    for day in segment_days(root):
+        times = sample_times(day, start, end, interval)
+        if len(times):
+            jobs.append((os.path.join(root, day), streams, times, amounts, direction, exchange_name, max_age))
+
+    if processes == 1 or len(jobs) <= 1:
+        results = [backtest_segment(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(backtest_segment, *zip(*jobs)))
+
+    times = np.concatenate([r[0] for r in results]) if results else np.empty(0)
+    roi = np.concatenate([r[1] for r in results]) if results else np.empty((0, len(amounts)), dtype=np.float32)
+    complete = np.concatenate([r[2] for r in results]) if results else np.empty(0, dtype=bool)
+
+    meta = dict(coin=coin, exchange=exchange, direction=direction, interval=interval, max_age=max_age)
+
+    return BacktestResult(times, amounts, roi, meta=meta, complete=complete)
+
+
+def _parse_time(value: str) -> float:
+    """YYYY-MM-DD (UTC) or seconds since epoch"""
+    try:
+        return float(value)
+    except ValueError:
+        return float(calendar.timegm(time.strptime(value, '%Y-%m-%d')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help='Recorder directory (BITRADER_RECORD_DIR).')
+    parser.add_argument('--start', type=_parse_time, help='YYYY-MM-DD or seconds since epoch.')
+    parser.add_argument('--end', type=_parse_time, help='YYYY-MM-DD or seconds since epoch.')
+    parser.add_argument('--coin', default='bitcoin')
+    parser.add_argument('--exchange', default='luno')
+    parser.add_argument('--direction', default='forward', choices=['forward', 'reverse'])
+    parser.add_argument('--max-invest', type=float, default=1000000)
+    parser.add_argument('--step', type=float, default=5000)
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between sample times.')
+    parser.add_argument('--max-age', type=float, default=300, help='Maximum snapshot age in seconds.')
+    parser.add_argument('--processes', type=int, help='Worker processes. Default: one per CPU.')
+    parser.add_argument('--out', default='backtest.npz', help='Result file.')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    result = backtest(
+        args.root, start=args.start, end=args.end, coin=args.coin, exchange=args.exchange,
+        direction=args.direction, amounts=np.arange(args.step, args.max_invest, args.step),
+        interval=args.interval, max_age=args.max_age, processes=args.processes)
+
+    result.save(args.out)
+    print(result.summary_text())
+    print(f'{len(result)} sample times in {time.perf_counter() - started:.1f}s, saved to {args.out}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,12 +5,24 @@
 
 import requests
 import logging
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
-import pandas as pd
 import json
 
+from bitrader.order_book import OrderBook
+
 __version__ = "0.1.10"
 
+TOP_LEVELS = 100  # Levels per side returned by orderbook_top
+
+# Luno allows 300 authenticated calls per minute per API key, and answers calls over the limit with a 429
+RATE_LIMIT = 5  # Calls per second
+RATE_BURST = 10  # Calls at once after a quiet period
+MAX_WORKERS = 5  # Concurrent calls of the batch methods
+RETRIES = 2  # Retries of a batch call rejected with a 429
+RETRY_DELAY = 1  # Seconds before the first retry, doubled for each next one
+
 log = logging.getLogger(__name__)
 
 # --------------------------- constants -----------------------
@@ -25,6 +37,74 @@ class BitXAPIError(ValueError):
         return "BitX request %s failed with %d: %s" % (self.url, self.code, self.message)
 
 
+class TokenBucket:
+    """Thread safe token bucket: rate calls per second on average, up to burst at once"""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.waited = 0.  # Seconds spent waiting for tokens, over all threads
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token, or return the seconds until the next one"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            wait = (1 - self.tokens) / self.rate
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        """Wait until a call is allowed"""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class BatchResult:
+    """
+    Per order outcome of a batch call
+    :ivar results: dict of key: response of the orders that succeeded
+    :ivar errors: dict of key: exception of the orders that failed
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+    def __repr__(self):
+        return '<BatchResult: %d succeeded, %d failed>' % (len(self.results), len(self.errors))
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def raise_for_errors(self):
+        """Raise BatchError if any order failed"""
+        if self.errors:
+            raise BatchError(self)
+        return self
+
+
+class BatchError(Exception):
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __str__(self):
+        return "%d of %d orders failed: %s" % (
+            len(self.batch.errors), len(self.batch.errors) + len(self.batch.results),
+            ', '.join('%s (%s)' % (key, error) for key, error in self.batch.errors.items()))
+
+
 class BitX:
     def __init__(self, key, secret, options={}):
         self.options = options
@@ -37,17 +117,23 @@ class BitX:
         self.pair = options['pair'] if 'pair' in options else 'XBTZAR'
         self.ca = options['ca'] if 'ca' in options else None
         self.timeout = options['timeout'] if 'timeout' in options else 30
+        self.stream_url = options['stream_url'] if 'stream_url' in options else 'wss://ws.luno.com/api/1/stream/'
         self.headers = {
             'Accept': 'application/json',
             'Accept-Charset': 'utf-8',
             'User-Agent': 'py-bitx v' + __version__
         }
-        self._executor = ThreadPoolExecutor(max_workers=5)
+        self.session = options['session'] if 'session' in options else requests.Session()
+        # Shared by every authenticated call of this client. Pass rate_limit=None to turn it off.
+        rate_limit = options['rate_limit'] if 'rate_limit' in options else RATE_LIMIT
+        self.rate_limiter = TokenBucket(rate_limit, options.get('burst', RATE_BURST)) if rate_limit else None
+        self._executor = ThreadPoolExecutor(max_workers=options.get('max_workers', MAX_WORKERS))
 
     def close(self):
         log.info('Asking MultiThreadPool to shutdown')
         self._executor.shutdown(wait=True)
         log.info('MultiThreadPool has shutdown')
+        self.session.close()
 
     def construct_url(self, call):
         base = self.hostname
@@ -63,14 +149,7 @@ class BitX:
         :param params: a dict of query parameters
         :return: a json response, a BitXAPIError is thrown if the api returns with an error
         """
-        url = self.construct_url(call)
-        auth = self.auth if kind == 'auth' else None
-        if http_call == 'get':
-            response = requests.get(url, params, headers=self.headers, auth=auth)
-        elif http_call == 'post':
-            response = requests.post(url, data = params, headers=self.headers, auth=auth)
-        else:
-            raise ValueError('Invalid http_call parameter')
+        response = self.raw_request(call, params, kind=kind, http_call=http_call)
         try:
             result = response.json()
         except ValueError:
@@ -80,6 +159,22 @@ class BitX:
         else:
             return result
 
+    def raw_request(self, call, params, kind='auth', http_call='get'):
+        """
+        Same as api_request(), but returns the response without decoding it
+        :return: a requests.Response
+        """
+        url = self.construct_url(call)
+        auth = self.auth if kind == 'auth' else None
+        if auth is not None and self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if http_call == 'get':
+            return self.session.get(url, params=params, headers=self.headers, auth=auth, timeout=self.timeout)
+        elif http_call == 'post':
+            return self.session.post(url, data=params, headers=self.headers, auth=auth, timeout=self.timeout)
+        else:
+            raise ValueError('Invalid http_call parameter')
+
     def get_ticker(self, kind='auth'):
         params = {'pair': self.pair}
         return self.api_request('ticker', params, kind=kind)
@@ -95,7 +190,26 @@ class BitX:
             orders['asks'] = orders['asks'][:limit]
         return orders
 
+    def get_order_book_arrays(self, book_types=('asks', 'bids'), kind='auth', top=False):
+        """
+        Order book as typed arrays, decoded straight from the response body (see api_tools.decode_depth())
+        :param book_types: the sides to decode
+        :param top: only fetch the top TOP_LEVELS levels of each side
+        :return: a dict of book_type: (price, volume) float64 arrays, best price first
+        """
+        from bitrader.api_tools import ExternalAPIException, decode_depth
+
+        response = self.raw_request('orderbook_top' if top else 'orderbook', {'pair': self.pair}, kind=kind)
+        if response.status_code != 200:
+            raise BitXAPIError(response)
+        try:
+            return decode_depth(response.content, 'luno', (), book_types, price_key='price', volume_key='volume')
+        except (ExternalAPIException, ValueError):
+            raise BitXAPIError(response)
+
     def get_order_book_frame(self, limit=None, kind='auth'):
+        import pandas as pd
+
         q = self.get_order_book(limit, kind)
         asks = pd.DataFrame(q['asks'])
         bids = pd.DataFrame(q['bids'])
@@ -103,20 +217,57 @@ class BitX:
         df = pd.DataFrame(pd.concat([asks, bids], axis=1).values, columns=index)
         return df
 
-    def get_trades(self, limit=None, kind='auth'):
+    def stream_order_book(self, start=True, connect=None):
+        """
+        Order book kept up to date from the streaming API instead of polling get_order_book
+        :param start: start streaming in a background thread straight away
+        :param connect: optional callable(url) returning a websocket like connection, e.g. for a local test feed
+        :return: OrderBookStream
+        """
+        stream = OrderBookStream(self.stream_url + self.pair, self.auth, connect=connect)
+        if start:
+            stream.start()
+        return stream
+
+    def get_trades(self, limit=None, kind='auth', since=None):
+        """
+        Most recent trades, or the trades after since
+        :param since: optional timestamp in milliseconds
+        """
         params = {'pair': self.pair}
+        if since is not None:
+            params['since'] = since
         trades = self.api_request('trades', params, kind=kind)
         if limit is not None:
             trades['trades'] = trades['trades'][:limit]
         return trades
 
-    def get_trades_frame(self, limit=None, kind='auth'):
+    def get_trades_frame(self, limit=None, kind='auth', store=None):
+        """
+        :param store: optional trade_history.TradeStore for this pair. Synced from the last stored trade and
+            read from instead of building the frame from a full download.
+        """
+        if store is not None:
+            store.sync(self)
+            df = store.frame()
+            return df if limit is None else df.iloc[-limit:]
+
+        import pandas as pd
+
         trades = self.get_trades(limit, kind)
         df = pd.DataFrame(trades['trades'])
         df.index = pd.to_datetime(df.timestamp * 1e-3, unit='s')
         df.drop('timestamp', axis=1, inplace=True)
         return df
 
+    def trade_store(self, directory):
+        """
+        Local trade history of this pair, see trade_history.TradeStore
+        :param directory: directory the history file is kept in
+        """
+        from bitrader.trade_history import TradeStore
+        return TradeStore(directory, self.pair)
+
     def get_orders(self, state=None, kind='auth'):
         """
         Returns a list of the most recently placed orders. You can specify an optional state='PENDING' parameter to
@@ -140,6 +291,8 @@ class BitX:
         return self.api_request('orders/%s' % (order_id,), None)
 
     def get_orders_frame(self, state=None, kind='auth'):
+        import pandas as pd
+
         q = self.get_orders(state, kind)
         tj = json.dumps(q['orders'])
         df = pd.read_json(tj, convert_dates=['creation_timestamp', 'expiration_timestamp'])
@@ -177,17 +330,75 @@ class BitX:
 
     def stop_all_orders(self):
         """
-        Stops all pending orders, both sell and buy
+        Stops all pending orders, both sell and buy, concurrently (see stop_orders)
         :return: dict of Boolean -- whether request succeeded or not for each order_id that was pending
         """
-        pending = self.get_orders('PENDING')['orders']
-        ids = [order['order_id'] for order in pending]
-        result = {}
-        for order_id in ids:
-            status = self.stop_order(order_id)
-            result[order_id] = status['success']
+        pending = self.get_orders('PENDING')['orders'] or []
+        batch = self.stop_orders([order['order_id'] for order in pending])
+        for order_id, error in batch.errors.items():
+            log.warning('Could not stop order %s: %s', order_id, error)
+        result = {order_id: status['success'] for order_id, status in batch.results.items()}
+        result.update({order_id: False for order_id in batch.errors})
         return result
 
+    def _retry(self, func, *args):
+        """func(*args), retried after a delay while Luno rejects it for going over the rate limit"""
+        for attempt in range(RETRIES + 1):
+            try:
+                return func(*args)
+            except BitXAPIError as e:
+                if e.code != 429 or attempt == RETRIES:
+                    raise
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+
+    def batch(self, func, items):
+        """
+        Call func on every item concurrently on the client's executor, within the rate limit
+        :param func: callable taking an item, e.g. self.stop_order
+        :param items: dict of key: item, or a list of items keyed by position
+        :return: BatchResult with the response or exception per key, after all calls finished
+        """
+        if not isinstance(items, dict):
+            items = dict(enumerate(items))
+        futures = {key: self._executor.submit(self._retry, func, item) for key, item in items.items()}
+
+        results, errors = {}, {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                errors[key] = e
+        return BatchResult(results, errors)
+
+    def stop_orders(self, order_ids):
+        """
+        Stop several orders concurrently
+        :param order_ids: list of order IDs
+        :return: BatchResult of order_id: stop_order response
+        """
+        return self.batch(self.stop_order, {order_id: order_id for order_id in order_ids})
+
+    def create_limit_orders(self, orders):
+        """
+        Create several limit orders concurrently, e.g. a ladder
+        :param orders: list of (order_type, volume, price) tuples, or dicts with those keys
+        :return: BatchResult of position in orders: create_limit_order response
+        """
+        def create(order):
+            if isinstance(order, dict):
+                return self.create_limit_order(order['order_type'], order['volume'], order['price'])
+            return self.create_limit_order(*order)
+
+        return self.batch(create, orders)
+
+    def get_orders_by_id(self, order_ids):
+        """
+        Get several orders concurrently
+        :param order_ids: list of order IDs
+        :return: BatchResult of order_id: get_order response
+        """
+        return self.batch(self.get_order, {order_id: order_id for order_id in order_ids})
+
     def get_funding_address(self, asset):
         """
         Returns the default receive address associated with your account and the amount received via the address. You
@@ -224,6 +435,8 @@ class BitX:
         return self.api_request('accounts/%s/transactions' % (account_id,), params)
 
     def get_transactions_frame(self, account_id, min_row=None, max_row=None):
+        import pandas as pd
+
         tx = self.get_transactions(account_id, min_row, max_row)['transactions']
         df = pd.DataFrame(tx)
         df.index = pd.to_datetime(df.timestamp, unit='ms')
@@ -232,3 +445,274 @@ class BitX:
 
     def get_pending_transactions(self, account_id):
         return self.api_request('accounts/%s/pending' % (account_id,), None)
+
+
+class SequenceGapError(ValueError):
+    def __init__(self, expected, received):
+        self.expected = expected
+        self.received = received
+
+    def __str__(self):
+        return "Expected stream update %d, got %d" % (self.expected, self.received)
+
+
+class OrderBookStream:
+    """
+    Luno order book built from the initial snapshot of the streaming API and kept up to date by applying
+    the sequenced create, delete and trade updates that follow. A sequence gap triggers a resync from a new
+    snapshot.
+
+    book('asks') / book('bids') return a sorted OrderBook. It is only rebuilt after the book has changed and
+    is never modified afterwards, so it can be queried without copying while the stream carries on.
+    """
+
+    def __init__(self, url, auth=(None, None), connect=None, reconnect_delay=1, max_reconnect_delay=60,
+                 record=None):
+        """
+        :param url: stream url, e.g. wss://ws.luno.com/api/1/stream/XBTZAR
+        :param auth: (key, secret) tuple
+        :param connect: optional callable(url) returning a connection with send(), recv() and close(), e.g. a
+            ReplayFeed. Defaults to websocket.create_connection from the websocket-client package.
+        :param record: optional path to append every received message to, one per line, for ReplayFeed.load()
+        """
+        self.url = url
+        self.auth = auth
+        self.connect = connect
+        self.record = record
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.sequence = None
+        self.timestamp = None
+        self.resyncs = 0
+        self._orders = {'asks': {}, 'bids': {}}
+        self._books = {'asks': None, 'bids': None}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        self._connection = None
+        self._thread = None
+
+    def load_snapshot(self, message):
+        """
+        Replace the book with the initial snapshot sent after connecting
+        :param message: dict with sequence, asks and bids
+        """
+        with self._lock:
+            for book_type in ('asks', 'bids'):
+                self._orders[book_type] = {
+                    order['id']: (float(order['price']), float(order['volume'])) for order in message[book_type]}
+                self._books[book_type] = None
+            self.sequence = int(message['sequence'])
+            self.timestamp = message.get('timestamp')
+        self._ready.set()
+
+    def apply(self, message):
+        """
+        Apply one update message to the book
+        :param message: dict with sequence and optional trade_updates, create_update and delete_update
+        :raises SequenceGapError: if the update does not follow on the last one applied
+        """
+        sequence = int(message['sequence'])
+        with self._lock:
+            if sequence <= self.sequence:
+                return
+            if sequence != self.sequence + 1:
+                raise SequenceGapError(self.sequence + 1, sequence)
+
+            for trade in message.get('trade_updates') or []:
+                self._fill(trade['maker_order_id'], float(trade['base']))
+
+            create = message.get('create_update')
+            if create:
+                book_type = 'bids' if create['type'] == 'BID' else 'asks'
+                self._orders[book_type][create['order_id']] = (float(create['price']), float(create['volume']))
+                self._books[book_type] = None
+
+            delete = message.get('delete_update')
+            if delete:
+                self._remove(delete['order_id'])
+
+            self.sequence = sequence
+            self.timestamp = message.get('timestamp')
+
+    def _fill(self, order_id, volume):
+        for book_type, orders in self._orders.items():
+            if order_id in orders:
+                price, remaining = orders[order_id]
+                remaining -= volume
+                if remaining > 1e-12:
+                    orders[order_id] = (price, remaining)
+                else:
+                    del orders[order_id]
+                self._books[book_type] = None
+                return
+
+    def _remove(self, order_id):
+        for book_type, orders in self._orders.items():
+            if orders.pop(order_id, None) is not None:
+                self._books[book_type] = None
+                return
+
+    def book(self, book_type):
+        """
+        Current state of one side of the book
+        :param book_type: 'asks' or 'bids'
+        :return: OrderBook
+        """
+        with self._lock:
+            if self._books[book_type] is None:
+                levels = list(self._orders[book_type].values())
+                self._books[book_type] = OrderBook(
+                    [price for price, volume in levels], [volume for price, volume in levels], book_type)
+            return self._books[book_type]
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until the initial snapshot has been loaded
+        :return: True if ready, False on timeout
+        """
+        return self._ready.wait(timeout)
+
+    def _connect(self):
+        if self.connect is not None:
+            return self.connect(self.url)
+        import websocket
+        return websocket.create_connection(self.url)
+
+    def _consume(self):
+        self._connection = connection = self._connect()
+        record = open(self.record, 'a') if self.record else None
+        try:
+            key, secret = self.auth
+            connection.send(json.dumps({'api_key_id': key, 'api_key_secret': secret}))
+            raw = connection.recv()
+            if record:
+                record.write(raw.strip() + '\n')
+            self.load_snapshot(json.loads(raw))
+            while not self._closed.is_set():
+                raw = connection.recv()
+                if not raw:
+                    continue  # keep alive
+                if record:
+                    record.write(raw.strip() + '\n')
+                message = json.loads(raw)
+                self.apply(message)
+        finally:
+            connection.close()
+            if record:
+                record.close()
+
+    def run(self):
+        """
+        Consume the stream until close() is called, resyncing from a new snapshot after gaps or disconnects
+        """
+        delay = self.reconnect_delay
+        while not self._closed.is_set():
+            try:
+                self._consume()
+                delay = self.reconnect_delay
+            except SequenceGapError as e:
+                log.warning('%s, resyncing order book', e)
+                self.resyncs += 1
+                delay = self.reconnect_delay
+                continue
+            except Exception:
+                if self._closed.is_set():
+                    break
+                log.exception('Order book stream failed, reconnecting in %ds', delay)
+                self.resyncs += 1
+            self._closed.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='luno-order-book-stream', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._closed.set()
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+class ReplayConnection:
+    """
+    Stand-in for a stream connection that sends recorded messages, see ReplayFeed
+    """
+
+    def __init__(self, messages, last=False):
+        """
+        :param messages: list of messages (dicts or JSON strings), the snapshot first
+        :param last: after the last message, block until closed instead of disconnecting
+        """
+        self.messages = [m if isinstance(m, str) else json.dumps(m) for m in messages]
+        self.last = last
+        self.sent = []
+        self._position = 0
+        self._closed = threading.Event()
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv(self):
+        if self._closed.is_set():
+            raise ConnectionError('Replay connection closed')
+        if self._position < len(self.messages):
+            self._position += 1
+            return self.messages[self._position - 1]
+        if self.last:
+            self._closed.wait()
+        raise ConnectionError('End of replayed messages')
+
+    def close(self):
+        self._closed.set()
+
+
+class ReplayFeed:
+    """
+    Local stand-in for the Luno stream that replays recorded messages, e.g. for tests:
+
+        feed = ReplayFeed([snapshot, update, ...], [snapshot, ...])
+        stream = OrderBookStream('replay', connect=feed)
+
+    Each connection replays the next session: a snapshot followed by its updates. The last session stays
+    connected once replayed, earlier ones disconnect like a dropped connection would.
+    """
+
+    def __init__(self, *sessions):
+        """
+        :param sessions: lists of messages (dicts or JSON strings), one per connection
+        """
+        self.sessions = [list(session) for session in sessions]
+        self.connections = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Feed from a file written with OrderBookStream(record=path). Every snapshot starts a new session.
+        """
+        sessions = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if 'asks' in message or not sessions:
+                    sessions.append([])
+                sessions[-1].append(message)
+        return cls(*sessions)
+
+    def __call__(self, url):
+        with self._lock:
+            index = len(self.connections)
+            if index >= len(self.sessions):
+                raise ConnectionError('No more replayed sessions')
+            connection = ReplayConnection(self.sessions[index], last=index == len(self.sessions) - 1)
+            self.connections.append(connection)
+        return connection
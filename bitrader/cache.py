@@ -0,0 +1,160 @@
+""" Cache
+
+In-process cache for market data.
+
+"""
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+
+class TTLCache:
+    """Thread safe LRU cache with a time to live per source
+
+    Keys are tuples whose first item is the source (e.g. ('kraken', 'asks', 'XBT')), which
+    determines the TTL. Concurrent callers asking for the same missing key share a single fetch.
+
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60, ttls: dict = None):
+        """
+
+        Args:
+            maxsize: Maximum number of entries kept. Least recently used entries are evicted first.
+            ttl: Default time to live in seconds.
+            ttls: Optional dict of source: ttl in seconds, overriding the default.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_ttl(self, key) -> float:
+        return self.ttls.get(key[0], self.ttl)
+
+    def get_entry(self, key: tuple, fetch, valid=None):
+        """Get (value, stored_at) for key, calling fetch() if it is missing or expired
+
+        Args:
+            key: Tuple with the source as first item.
+            fetch: Callable without arguments that returns the value.
+            valid: Optional. Callable that returns False for cached values this caller can't use, e.g. an
+                order book fetched with too few levels. Those are fetched again.
+
+        Returns: Tuple of (value, stored_at) with stored_at the time.time() the value was fetched.
+
+        """
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None and (valid is None or valid(entry[0])):
+                self.hits += 1
+                return entry
+
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                self.misses += 1
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+
+        if not owner:
+            entry = future.result()
+            if valid is None or valid(entry[0]):
+                return entry
+            # Shared a fetch that isn't good enough for this caller, fetch again
+            value = fetch()
+            with self._lock:
+                return self._set(key, value)
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            entry = self._set(key, value)
+            del self._pending[key]
+
+        future.set_result(entry)
+
+        return entry
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def _set(self, key, value):
+        entry = (value, time.time())
+        self._entries[key] = entry + (time.monotonic() + self.get_ttl(key),)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def lookup(self, key: tuple):
+        """Get (value, stored_at) for key without fetching, e.g. from an event loop
+
+        Returns: Tuple of (value, stored_at), or None if key is missing or expired.
+
+        """
+        with self._lock:
+            entry = self._get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def peek(self, key: tuple):
+        """Last value stored for key, even if expired, without counting a hit or miss. None if missing."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[0]
+
+    def store(self, key: tuple, value):
+        """Store value for key, e.g. after a lookup() miss"""
+        with self._lock:
+            return self._set(key, value)
+
+    def get(self, key: tuple, fetch):
+        """Get value for key, calling fetch() if it is missing or expired"""
+        return self.get_entry(key, fetch)[0]
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses + self.shared
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            shared=self.shared,
+            evictions=self.evictions,
+            size=len(self._entries),
+            hit_rate=(self.hits + self.shared) / requests if requests else 0.,
+        )
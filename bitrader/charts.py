@@ -0,0 +1,158 @@
+""" Charts
+
+Rendering of the /status ROI chart, with rendered PNGs cached per market snapshot.
+
+"""
+import asyncio
+import hashlib
+import time
+from io import BytesIO
+from threading import Lock
+
+from bitrader import profiling
+from bitrader.cache import TTLCache
+
+_figure = None
+_figure_lock = Lock()
+
+
+def render_png(df, dpi: int = 150) -> bytes:
+    """Plot DataFrame and return the figure as PNG bytes
+
+    Reuses one Agg figure per process instead of creating (and leaking) a pyplot figure per render.
+
+    """
+    global _figure
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    with _figure_lock:
+        if _figure is None:
+            _figure = Figure()
+            FigureCanvasAgg(_figure)
+
+        _figure.clf()
+        df.plot(ax=_figure.add_subplot(111))
+
+        fig_file = BytesIO()
+        _figure.savefig(fig_file, format='png', dpi=dpi)
+
+    return fig_file.getvalue()
+
+
+def roi_chart(books, exchange_rate, **kwargs):
+    """Run optimal() on the given books and render the ROI curve
+
+    Runs in a worker process, so it returns the time taken along with the image.
+
+    Returns: Tuple of (png, seconds)
+
+    """
+    from bitrader.arbitrage_tools import optimal
+
+    started = time.perf_counter()
+    df = optimal(books=books, exchange_rate=exchange_rate, return_format='raw', **kwargs)
+    png = render_png(df)
+
+    return png, time.perf_counter() - started
+
+
+def backtest_chart(path: str):
+    """Summary and best ROI chart of a stored backtest result
+
+    Runs in a worker process.
+
+    Returns: Tuple of (png, summary text)
+
+    """
+    from bitrader.backtest import BacktestResult
+
+    result = BacktestResult.load(path)
+    if not len(result):
+        return None, result.summary_text()
+
+    return render_png(result.to_frame()[['roi']]), result.summary_text()
+
+
+def snapshot_digest(books, exchange_rate, **kwargs) -> str:
+    """Hash of the order books, exchange rate and chart options"""
+    digest = hashlib.sha1()
+    for book in books:
+        digest.update(book.book_type.encode())
+        digest.update(book.price.tobytes())
+        digest.update(book.volume.tobytes())
+    digest.update(str(exchange_rate).encode())
+    digest.update(repr(sorted(kwargs.items())).encode())
+
+    return digest.hexdigest()
+
+
+class ChartService:
+    """Renders /status charts off the event loop and serves repeats for the same snapshot from memory"""
+
+    def __init__(self, maxsize: int = 32, ttl: float = 600):
+        """
+
+        Args:
+            maxsize: Maximum number of PNGs kept.
+            ttl: Seconds a PNG is kept.
+        """
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.renders = 0
+        self.render_seconds = 0.
+        self.last_render_seconds = 0.
+        self.shared = 0
+        self._pending = {}
+
+    async def roi_png(self, run, books, exchange_rate, **kwargs):
+        """PNG of the ROI chart for a snapshot
+
+        Args:
+            run: Coroutine function run(func, *args, cpu=True, **kwargs) that runs func off the event loop
+                and returns its result, or None if it could not be run.
+            books: Tuple of (eur_asks, zar_bids) OrderBooks.
+            exchange_rate: The ZAR / EURO Exchange rate.
+            **kwargs: Passed on to optimal(), e.g. max_invest.
+
+        Returns: PNG bytes, or None if the render could not be run.
+
+        """
+        key = ('roi', snapshot_digest(books, exchange_rate, **kwargs))
+
+        if key in self._pending:
+            self.shared += 1
+            return await asyncio.shield(self._pending[key])
+
+        entry = self.cache.lookup(key)
+        if entry is not None:
+            return entry[0]
+
+        pending = self._pending[key] = asyncio.get_event_loop().create_future()
+        png = None
+        try:
+            result = await run(roi_chart, books, exchange_rate, cpu=True, **kwargs)
+            if result is not None:
+                png, seconds = result
+                self.renders += 1
+                self.render_seconds += seconds
+                self.last_render_seconds = seconds
+                profiling.record('chart', seconds)
+                self.cache.store(key, png)
+        finally:
+            del self._pending[key]
+            pending.set_result(png)
+
+        return png
+
+    def stats(self) -> dict:
+        hits = self.cache.hits + self.shared
+        requests = hits + self.cache.misses
+        return dict(
+            renders=self.renders,
+            last_render_seconds=self.last_render_seconds,
+            mean_render_seconds=self.render_seconds / self.renders if self.renders else 0.,
+            cache_hits=hits,
+            cache_hit_rate=hits / requests if requests else 0.,
+            cached=len(self.cache),
+        )
@@ -0,0 +1,123 @@
+""" Clients
+
+Process wide registry of exchange API clients, so HTTP connections are kept alive and
+reused across calls instead of being set up (and leaked) on every request.
+
+"""
+import atexit
+from logging import getLogger
+from threading import Lock
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+logger = getLogger(__name__)
+
+POOL_SIZE = 10
+
+_clients = {}
+_lock = Lock()
+
+
+def pooled_session(session: Session = None, pool_size: int = POOL_SIZE) -> Session:
+    """Mount keep-alive connection pools big enough for the snapshot thread pool on a session"""
+    session = session or Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_client(name: str, factory, close=None):
+    """Get the client registered as name, creating it with factory() on first use
+
+    Args:
+        name: Registry key, e.g. 'kraken'.
+        factory: Callable without arguments returning a new client.
+        close: Optional callable taking the client, called by close_all().
+
+    """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = (factory(), close)
+        return _clients[name][0]
+
+
+def close_all():
+    """Close all registered clients and their connection pools"""
+    with _lock:
+        clients = list(_clients.items())
+        _clients.clear()
+
+    for name, (client, close) in clients:
+        if close:
+            try:
+                close(client)
+            except Exception:
+                logger.exception(f'Could not close {name} client')
+
+
+atexit.register(close_all)
+
+
+class _LockedKrakenAPI:
+    """krakenex < 2 keeps one persistent HTTPSConnection, which can't be shared between threads"""
+
+    def __init__(self, api):
+        self.api = api
+        self._lock = Lock()
+
+    def query_public(self, *args, **kwargs):
+        with self._lock:
+            return self.api.query_public(*args, **kwargs)
+
+    def query_private(self, *args, **kwargs):
+        with self._lock:
+            return self.api.query_private(*args, **kwargs)
+
+    def close(self):
+        self.api.conn.close()
+
+
+def kraken(key: str = None, secret: str = None):
+    """Shared krakenex API client"""
+
+    def factory():
+        import krakenex
+
+        if hasattr(krakenex, 'Connection'):
+            return _LockedKrakenAPI(krakenex.API(key=key, secret=secret, conn=krakenex.Connection()))
+
+        api = krakenex.API(key=key, secret=secret)
+        pooled_session(api.session)
+        return api
+
+    return get_client('kraken', factory, close=lambda api: api.close())
+
+
+def bitx(key: str = None, secret: str = None):
+    """Shared Luno (BitX) client"""
+
+    def factory():
+        from bitrader.bitx import BitX
+        return BitX(key, secret, {'session': pooled_session()})
+
+    return get_client('luno', factory, close=lambda api: api.close())
+
+
+def fnb():
+    """Shared session for the FNB forex rates page"""
+    return get_client('fnb', pooled_session, close=lambda session: session.close())
+
+
+def ice3x():
+    """Shared Ice3x client"""
+
+    def factory():
+        from bitrader.api_tools import Ice3xAPI
+
+        api = Ice3xAPI(cache=False, future=False)
+        pooled_session(api.session)
+        return api
+
+    return get_client('ice3x', factory, close=lambda api: api.session.close())
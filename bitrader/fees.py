@@ -0,0 +1,159 @@
+""" Fees
+
+Declarative fee schedule for the banks and exchanges in the arbitrage routes.
+
+FEES lists each fee once as Fixed, Percentage or Tiered, in the currency it is charged in. Fee objects work
+on Decimals (for arbitrage()) and on floats or whole NumPy arrays (for the sweeps) with the same logic, so
+changing a rate or adding a tier only means editing FEES.
+
+Tiered rates are picked by the venue's trading volume over the exchange's tier period, set with
+e.g. schedule.volumes['kraken'] = 60000. Without a volume, the first tier applies.
+
+"""
+import bisect
+from decimal import Decimal
+
+import numpy as np
+
+
+class Fixed:
+    """Fixed fee per transaction"""
+
+    def __init__(self, amount):
+        self.amount = amount
+
+    def __repr__(self):
+        return f'Fixed({self.amount})'
+
+    def __call__(self, amounts, volume: float = 0):
+        """Fee for amounts: a Decimal for a Decimal amount, a float otherwise (broadcasts over arrays)"""
+        if isinstance(amounts, Decimal):
+            return Decimal(str(self.amount))
+        return float(self.amount)
+
+
+class Percentage:
+    """Percentage of the amount, optionally clamped to [minimum, maximum]"""
+
+    def __init__(self, rate: float, minimum: float = None, maximum: float = None):
+        """
+
+        Args:
+            rate: Fraction of the amount, e.g. 0.0055 for 0.55%.
+            minimum: Optional. Smallest fee charged.
+            maximum: Optional. Largest fee charged.
+        """
+        self.rate = rate
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.rate}, minimum={self.minimum}, maximum={self.maximum})'
+
+    def rate_for(self, volume: float = 0) -> float:
+        return self.rate
+
+    def __call__(self, amounts, volume: float = 0):
+        """Fee for amounts: a Decimal for a Decimal amount, a float or array otherwise"""
+        rate = self.rate_for(volume)
+
+        if isinstance(amounts, Decimal):
+            charged = amounts * Decimal(str(rate))
+            if self.minimum is not None:
+                charged = max(charged, Decimal(str(self.minimum)))
+            if self.maximum is not None:
+                charged = min(charged, Decimal(str(self.maximum)))
+            return charged
+
+        charged = np.asarray(amounts, dtype=float) * rate
+        if self.minimum is not None or self.maximum is not None:
+            charged = np.clip(charged, self.minimum, self.maximum)
+        return charged
+
+    def breakpoints(self, volume: float = 0):
+        """Amounts where the clamp starts or stops applying"""
+        rate = self.rate_for(volume)
+        return np.array([limit / rate for limit in (self.minimum, self.maximum) if limit is not None and rate])
+
+
+class Tiered(Percentage):
+    """Percentage with a lower rate for higher trading volumes"""
+
+    def __init__(self, tiers: list, minimum: float = None, maximum: float = None):
+        """
+
+        Args:
+            tiers: List of (volume, rate): rate applies from volume on. Sorted by volume, starting at 0.
+            minimum: Optional. Smallest fee charged.
+            maximum: Optional. Largest fee charged.
+        """
+        super().__init__(tiers[0][1], minimum=minimum, maximum=maximum)
+        self.tiers = sorted(tiers)
+        self._volumes = [volume for volume, rate in self.tiers]
+
+    def __repr__(self):
+        return f'Tiered({self.tiers}, minimum={self.minimum}, maximum={self.maximum})'
+
+    def rate_for(self, volume: float = 0) -> float:
+        return self.tiers[max(bisect.bisect_right(self._volumes, volume) - 1, 0)][1]
+
+
+# Fees per venue, in the currency they are charged in (ZAR for fnb, EUR or coin for kraken, coin or ZAR for
+# the ZAR exchanges). Fees: https://www.kraken.com/en-us/help/faq
+FEES = {
+    'fnb': {
+        'swift': Fixed(110),  # ZAR
+        'commission': Percentage(0.0055, minimum=140, maximum=650),  # ZAR
+    },
+    'kraken': {
+        'deposit': Fixed(15),  # EUR, SEPA
+        'trade': Tiered([(0, 0.0026), (50000, 0.0024)]),  # 30 day volume in USD
+        'withdrawal': Fixed(0.001),  # Coin
+        'eur_withdrawal': Fixed(0.09),  # EUR, SEPA. For reverse routes, which bring the Euros home.
+    },
+    'luno': {
+        'deposit': Fixed(0.0002),  # Coin
+        'trade': Tiered([(0, 0.01), (10, 0.0075)]),  # 30 day volume in BTC
+        'withdrawal': Fixed(8.5),  # ZAR
+    },
+    'ice3x': {  # TODO: Check Ice3x fees, same as Luno for now
+        'deposit': Fixed(0.0002),
+        'trade': Tiered([(0, 0.01), (10, 0.0075)]),
+        'withdrawal': Fixed(8.5),
+    },
+}
+
+
+class FeeSchedule:
+    """FEES (or another table like it) with the trading volume per venue used for tiered rates"""
+
+    def __init__(self, table: dict = None, volumes: dict = None):
+        self.table = FEES if table is None else table
+        self.volumes = dict(volumes or {})
+
+    def spec(self, venue: str, name: str):
+        """Fee object for a venue's fee, e.g. spec('kraken', 'trade')"""
+        venue_fees = self.table.get(venue.lower())
+        if venue_fees is None or name not in venue_fees:
+            raise KeyError(f'{venue} has no {name} fee')
+        return venue_fees[name]
+
+    def __call__(self, venue: str, name: str, amounts=0):
+        """Fee charged on amounts, as Decimal, float or array like amounts"""
+        return self.spec(venue, name)(amounts, volume=self.volumes.get(venue.lower(), 0))
+
+    def rate(self, venue: str, name: str) -> float:
+        """Current rate of a percentage fee"""
+        return self.spec(venue, name).rate_for(self.volumes.get(venue.lower(), 0))
+
+    def amount(self, venue: str, name: str) -> float:
+        """Amount of a fixed fee"""
+        return float(self.spec(venue, name).amount)
+
+    def breakpoints(self, venue: str, name: str):
+        """Amounts where a clamped percentage fee starts or stops being clamped"""
+        return self.spec(venue, name).breakpoints(self.volumes.get(venue.lower(), 0))
+
+
+# Used by arbitrage(), the sweeps and the fixed point engine
+schedule = FeeSchedule()
@@ -0,0 +1,224 @@
+""" Fixed point
+
+Arbitrage simulation in scaled integers: satoshis for coins, cents for fiat amounts and fees, and
+10,000ths of a cent for cumulative order book value. Results don't depend on the global Decimal context
+and whole sweeps run as int64 NumPy operations.
+
+Rounding is explicit and configurable per venue in ROUNDING. By default every fee is rounded up and
+every conversion rounded down, i.e. in favour of the exchange or bank.
+
+"""
+import numpy as np
+
+from bitrader.fees import schedule as fee_schedule
+
+SATOSHI = 10 ** 8  # Coin units per coin
+CENTS = 100  # Fiat units per Rand or Euro
+VALUE_SCALE = 10 ** 4  # Order book value units per cent
+RATE_SCALE = 10 ** 4  # Exchange rate units per Rand / Euro
+PPM = 10 ** 6  # Fee rates are in parts per million
+
+# Rounding per venue for fees charged and conversions done there
+ROUNDING = {
+    'fnb': {'fee': 'up', 'convert': 'down'},
+    'kraken': {'fee': 'up', 'convert': 'down'},
+    'luno': {'fee': 'up', 'convert': 'down'},
+    'ice3x': {'fee': 'up', 'convert': 'down'},
+}
+
+
+def muldiv(a, b, c, rounding: str = 'down'):
+    """a * b / c for int64 arrays, rounded down, up or half_even, without overflowing on a * b
+
+    Safe as long as (c - 1) * b and (a // c) * b fit in an int64.
+
+    """
+    a = np.asarray(a, dtype=np.int64)
+    q, r = np.divmod(a, c)
+    q = q * b
+    q2, r2 = np.divmod(r * b, c)
+    result = q + q2
+
+    if rounding == 'down':
+        return result
+    elif rounding == 'up':
+        return result + (r2 > 0)
+    elif rounding == 'half_even':
+        twice = 2 * r2
+        return result + ((twice > c) | ((twice == c) & (result % 2 == 1)))
+    else:
+        raise KeyError(f'{rounding} is not a valid rounding')
+
+
+class FixedPointBook:
+    """Order book with integer price (cents), volume (satoshi) and cumulative value columns"""
+    __slots__ = ('book_type', 'price', 'volume', 'cumulative_volume', 'cumulative_value')
+
+    def __init__(self, order_book):
+        """
+
+        Args:
+            order_book: OrderBook, already sorted from best to worst price.
+        """
+        self.book_type = order_book.book_type
+        self.price = np.rint(order_book.price * CENTS).astype(np.int64)
+        self.volume = np.rint(order_book.volume * SATOSHI).astype(np.int64)
+        self.cumulative_volume = np.cumsum(self.volume)
+        # price [cents] * volume [satoshi] / SATOSHI * VALUE_SCALE, kept exact up to 1 / VALUE_SCALE cent per level
+        self.cumulative_value = np.cumsum(muldiv(self.volume, self.price, SATOSHI // VALUE_SCALE))
+
+    def __len__(self):
+        return len(self.price)
+
+    def fill(self, limits, order_type: str, rounding: str = 'down'):
+        """Convert cents to satoshi (buy) or satoshi to cents (sell)
+
+        Args:
+            limits: int64 array of cents (buy) or satoshi (sell).
+            order_type: buy or sell
+            rounding: Rounding of the converted amount.
+
+        Returns: Tuple of (result, exhausted) int64 and bool arrays. result is 0 where exhausted.
+
+        """
+        limits = np.asarray(limits, dtype=np.int64)
+
+        if order_type == 'buy':
+            cumulative_from, cumulative_to = self.cumulative_value, self.cumulative_volume
+            limits = limits * VALUE_SCALE
+        elif order_type == 'sell':
+            cumulative_from, cumulative_to = self.cumulative_volume, self.cumulative_value
+        else:
+            raise KeyError(f'{order_type} is not a valid order_type')
+
+        if not len(self):
+            return np.zeros(limits.shape, dtype=np.int64), np.ones(limits.shape, dtype=bool)
+
+        rows = np.searchsorted(cumulative_from, limits, side='left')
+        exhausted = rows >= len(self)
+        rows = np.minimum(rows, len(self) - 1)
+
+        over = cumulative_from[rows] - limits
+        # Rounding the part that is taken off in the opposite direction rounds the result as asked
+        over_rounding = {'down': 'up', 'up': 'down'}.get(rounding, rounding)
+
+        if order_type == 'buy':
+            # value units -> satoshi
+            result = cumulative_to[rows] - muldiv(over, SATOSHI // VALUE_SCALE, self.price[rows], over_rounding)
+        else:
+            # satoshi -> value units -> cents
+            result = cumulative_to[rows] - muldiv(over, self.price[rows], SATOSHI // VALUE_SCALE, over_rounding)
+            result = muldiv(result, 1, VALUE_SCALE, rounding)
+
+        return np.where(exhausted, 0, result), exhausted
+
+
+def fee(amounts, rate_ppm: int, venue: str, minimum: int = None, maximum: int = None):
+    """Percentage fee in the units of amounts, clamped to [minimum, maximum]"""
+    charged = muldiv(amounts, rate_ppm, PPM, ROUNDING[venue]['fee'])
+    if minimum is not None or maximum is not None:
+        charged = np.clip(charged, minimum, maximum)
+    return charged
+
+
+def rate_ppm(venue: str, name: str) -> int:
+    """Current rate of a percentage fee in fees.schedule, in PPM"""
+    return int(round(fee_schedule.rate(venue, name) * PPM))
+
+
+def fee_units(venue: str, name: str, scale: int) -> int:
+    """Amount of a fixed fee in fees.schedule, in cents (scale=CENTS) or satoshi (scale=SATOSHI)"""
+    return int(round(fee_schedule.amount(venue, name) * scale))
+
+
+def to_cents(value) -> int:
+    """Fiat amount (e.g. Decimal or str) to cents, without going through float"""
+    from decimal import Decimal, ROUND_HALF_EVEN, localcontext
+
+    with localcontext() as context:
+        context.prec = 28
+        return int((Decimal(value) * CENTS).to_integral_value(ROUND_HALF_EVEN))
+
+
+def to_rate(exchange_rate) -> int:
+    """ZAR / EUR exchange rate to RATE_SCALE units"""
+    from decimal import Decimal, ROUND_HALF_EVEN, localcontext
+
+    with localcontext() as context:
+        context.prec = 28
+        return int((Decimal(str(exchange_rate)) * RATE_SCALE).to_integral_value(ROUND_HALF_EVEN))
+
+
+def simulate(amounts, books, exchange_rate, transfer_fees: bool = True, trade_fees: bool = True,
+             exchange_name: str = 'Luno') -> dict:
+    """Simulate ZAR -> EUR -> coin -> ZAR arbitrage for an array of amounts in cents
+
+    Same fees as arbitrage_tools.arbitrage().
+
+    Args:
+        amounts: int64 array of amounts in ZAR cents.
+        books: Tuple of (eur_asks, zar_bids) as FixedPointBooks.
+        exchange_rate: The ZAR / EURO Exchange rate, as Decimal or in RATE_SCALE units (see to_rate()).
+        transfer_fees: Whether to include FOREX fees or not.
+        trade_fees: Whether to include the ZAR exchange trade fee or not.
+        exchange_name: ZAR exchange, for its rounding rules.
+
+    Returns: Dict of int64 arrays: capital, euros, coins, rands, return_value, profit (cents or satoshi)
+        and the bool array exhausted.
+
+    """
+    eur_asks, zar_bids = books
+    zar_venue = exchange_name.lower()
+
+    if not isinstance(exchange_rate, (int, np.integer)):
+        exchange_rate = to_rate(exchange_rate)
+
+    transfer_amount = np.asarray(amounts, dtype=np.int64)
+
+    if transfer_fees:
+        commission = fee_schedule.spec('fnb', 'commission')
+        _swift_fee = fee_units('fnb', 'swift', CENTS)
+        _fnb_comission = fee(
+            transfer_amount, rate_ppm('fnb', 'commission'), 'fnb',
+            minimum=None if commission.minimum is None else int(round(commission.minimum * CENTS)),
+            maximum=None if commission.maximum is None else int(round(commission.maximum * CENTS)))
+        _kraken_deposit_fee = fee_units('kraken', 'deposit', CENTS)
+        _luno_withdrawel_fee = fee_units(zar_venue, 'withdrawal', CENTS)
+    else:
+        _swift_fee = _fnb_comission = _kraken_deposit_fee = _luno_withdrawel_fee = 0
+
+    capital = transfer_amount + _fnb_comission + _swift_fee
+
+    euros = muldiv(transfer_amount, RATE_SCALE, exchange_rate, ROUNDING['fnb']['convert']) - _kraken_deposit_fee
+    _kraken_fee = fee(euros, rate_ppm('kraken', 'trade'), 'kraken')
+
+    _kraken_withdrawal_fee = fee_units('kraken', 'withdrawal', SATOSHI)
+    _luno_deposit_fee = fee_units(zar_venue, 'deposit', SATOSHI)
+
+    coins, buy_exhausted = eur_asks.fill(euros - _kraken_fee, 'buy', ROUNDING['kraken']['convert'])
+    coins = coins - _kraken_withdrawal_fee - _luno_deposit_fee
+
+    if trade_fees:
+        _luno_fees = fee(coins, rate_ppm(zar_venue, 'trade'), zar_venue)
+    else:
+        _luno_fees = 0
+
+    rands, sell_exhausted = zar_bids.fill(coins - _luno_fees, 'sell', ROUNDING[zar_venue]['convert'])
+
+    return_value = rands - _luno_withdrawel_fee
+
+    return dict(
+        capital=capital,
+        euros=euros,
+        coins=coins,
+        rands=rands,
+        return_value=return_value,
+        profit=return_value - capital,
+        exhausted=buy_exhausted | sell_exhausted,
+    )
+
+
+def roi(result: dict):
+    """ROI in % from simulate() results, NaN where exhausted"""
+    value = result['profit'] / result['capital'] * 100
+    return np.where(result['exhausted'], np.nan, value)
@@ -0,0 +1,273 @@
+""" Forex
+
+FNB forex quotes without pandas: the rates page is streamed through a small HTMLParser that only keeps the
+rates table, and stops reading once the table has been parsed.
+
+ForexQuoteProvider keeps every currency's quotes from one fetch and refreshes them on a schedule, from a
+background thread once started. Simulations read the cached quote and its age instead of waiting on a
+scrape, and only fetch synchronously if there is no quote yet or it is too old.
+
+"""
+import codecs
+import logging
+import threading
+import time
+from decimal import Decimal
+from html.parser import HTMLParser
+
+from bitrader import profiling
+
+log = logging.getLogger(__name__)
+
+FNB_FOREX_URL = 'https://www.fnb.co.za/Controller?nav=rates.forex.list.ForexRatesList'
+
+# Column of each order type: the bank sells foreign currency when I buy it
+FNB_COLUMNS = {
+    'buy': 'Bank Selling Rate',
+    'sell': 'Bank Buying Rate',
+}
+
+REFRESH_INTERVAL = 300  # Seconds between background refreshes
+CHUNK_SIZE = 16 * 1024
+
+
+def to_rate(text: str) -> Decimal:
+    """Rate as shown on the page to a Decimal with 4 decimals, like the quotes have always been"""
+    return Decimal('%.4f' % float(text.replace(',', '').strip()))
+
+
+class FNBRatesParser(HTMLParser):
+    """Streaming parser for the FNB forex rates table
+
+    Feed it the page in chunks. quotes fills up with currency_code: dict(buy=Decimal, sell=Decimal) for
+    every row of the first table with the FNB_COLUMNS headers, and done is set at the end of that table.
+
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.quotes = {}
+        self.done = False
+
+        self._columns = None  # Header: column index
+        self._depth = 0  # Table nesting inside the rates table
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table' and self._columns is not None:
+            self._depth += 1
+        elif tag == 'tr':
+            self._row = []
+        elif tag in ('td', 'th') and self._row is not None:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag in ('td', 'th') and self._cell is not None:
+            self._row.append(''.join(self._cell).strip())
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            self._end_row(self._row)
+            self._row = None
+        elif tag == 'table' and self._columns is not None:
+            if self._depth:
+                self._depth -= 1
+            elif self.quotes:
+                self.done = True
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def _end_row(self, row):
+        if self._columns is None:
+            if all(header in row for header in FNB_COLUMNS.values()):
+                self._columns = {header: i for i, header in enumerate(row)}
+            return
+
+        # The currency code is the second column, or the one headed Code
+        code_column = self._columns.get('Code', 1)
+        try:
+            code = row[code_column]
+            quote = {order_type: to_rate(row[self._columns[header]]) for order_type, header in FNB_COLUMNS.items()}
+        except (IndexError, ValueError):
+            return
+
+        self.quotes[code] = quote
+
+
+def parse_fnb_rates(chunks) -> dict:
+    """Quotes of every currency on the FNB rates page
+
+    Args:
+        chunks: The page as a string, or an iterable of string chunks. Reading stops after the rates table.
+
+    Returns: Dict of currency_code: dict(buy=Decimal, sell=Decimal)
+
+    """
+    parser = FNBRatesParser()
+    for chunk in [chunks] if isinstance(chunks, str) else chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    return parser.quotes
+
+
+def read_chunks(file, encoding: str = 'utf-8'):
+    """String chunks of a text or binary file, for parse_fnb_rates()"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    while True:
+        data = file.read(CHUNK_SIZE)
+        text = data if isinstance(data, str) else decoder.decode(data, final=not data)
+        if text:
+            yield text
+        if not data:
+            return
+
+
+def fetch_fnb_rates(session=None, url: str = FNB_FOREX_URL, timeout: float = 20) -> dict:
+    """Download and parse the FNB rates page, see parse_fnb_rates()
+
+    Args:
+        session: Optional. requests Session. Default: the shared one from clients.fnb().
+        url: The rates page.
+        timeout: Seconds to wait for FNB.
+
+    """
+    if session is None:
+        from bitrader import clients
+        session = clients.fnb()
+
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+        quotes = parse_fnb_rates(response.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=True))
+
+    if not quotes:
+        raise ValueError(f'No forex rates found on {url}')
+
+    return quotes
+
+
+class ForexQuoteProvider:
+    """Cached quotes of all currencies, refreshed on a schedule"""
+
+    def __init__(self, fetch=None, interval: float = REFRESH_INTERVAL, max_age: float = None):
+        """
+
+        Args:
+            fetch: Callable without arguments returning quotes like parse_fnb_rates(). Default: fetch_fnb_rates.
+            interval: Seconds between refreshes.
+            max_age: Seconds after which quote() fetches synchronously while the background refresh is
+                running, e.g. when FNB is down. Default: 2 * interval. Without the background refresh,
+                quotes older than interval are fetched synchronously.
+        """
+        self.fetch = fetch or fetch_fnb_rates
+        self.interval = interval
+        self.max_age = 2 * interval if max_age is None else max_age
+
+        self.quotes = {}
+        self.fetched_at = None
+        self.fetches = 0
+        self.errors = 0
+        self.fetch_seconds = 0.
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f'<ForexQuoteProvider: {len(self.quotes)} currencies, {self.age:.0f}s old>'
+
+    @property
+    def age(self) -> float:
+        """Seconds since the quotes were fetched, inf if never"""
+        return float('inf') if self.fetched_at is None else time.time() - self.fetched_at
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def refresh(self, older_than: float = 0.):
+        """Fetch all quotes, unless another thread just did
+
+        Args:
+            older_than: Only fetch if the quotes are older than this many seconds once the lock is held.
+
+        """
+        with self._lock:
+            if self.age <= older_than:
+                return
+            started = time.perf_counter()
+            try:
+                quotes = self.fetch()
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                seconds = time.perf_counter() - started
+                profiling.record('fetch.fnb', seconds)
+            self.fetch_seconds = seconds
+            self.fetches += 1
+            self.quotes, self.fetched_at = quotes, time.time()
+
+    def entry(self, currency_code: str = 'EUR', order_type: str = 'buy'):
+        """Quote and the time it was fetched, fetching first if there is no quote or it is too old
+
+        Returns: Tuple of (rate, fetched_at)
+
+        """
+        max_age = self.max_age if self.running else self.interval
+        if self.age > max_age:
+            self.refresh(older_than=max_age)
+
+        try:
+            return self.quotes[currency_code][order_type], self.fetched_at
+        except KeyError:
+            raise KeyError(f'No {order_type} quote for {currency_code}')
+
+    def quote(self, currency_code: str = 'EUR', order_type: str = 'buy'):
+        """Tuple of (rate, age in seconds), see entry()"""
+        rate, fetched_at = self.entry(currency_code, order_type)
+        return rate, time.time() - fetched_at
+
+    def peek(self, currency_code: str = 'EUR', order_type: str = 'buy'):
+        """Cached rate however old it is, or None. Never fetches."""
+        return self.quotes.get(currency_code, {}).get(order_type)
+
+    def start(self):
+        """Refresh every interval seconds from a daemon thread"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='forex', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh(older_than=self.interval / 2)
+            except Exception as e:
+                log.warning('Could not refresh forex quotes: %s', e)
+            self._stop.wait(self.interval)
+
+    def stats(self) -> dict:
+        return dict(
+            currencies=len(self.quotes),
+            age=self.age,
+            fetches=self.fetches,
+            errors=self.errors,
+            fetch_seconds=self.fetch_seconds,
+            running=self.running,
+        )
+
+
+# Shared FNB quotes, started by the bot. Simulations without it fetch on demand.
+fnb = ForexQuoteProvider()
@@ -0,0 +1,83 @@
+""" Jobs
+
+Run blocking and CPU heavy work for the bot off the asyncio event loop.
+
+Blocking I/O (order book fetches, forex scrapes) runs on a thread pool, CPU bound work (ROI sweeps,
+chart renders) on a process pool. Functions sent to the process pool have to be importable from a
+module other than bitrader.main, so they can be pickled. Workers are started from a fork server (or spawned)
+instead of forked from the bot, whose threads could be holding locks at the time of the fork.
+
+"""
+import asyncio
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from bitrader import profiling
+
+
+class BusyError(Exception):
+    """Raised when a chat already has the maximum number of jobs queued"""
+    pass
+
+
+class JobRunner:
+    """Runs bot jobs on thread and process pools, with a timeout per job and a limit per chat"""
+
+    def __init__(self, max_threads: int = 8, max_processes: int = 2, timeout: float = 120,
+                 max_jobs_per_chat: int = 2, loop=None, start_method: str = None):
+        """
+
+        Args:
+            max_threads: Thread pool size for blocking I/O.
+            max_processes: Process pool size for CPU bound work.
+            timeout: Default seconds to wait for a job.
+            max_jobs_per_chat: Maximum number of jobs queued or running per chat.
+            loop: Event loop. Defaults to asyncio.get_event_loop().
+            start_method: multiprocessing start method of the process pool. Default: forkserver where
+                available, spawn otherwise. Never fork: the bot runs several threads by the first job.
+        """
+        self.timeout = timeout
+        self.max_jobs_per_chat = max_jobs_per_chat
+        self.loop = loop or asyncio.get_event_loop()
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_threads)
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.process_pool = ProcessPoolExecutor(
+            max_workers=max_processes, mp_context=multiprocessing.get_context(start_method))
+        self.jobs = Counter()
+
+    async def run(self, chat_id, func, *args, cpu: bool = False, timeout: float = None, **kwargs):
+        """Run func(*args, **kwargs) in a pool and wait for the result
+
+        Args:
+            chat_id: Chat the job is for.
+            func: Function to run. Has to be picklable if cpu is True.
+            cpu: Default = False. Run on the process pool instead of the thread pool.
+            timeout: Seconds to wait. Default = self.timeout.
+
+        Raises:
+            BusyError: If the chat already has max_jobs_per_chat jobs.
+            asyncio.TimeoutError: If the job took longer than timeout.
+
+        """
+        if self.jobs[chat_id] >= self.max_jobs_per_chat:
+            raise BusyError(f'Chat {chat_id} already has {self.jobs[chat_id]} jobs')
+
+        self.jobs[chat_id] += 1
+        try:
+            job = partial(func, *args, **kwargs)
+            if cpu:
+                future = self.loop.run_in_executor(self.process_pool, job)
+            else:
+                future = self.loop.run_in_executor(self.thread_pool, profiling.in_context(job))
+            return await asyncio.wait_for(future, timeout=timeout or self.timeout)
+        finally:
+            self.jobs[chat_id] -= 1
+            if not self.jobs[chat_id]:
+                del self.jobs[chat_id]
+
+    def close(self):
+        self.thread_pool.shutdown(wait=False)
+        self.process_pool.shutdown(wait=False)
@@ -1,17 +1,17 @@
 import asyncio
+import decimal
 import os
 from decimal import getcontext
+from functools import partial
 from io import BytesIO
 
-import telepot
-import telepot.aio
-from dotenv import load_dotenv
-from telepot.aio.loop import MessageLoop
-from telepot.namedtuple import (
-    KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove,
+from bitrader import forex, profiling
+from bitrader.arbitrage_tools import (
+    COIN_MAP, arbitrage, get_snapshot, market_data_cache, scan_routes, scan_summary, set_recorder,
 )
-
-from bitrader.arbitrage_tools import COIN_MAP, arbitrage, optimal
+from bitrader.charts import ChartService, backtest_chart
+from bitrader.jobs import BusyError, JobRunner
+from bitrader.monitor import OpportunityMonitor
 
 """
 Main loop for Bitcoin arbitrage.
@@ -20,9 +20,43 @@ Main loop for Bitcoin arbitrage.
 coin_type = 'bitcoin'
 zar_exchange = 'luno'
 
+COMMANDS = ('/help', '/status', '/arbitrage', '/scan', '/backtest', '/watch', '/unwatch', '/stats')
+
+bot = None
+jobs = None
+monitor = None
+charts = ChartService()
+
+
+async def run_job(chat_id, func, *args, **kwargs):
+    """Run a blocking or CPU heavy job without holding up other chats
+
+    Returns: The job's result, or None if the chat was told the job could not be run.
+    """
+    try:
+        return await jobs.run(chat_id, func, *args, **kwargs)
+    except BusyError:
+        await bot.sendMessage(chat_id, 'Still working on your previous request, please wait a bit.')
+    except asyncio.TimeoutError:
+        await bot.sendMessage(chat_id, 'Sorry, that took too long. The exchanges might be slow, try again later.')
+
 
 async def on_chat_message(msg):
-    content_type, chat_type, chat_id = telepot.glance(msg)
+    """Handle message under its own trace ID, timed per command"""
+    command = msg.get('text', '').lower().split(' ')[0]
+    stage = f'request.{command[1:]}' if command in COMMANDS else 'request.message'
+
+    with profiling.trace(stage):
+        await handle_chat_message(msg)
+
+    profiling.write_metrics()
+
+
+async def handle_chat_message(msg):
+    from telepot import glance
+    from telepot.namedtuple import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+    content_type, chat_type, chat_id = glance(msg)
     print('Chat:', content_type, chat_type, chat_id)
 
     if content_type != 'text':
@@ -38,18 +72,78 @@ async def on_chat_message(msg):
 
     if command == '/help':
         await bot.sendMessage(
-            chat_id, 'Type /status or /arbitrage to get an overview graph or simulate a specific coin')
+            chat_id, 'Type /status or /arbitrage to get an overview graph or simulate a specific coin, '
+                     '/scan to rank all routes, or /watch 2.5 to get an alert when a route makes 2.5%')
+
+    elif command.startswith('/watch'):
+        try:
+            threshold = float(command[len('/watch'):] or os.environ.get('BITRADER_ALERT_THRESHOLD', 3))
+        except ValueError:
+            await bot.sendMessage(chat_id, 'Give the ROI to alert at in %, e.g. /watch 2.5')
+            return
+        monitor.subscribe(chat_id, threshold)
+        await bot.sendMessage(chat_id, f'Watching all routes for an ROI of {threshold:.2f}%. /unwatch to stop.')
+
+    elif command == '/unwatch':
+        if monitor.unsubscribe(chat_id):
+            await bot.sendMessage(chat_id, 'Stopped watching.')
+        else:
+            await bot.sendMessage(chat_id, 'You are not watching any routes.')
+
+    elif command == '/scan':
+        df = await run_job(chat_id, scan_routes)
+        if df is None:
+            return
+        await bot.sendMessage(chat_id, scan_summary(df))
+
+    elif command == '/backtest':
+        path = os.environ.get('BITRADER_BACKTEST_FILE', 'backtest.npz')
+        if not os.path.exists(path):
+            await bot.sendMessage(chat_id, 'No backtest results yet. Run python -m bitrader.backtest first.')
+            return
+
+        result = await run_job(chat_id, backtest_chart, path, cpu=True)
+        if result is None:
+            return
+        png, summary = result
+
+        if png is not None:
+            await bot.sendPhoto(chat_id, BytesIO(png))
+        await bot.sendMessage(chat_id, summary)
+
+    elif command == '/stats':
+        from bitrader.api_tools import depth_summary
+
+        cache_stats = market_data_cache.stats()
+        chart_stats = charts.stats()
+        message = '\n'.join([
+            profiling.summary(),
+            '--------------------',
+            f'Market data cache: {cache_stats["hit_rate"] * 100:.0f}% hits, {cache_stats["size"]} entries',
+            f'Chart cache: {chart_stats["cache_hit_rate"] * 100:.0f}% hits, '
+            f'{chart_stats["mean_render_seconds"]:.2f}s per render',
+            f'Monitor: {monitor.stats()["subscriptions"]} watching, {monitor.stats()["rounds"]} rounds, '
+            f'next in {monitor.stats()["interval"]:.0f}s',
+            f'FNB quotes: {forex.fnb.stats()["currencies"]} currencies, {forex.fnb.age:.0f}s old',
+            depth_summary(),
+        ])
+        await bot.sendMessage(chat_id, message)
 
     elif command == '/status':
         print('Creating optimal graph:')
-        xbt = optimal(coin='bitcoin', exchange='luno', max_invest=5_000_000, return_format='raw', exchange_rate=None)
-        ax = xbt.plot()
-        fig_file = BytesIO()
-        fig = ax.get_figure()
-        fig.savefig(fig_file, format='png', dpi=150)
-        fig_file.seek(0)  # rewind to beginning of file
+        coin_data = COIN_MAP['luno']['bitcoin']
+        snapshot = await run_job(
+            chat_id, get_snapshot, coin_code=coin_data['coin_code'], exchange_name=coin_data['exchange_name'])
+        if snapshot is None:
+            return
+
+        png = await charts.roi_png(
+            partial(run_job, chat_id), (snapshot['eur_asks'], snapshot['zar_bids']), snapshot['exchange_rate'],
+            coin='bitcoin', exchange='luno', max_invest=5_000_000)
+        if png is None:
+            return
 
-        await bot.sendPhoto(chat_id, fig_file)
+        await bot.sendPhoto(chat_id, BytesIO(png))
 
     elif command == '/arbitrage':
         markup = ReplyKeyboardMarkup(keyboard=[
@@ -90,7 +184,10 @@ async def on_chat_message(msg):
     elif amount > 0:
         await bot.sendMessage(chat_id, f'Simulating {amount} ZAR for {coin_type} using {zar_exchange}...')
         coin_data = COIN_MAP[zar_exchange][coin_type]
-        message = arbitrage(amount, **coin_data)['summary']
+        result = await run_job(chat_id, arbitrage, amount, **coin_data)
+        if result is None:
+            return
+        message = result['summary'] if isinstance(result, dict) else result
         # import pdb; pdb.set_trace()
         await bot.sendMessage(chat_id, message, reply_to_message_id=msg['message_id'])
 
@@ -98,19 +195,51 @@ async def on_chat_message(msg):
         print('No idea')
 
 
-getcontext().prec = 8  # Set Decimal context.
-load_dotenv('.env')  # Load environment
+def main():
+    global bot
+    global jobs
+    global monitor
+
+    # Imported here so the handlers and the tools they use can be imported without the bot's dependencies
+    import telepot.aio
+    from dotenv import load_dotenv
+    from telepot.aio.loop import MessageLoop
+
+    getcontext().prec = 8  # Set Decimal context.
+    decimal.DefaultContext.prec = 8  # Also for the job threads
+    load_dotenv('.env')  # Load environment
+
+    TOKEN = os.environ.get('TELEGRAM_TOKEN')  # get token from environment
 
-TOKEN = os.environ.get('TELEGRAM_TOKEN')  # get token from environment
+    bot = telepot.aio.Bot(TOKEN)
+    loop = asyncio.get_event_loop()
+    jobs = JobRunner(loop=loop)
+    monitor = OpportunityMonitor(partial(jobs.run, 'monitor'), bot.sendMessage)
 
-bot = telepot.aio.Bot(TOKEN)
-answerer = telepot.aio.helper.Answerer(bot)
-loop = asyncio.get_event_loop()
+    if os.environ.get('BITRADER_METRICS_PORT'):
+        # Localhost only, unless BITRADER_METRICS_HOST (e.g. 0.0.0.0) exposes it
+        profiling.serve_metrics(
+            int(os.environ['BITRADER_METRICS_PORT']), os.environ.get('BITRADER_METRICS_HOST', '127.0.0.1'))
 
-loop.create_task(MessageLoop(bot, {
-    'chat': on_chat_message,
-}).run_forever())
+    if os.environ.get('BITRADER_RECORD_DIR'):
+        from bitrader.recorder import SnapshotRecorder
+        set_recorder(SnapshotRecorder(os.environ['BITRADER_RECORD_DIR']))
+
+    # Keep the forex quotes fresh in the background, so commands don't wait on FNB
+    forex.fnb.start()
+
+    loop.create_task(monitor.run_forever())
+    loop.create_task(MessageLoop(bot, {
+        'chat': on_chat_message,
+    }).run_forever())
+
+    print('Listening ...')
+
+    try:
+        loop.run_forever()
+    finally:
+        jobs.close()
 
-print('Listening ...')
 
-loop.run_forever()
+if __name__ == '__main__':
+    main()
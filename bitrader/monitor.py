@@ -0,0 +1,185 @@
+""" Monitor
+
+Background task that keeps scanning the arbitrage routes and pushes alerts to subscribed chats.
+
+One scan_routes() snapshot per round is shared by all subscriptions. Rounds come faster while the best ROI of
+a route is close to a subscriber's threshold, and slower while every route is far from all thresholds.
+A route alerts a chat when its ROI crosses the chat's threshold. It has to fall back below threshold -
+hysteresis before it can alert again, and at most once per cooldown.
+
+"""
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Alert settings of one chat"""
+
+    def __init__(self, chat_id, threshold: float):
+        """
+
+        Args:
+            chat_id: Chat to alert.
+            threshold: ROI (in %) to alert at.
+        """
+        self.chat_id = chat_id
+        self.threshold = threshold
+        self.above = set()  # Routes currently above threshold
+        self.last_alert = {}  # Route: time of last alert
+
+    def __repr__(self):
+        return f'<Subscription {self.chat_id}: {self.threshold:.2f}%>'
+
+
+def route_name(row) -> str:
+    return f'{row.coin.capitalize()} {row.buy.capitalize()} -> {row.sell.capitalize()}'
+
+
+class OpportunityMonitor:
+    """Scans all routes on an adaptive schedule and alerts subscribed chats"""
+
+    def __init__(self, run, send, min_interval: float = 15, max_interval: float = 300, near: float = 1.,
+                 hysteresis: float = 0.25, cooldown: float = 900, scan_kwargs: dict = None):
+        """
+
+        Args:
+            run: Coroutine function run(func, *args, **kwargs) that runs func off the event loop.
+            send: Coroutine function send(chat_id, text).
+            min_interval: Seconds between rounds while a route is at a threshold.
+            max_interval: Seconds between rounds while all routes are at least near from every threshold.
+            near: ROI distance (in %) from the closest threshold at which rounds slow down to max_interval.
+            hysteresis: ROI (in %) a route has to fall below the threshold before it can alert again.
+            cooldown: Minimum seconds between alerts for the same route and chat.
+            scan_kwargs: Passed on to scan_routes(), e.g. max_invest.
+        """
+        self.run = run
+        self.send = send
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.near = near
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.scan_kwargs = dict(scan_kwargs or {})
+
+        self.subscriptions = {}
+        self.rounds = 0
+        self.alerts = 0
+        self.errors = 0
+        self.interval = max_interval
+        self.last_scan = None
+
+        self._wake = None
+
+    def subscribe(self, chat_id, threshold: float) -> Subscription:
+        subscription = self.subscriptions[chat_id] = Subscription(chat_id, threshold)
+        self.wake()
+        return subscription
+
+    def unsubscribe(self, chat_id) -> bool:
+        return self.subscriptions.pop(chat_id, None) is not None
+
+    def wake(self):
+        """Start the next round now, e.g. after a new subscription"""
+        if self._wake is not None:
+            self._wake.set()
+
+    def next_interval(self, df) -> float:
+        """Seconds until the next round, from how close the best routes are to the thresholds"""
+        roi = df.roi.values[~np.isnan(df.roi.values)]
+        if not len(roi) or not self.subscriptions:
+            return self.max_interval
+
+        thresholds = np.array([s.threshold for s in self.subscriptions.values()])
+        distance = np.abs(roi[:, None] - thresholds[None, :]).min()
+
+        return float(np.interp(distance, [0, self.near], [self.min_interval, self.max_interval]))
+
+    def check(self, df, now: float = None) -> list:
+        """Alerts for the subscriptions whose threshold a route crossed
+
+        Args:
+            df: scan_routes() results.
+            now: Default = time.time().
+
+        Returns: List of (chat_id, text)
+
+        """
+        now = time.time() if now is None else now
+        alerts = []
+
+        for subscription in self.subscriptions.values():
+            for row in df.itertuples():
+                route = (row.direction, row.coin, row.buy, row.sell)
+
+                if np.isnan(row.roi) or row.roi < subscription.threshold - self.hysteresis:
+                    subscription.above.discard(route)
+                    continue
+
+                if row.roi < subscription.threshold or route in subscription.above:
+                    continue
+
+                subscription.above.add(route)
+
+                if now - subscription.last_alert.get(route, -np.inf) < self.cooldown:
+                    continue
+
+                subscription.last_alert[route] = now
+                alerts.append((subscription.chat_id, (
+                    f'{route_name(row)}: ROI of {row.roi:.2f}% at R{row.amount:.0f} '
+                    f'(your threshold is {subscription.threshold:.2f}%)')))
+
+        return alerts
+
+    async def scan(self):
+        """One round: scan once for all subscriptions and send their alerts"""
+        from bitrader.arbitrage_tools import scan_routes
+
+        df = await self.run(scan_routes, **self.scan_kwargs)
+        if df is None:
+            return None
+
+        self.rounds += 1
+        self.last_scan = time.time()
+
+        for chat_id, text in self.check(df):
+            self.alerts += 1
+            try:
+                await self.send(chat_id, text)
+            except Exception as e:
+                log.warning('Could not alert %s: %s', chat_id, e)
+
+        return df
+
+    async def run_forever(self):
+        self._wake = asyncio.Event()
+
+        while True:
+            self._wake.clear()
+
+            if self.subscriptions:
+                try:
+                    df = await self.scan()
+                    self.interval = self.max_interval if df is None else self.next_interval(df)
+                except Exception as e:
+                    self.errors += 1
+                    self.interval = self.max_interval
+                    log.warning('Monitor round failed: %s', e)
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return dict(
+            subscriptions=len(self.subscriptions),
+            rounds=self.rounds,
+            alerts=self.alerts,
+            errors=self.errors,
+            interval=self.interval,
+        )
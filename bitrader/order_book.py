@@ -0,0 +1,135 @@
+""" Order book
+
+Compact, array backed order book for fast fill queries.
+
+"""
+import numpy as np
+
+
+def fill(cumulative_from, cumulative_to, price, limits, order_type: str):
+    """Convert an array of limits along sorted cumulative order book columns
+
+    :param: order_type buy or sell
+        buy exchanges currency for bitcoin
+        sell exchanges bitcoins for currency
+
+    Returns: float array of converted amounts. NaN where the order book is exhausted.
+
+    """
+    limits = np.asarray(limits, dtype=np.float64)
+
+    if not len(cumulative_from):
+        return np.full(limits.shape, np.nan)
+
+    # Same as counting the levels with cumulative < limit, as cumulative columns are sorted.
+    rows = np.searchsorted(cumulative_from, limits, side='left')
+    exhausted = rows >= len(cumulative_from)
+    rows = np.minimum(rows, len(cumulative_from) - 1)
+
+    over = cumulative_from[rows] - limits
+
+    if order_type == 'buy':
+        over_convert = over / price[rows]
+    elif order_type == 'sell':
+        over_convert = over * price[rows]
+    else:
+        raise KeyError(f'{order_type} is not a valid order_type')
+
+    result = cumulative_to[rows] - over_convert
+
+    return np.where(exhausted, np.nan, result)
+
+
+class OrderBook:
+    """One side of an order book, sorted from best to worst price
+
+    asks are sorted by ascending price (what I'll have to pay if I want to buy),
+    bids by descending price (what I'll get if I want to sell).
+
+    """
+    __slots__ = ('book_type', 'price', 'volume', 'cumulative_volume', 'cumulative_value', 'complete')
+
+    def __init__(self, price, volume, book_type: str, complete: bool = True):
+        """
+
+        Args:
+            price: Price per level.
+            volume: Volume per level.
+            book_type: 'asks' or 'bids'
+            complete: Default = True. False if the exchange has more levels than were fetched.
+        """
+        if book_type not in ('asks', 'bids'):
+            raise KeyError(f'{book_type} is not a valid book_type')
+
+        price = np.asarray(price, dtype=np.float64)
+        volume = np.asarray(volume, dtype=np.float64)
+
+        if book_type == 'asks':
+            order = np.argsort(price, kind='mergesort')
+        else:
+            order = np.argsort(-price, kind='mergesort')
+
+        self.book_type = book_type
+        self.price = np.ascontiguousarray(price[order])
+        self.volume = np.ascontiguousarray(volume[order])
+        self.cumulative_volume = np.cumsum(self.volume)
+        self.cumulative_value = np.cumsum(self.price * self.volume)
+        self.complete = complete
+
+    @classmethod
+    def from_levels(cls, levels, book_type: str, price_key=0, volume_key=1):
+        """Build order book from a list of levels as returned by the exchange APIs
+
+        Args:
+            levels: List of lists (Kraken) or list of dicts (Luno, Ice3x).
+            book_type: 'asks' or 'bids'
+            price_key: Index or key of the price in each level.
+            volume_key: Index or key of the volume in each level.
+
+        """
+        price = np.fromiter((float(level[price_key]) for level in levels), dtype=np.float64, count=len(levels))
+        volume = np.fromiter((float(level[volume_key]) for level in levels), dtype=np.float64, count=len(levels))
+
+        return cls(price, volume, book_type)
+
+    @classmethod
+    def from_frame(cls, df, book_type: str, bitcoin_column: str = 'volume', currency_column: str = 'price'):
+        """Build order book from a DataFrame like the ones accepted by prepare_order_book()"""
+        return cls(df[currency_column].astype(float).values, df[bitcoin_column].astype(float).values, book_type)
+
+    def __len__(self):
+        return len(self.price)
+
+    def __repr__(self):
+        return f'<OrderBook {self.book_type}: {len(self)} levels{"" if self.complete else ", truncated"}>'
+
+    def covers(self, value: float) -> bool:
+        """Whether the book is complete or its fetched levels add up to at least value (in currency)"""
+        return self.complete or (len(self) > 0 and self.cumulative_value[-1] >= value)
+
+    def fill(self, limits, order_type: str):
+        """Convert amounts of currency to bitcoin (buy) or bitcoin to currency (sell)
+
+        Args:
+            limits: Scalar or array of amounts to convert.
+            order_type: buy or sell
+
+        Returns: float array of converted amounts. NaN where the order book is exhausted.
+
+        """
+        if order_type == 'buy':
+            return fill(self.cumulative_value, self.cumulative_volume, self.price, limits, order_type)
+        else:
+            return fill(self.cumulative_volume, self.cumulative_value, self.price, limits, order_type)
+
+    def to_frame(self):
+        """DataFrame in the same standard form as prepare_order_book()"""
+        import pandas as pd
+
+        return pd.DataFrame(dict(
+            price=self.price,
+            volume=self.volume,
+            value=self.price * self.volume,
+            cumulative_volume=self.cumulative_volume,
+            cumulative_value=self.cumulative_value,
+        ))
@@ -0,0 +1,238 @@
+""" Profiling
+
+Optional per-stage latency instrumentation for the arbitrage pipeline.
+
+Stages are timed with the @timed decorator or the span() context manager, tagged with the trace ID of the
+request they ran for, and kept in rolling windows for p50/p95/p99 latencies. Disabled by default; when
+disabled, instrumented code only pays for one flag check.
+
+Enable with BITRADER_PROFILE=1 or enable(). Set BITRADER_METRICS_FILE to write Prometheus text format
+metrics to a file, or call serve_metrics(port) for an HTTP endpoint on localhost.
+
+"""
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from functools import wraps
+
+WINDOW = 1000  # Samples per stage used for the percentiles
+QUANTILES = (0.5, 0.95, 0.99)
+
+_enabled = os.environ.get('BITRADER_PROFILE', '').lower() in ('1', 'true', 'yes')
+
+current_trace_id = contextvars.ContextVar('trace_id', default=None)
+
+_samples = defaultdict(lambda: deque(maxlen=WINDOW))
+_counts = defaultdict(int)
+_sums = defaultdict(float)
+_recent = deque(maxlen=200)
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def record(stage: str, seconds: float):
+    """Add a timing for stage, e.g. one measured in another process"""
+    if not _enabled:
+        return
+    with _lock:
+        _samples[stage].append(seconds)
+        _counts[stage] += 1
+        _sums[stage] += seconds
+        _recent.append((current_trace_id.get(), stage, seconds, time.time()))
+
+
+class _Span:
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.started)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(stage: str):
+    """Context manager timing the block as stage"""
+    if not _enabled:
+        return _no_span
+    return _Span(stage)
+
+
+def timed(stage: str):
+    """Decorator timing every call of the function as stage"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class trace:
+    """Context manager tagging all spans inside it with a new (or given) trace ID"""
+
+    def __init__(self, name: str = None, trace_id: str = None):
+        """
+
+        Args:
+            name: Optional. Also time the whole block as a stage with this name.
+            trace_id: Optional. Defaults to a new random ID.
+        """
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex[:12]
+        self._token = None
+        self._span = None
+
+    def __enter__(self):
+        self._token = current_trace_id.set(self.trace_id)
+        if self.name:
+            self._span = span(self.name).__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._span is not None:
+            self._span.__exit__(*exc_info)
+        current_trace_id.reset(self._token)
+
+
+def in_context(func):
+    """Wrap func to run in a copy of the current context, so threads keep the caller's trace ID"""
+    if not _enabled:
+        return func
+    return wraps(func)(lambda *args, **kwargs: contextvars.copy_context().run(func, *args, **kwargs))
+
+
+def percentile(samples, quantile: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.
+    return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+
+def stats() -> dict:
+    """Stage: dict(count, sum, p50, p95, p99) in seconds"""
+    with _lock:
+        samples = {stage: list(values) for stage, values in _samples.items()}
+        counts = dict(_counts)
+        sums = dict(_sums)
+
+    return {
+        stage: dict(
+            count=counts[stage],
+            sum=sums[stage],
+            **{f'p{int(q * 100)}': percentile(values, q) for q in QUANTILES})
+        for stage, values in sorted(samples.items())}
+
+
+def recent(trace_id: str = None) -> list:
+    """Recent spans as (trace_id, stage, seconds, timestamp), optionally for one trace only"""
+    with _lock:
+        spans = list(_recent)
+    if trace_id is not None:
+        spans = [s for s in spans if s[0] == trace_id]
+    return spans
+
+
+def summary() -> str:
+    """Human readable latency table, e.g. for the /stats bot command"""
+    if not _enabled:
+        return 'Profiling is disabled. Set BITRADER_PROFILE=1 to enable it.'
+
+    lines = ['stage: count p50 / p95 / p99 (ms)']
+    for stage, s in stats().items():
+        lines.append(
+            f'{stage}: {s["count"]} {s["p50"] * 1000:.0f} / {s["p95"] * 1000:.0f} / {s["p99"] * 1000:.0f}')
+    return '\n'.join(lines)
+
+
+def prometheus_text() -> str:
+    """Stage latencies in Prometheus text exposition format"""
+    lines = [
+        '# HELP bitrader_stage_seconds Latency of arbitrage pipeline stages.',
+        '# TYPE bitrader_stage_seconds summary',
+    ]
+    for stage, s in stats().items():
+        for q in QUANTILES:
+            lines.append(f'bitrader_stage_seconds{{stage="{stage}",quantile="{q}"}} {s[f"p{int(q * 100)}"]:.6f}')
+        lines.append(f'bitrader_stage_seconds_sum{{stage="{stage}"}} {s["sum"]:.6f}')
+        lines.append(f'bitrader_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path: str = None):
+    """Write prometheus_text() to path (default: BITRADER_METRICS_FILE), if profiling is enabled"""
+    path = path or os.environ.get('BITRADER_METRICS_FILE')
+    if not _enabled or not path:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1'):
+    """Serve prometheus_text() on http://host:port/metrics from a background thread
+
+    The endpoint has no authentication, so it only listens on localhost unless another host is given,
+    e.g. 0.0.0.0 for a Prometheus server in another container.
+
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
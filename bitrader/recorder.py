@@ -0,0 +1,358 @@
+""" Recorder
+
+Append-only columnar store for the order books and forex quotes fetched by the bot.
+
+Each UTC day gets its own segment directory with three append-only files:
+
+    index.bin   One INDEX_DTYPE row per snapshot: timestamp, venue, book type, code, whether the book is
+                complete and where its data is.
+    levels.bin  LEVEL_DTYPE (price, volume) rows.
+    runs.bin    RUN_DTYPE rows: runs of levels copied unchanged from the stream's previous snapshot.
+
+A snapshot is either a keyframe (all levels stored) or a delta: the levels that changed since the previous
+snapshot of the same stream, plus runs of the unchanged ones. Every segment starts each stream with a
+keyframe and adds one every keyframe_interval snapshots, so a snapshot can be decoded from its own
+segment, and from at most keyframe_interval rows of it.
+
+Forex quotes are stored as a one level book, with the rate as price and the order type as book type.
+
+Readers memory-map a segment with Segment and only decode the rows they ask for.
+
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+from bitrader.order_book import OrderBook
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('venue', 'S8'),
+    ('book_type', 'S8'),
+    ('code', 'S8'),
+    ('count', '<i4'),  # Levels in the snapshot
+    ('base', '<i8'),  # Row of the previous snapshot the runs copy from, -1 for keyframes
+    ('levels_offset', '<i8'),
+    ('levels_count', '<i4'),
+    ('runs_offset', '<i8'),
+    ('runs_count', '<i4'),
+    ('complete', '?'),  # False for order books fetched to a limited depth, see OrderBook.complete
+])
+LEVEL_DTYPE = np.dtype([('price', '<f8'), ('volume', '<f8')])
+RUN_DTYPE = np.dtype([('src', '<i4'), ('dst', '<i4'), ('length', '<i4')])
+
+FILES = {
+    'index': ('index.bin', INDEX_DTYPE),
+    'levels': ('levels.bin', LEVEL_DTYPE),
+    'runs': ('runs.bin', RUN_DTYPE),
+}
+
+
+def segment_day(timestamp: float) -> str:
+    """UTC day of a timestamp, as used for segment directory names"""
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def segment_days(root: str) -> list:
+    """Days with a segment under root, oldest first"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(day for day in os.listdir(root) if os.path.exists(os.path.join(root, day, 'index.bin')))
+
+
+def encode_delta(previous, levels, descending: bool = False):
+    """Split levels into runs copied from previous and literal levels
+
+    Args:
+        previous: LEVEL_DTYPE array of the previous snapshot.
+        levels: LEVEL_DTYPE array, sorted the same way as previous.
+        descending: Default = False. Whether both are sorted by descending price (bids).
+
+    Returns: Tuple of (runs, literals) as RUN_DTYPE and LEVEL_DTYPE arrays.
+
+    """
+    sign = -1. if descending else 1.
+
+    src = np.searchsorted(sign * previous['price'], sign * levels['price'])
+    src_clipped = np.minimum(src, max(len(previous) - 1, 0))
+    matched = (src < len(previous)) & (len(previous) > 0)
+    if len(previous):
+        matched &= (previous['price'][src_clipped] == levels['price'])
+        matched &= (previous['volume'][src_clipped] == levels['volume'])
+
+    # A level continues a run if the level before it was copied from the level before its source
+    continues = np.zeros(len(levels), dtype=bool)
+    continues[1:] = matched[1:] & matched[:-1] & (src[1:] == src[:-1] + 1)
+    ends_run = np.zeros(len(levels), dtype=bool)
+    ends_run[:-1] = ~continues[1:]
+    ends_run[-1:] = True
+
+    starts = np.flatnonzero(matched & ~continues)
+    ends = np.flatnonzero(matched & ends_run)
+
+    runs = np.empty(len(starts), dtype=RUN_DTYPE)
+    runs['src'] = src[starts]
+    runs['dst'] = starts
+    runs['length'] = ends - starts + 1
+
+    return runs, levels[~matched]
+
+
+def decode_delta(previous, runs, literals, count: int):
+    """Inverse of encode_delta()"""
+    levels = np.empty(count, dtype=LEVEL_DTYPE)
+    copied = np.zeros(count, dtype=bool)
+
+    for src, dst, length in runs.tolist():
+        levels[dst:dst + length] = previous[src:src + length]
+        copied[dst:dst + length] = True
+
+    levels[~copied] = literals
+
+    return levels
+
+
+def _levels(value):
+    """LEVEL_DTYPE array of an OrderBook, or of a quote as a one level book"""
+    if isinstance(value, OrderBook):
+        levels = np.empty(len(value), dtype=LEVEL_DTYPE)
+        levels['price'] = value.price
+        levels['volume'] = value.volume
+        return levels
+
+    levels = np.zeros(1, dtype=LEVEL_DTYPE)
+    levels['price'] = float(value)
+    return levels
+
+
+class SnapshotRecorder:
+    """Appends order books and quotes to per-day segments under root"""
+
+    def __init__(self, root: str, keyframe_interval: int = 60):
+        """
+
+        Args:
+            root: Directory the segments are written to.
+            keyframe_interval: Maximum number of deltas per stream between keyframes.
+        """
+        self.root = root
+        self.keyframe_interval = keyframe_interval
+
+        self.snapshots = 0
+        self.levels = 0
+        self.levels_stored = 0
+        self.bytes_written = 0
+
+        self._day = None
+        self._files = {}
+        self._sizes = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: tuple, value, timestamp: float = None):
+        """Append one snapshot
+
+        Args:
+            key: Market data cache key, (venue, book_type, coin_code) for order books or
+                (venue, currency_code, order_type) for forex quotes.
+            value: OrderBook or quote.
+            timestamp: Default = now.
+
+        Returns: Row of the snapshot in its segment's index, or None if the stream already has a
+            snapshot at or after timestamp.
+
+        """
+        if isinstance(value, OrderBook):
+            venue, book_type, code = key
+        else:
+            venue, code, book_type = key
+
+        timestamp = time.time() if timestamp is None else timestamp
+        stream = (venue.lower(), book_type, code)
+        levels = _levels(value)
+
+        with self._lock:
+            self._open(segment_day(timestamp))
+
+            previous = self._streams.get(stream)
+            if previous is not None and timestamp <= previous['timestamp']:
+                return None
+
+            if previous is None or previous['deltas'] >= self.keyframe_interval:
+                runs, literals, base, deltas = np.empty(0, dtype=RUN_DTYPE), levels, -1, 0
+            else:
+                runs, literals = encode_delta(previous['levels'], levels, descending=book_type == 'bids')
+                base, deltas = previous['row'], previous['deltas'] + 1
+
+            row = np.zeros(1, dtype=INDEX_DTYPE)
+            row['timestamp'] = timestamp
+            row['venue'] = stream[0].encode()
+            row['book_type'] = stream[1].encode()
+            row['code'] = stream[2].encode()
+            row['count'] = len(levels)
+            row['base'] = base
+            row['levels_offset'] = self._sizes['levels']
+            row['levels_count'] = len(literals)
+            row['runs_offset'] = self._sizes['runs']
+            row['runs_count'] = len(runs)
+            row['complete'] = getattr(value, 'complete', True)
+
+            # Index last, so readers never see a row whose data isn't written yet
+            self._append('levels', literals)
+            self._append('runs', runs)
+            index_row = self._sizes['index']
+            self._append('index', row)
+
+            self._streams[stream] = dict(row=index_row, levels=levels, deltas=deltas, timestamp=timestamp)
+
+            self.snapshots += 1
+            self.levels += len(levels)
+            self.levels_stored += len(literals)
+
+        return index_row
+
+    def _open(self, day: str):
+        """Switch to the segment for day, starting every stream with a keyframe"""
+        if day == self._day:
+            return
+
+        self.close()
+
+        path = os.path.join(self.root, day)
+        os.makedirs(path, exist_ok=True)
+
+        for name, (filename, dtype) in FILES.items():
+            self._files[name] = open(os.path.join(path, filename), 'ab')
+            self._sizes[name] = os.path.getsize(os.path.join(path, filename)) // dtype.itemsize
+
+        self._day = day
+
+    def _append(self, name: str, rows):
+        if not len(rows):
+            return
+        data = rows.tobytes()
+        self._files[name].write(data)
+        self._files[name].flush()
+        self._sizes[name] += len(rows)
+        self.bytes_written += len(data)
+
+    def stats(self) -> dict:
+        return dict(
+            snapshots=self.snapshots,
+            levels=self.levels,
+            levels_stored=self.levels_stored,
+            bytes_written=self.bytes_written,
+            delta_ratio=self.levels_stored / self.levels if self.levels else 0.,
+        )
+
+    def close(self):
+        files, self._files = self._files, {}
+        for f in files.values():
+            f.close()
+        self._day = None
+        self._streams = {}
+
+
+def _map(path: str, dtype):
+    """Read only memory map of the complete rows in path"""
+    rows = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if not rows:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
+
+class Segment:
+    """Read only, memory mapped view of one day of recorded snapshots"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = _map(os.path.join(path, 'index.bin'), INDEX_DTYPE)
+        self.levels = _map(os.path.join(path, 'levels.bin'), LEVEL_DTYPE)
+        self.runs = _map(os.path.join(path, 'runs.bin'), RUN_DTYPE)
+
+    @classmethod
+    def open(cls, root: str, day: str):
+        return cls(os.path.join(root, day))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f'<Segment {os.path.basename(self.path)}: {len(self)} snapshots>'
+
+    def streams(self) -> list:
+        """(venue, book_type, code) of every stream in the segment"""
+        keys = np.unique(self.index[['venue', 'book_type', 'code']])
+        return [tuple(field.decode() for field in key) for key in keys.tolist()]
+
+    def rows(self, venue: str, book_type: str, code: str):
+        """Index rows of one stream, in time order"""
+        return np.flatnonzero(
+            (self.index['venue'] == venue.encode())
+            & (self.index['book_type'] == book_type.encode())
+            & (self.index['code'] == code.encode()))
+
+    def find(self, venue: str, book_type: str, code: str, timestamp: float = None):
+        """Row of the stream's last snapshot at or before timestamp (default: the last one), or None"""
+        rows = self.rows(venue, book_type, code)
+        if timestamp is not None:
+            rows = rows[:np.searchsorted(self.index['timestamp'][rows], timestamp, side='right')]
+        return int(rows[-1]) if len(rows) else None
+
+    def levels_at(self, row: int, cached: tuple = None):
+        """Decoded LEVEL_DTYPE array of the snapshot at row
+
+        Args:
+            row: Index row.
+            cached: Optional (row, levels) of an earlier snapshot of the same stream, e.g. when reading a
+                stream in time order, to decode from there instead of from the last keyframe.
+
+        """
+        chain = [row]
+        while self.index['base'][chain[-1]] >= 0 and (cached is None or chain[-1] != cached[0]):
+            chain.append(int(self.index['base'][chain[-1]]))
+
+        levels = None
+        if cached is not None and chain[-1] == cached[0]:
+            levels = cached[1]
+            chain.pop()
+
+        for r in reversed(chain):
+            entry = self.index[r]
+            literals = self.levels[entry['levels_offset']:entry['levels_offset'] + entry['levels_count']]
+            if entry['base'] < 0:
+                levels = np.array(literals)
+            else:
+                runs = self.runs[entry['runs_offset']:entry['runs_offset'] + entry['runs_count']]
+                levels = decode_delta(levels, runs, literals, int(entry['count']))
+
+        return levels
+
+    def load(self, row: int, cached: tuple = None):
+        """OrderBook (or quote) of the snapshot at row, see levels_at()"""
+        book_type = self.index['book_type'][row].decode()
+        levels = self.levels_at(row, cached=cached)
+
+        if book_type in ('asks', 'bids'):
+            return OrderBook(levels['price'], levels['volume'], book_type, complete=bool(self.index['complete'][row]))
+
+        return float(levels['price'][0])
+
+    def snapshot(self, timestamp: float = None, streams=None) -> dict:
+        """Latest value of each stream at or before timestamp
+
+        Args:
+            timestamp: Default = end of the segment.
+            streams: Optional list of (venue, book_type, code). Default: all streams.
+
+        Returns: Dict of (venue, book_type, code): (value, captured_at)
+
+        """
+        result = {}
+        for stream in streams or self.streams():
+            row = self.find(*stream, timestamp=timestamp)
+            if row is not None:
+                result[stream] = self.load(row), float(self.index['timestamp'][row])
+        return result
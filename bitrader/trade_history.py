@@ -0,0 +1,235 @@
+""" Trade history
+
+Local, append-only trade history per pair, synced incrementally from the exchange.
+
+Trades are stored in one fixed-width binary file per pair (TRADE_DTYPE rows, oldest first) that readers
+memory-map, so time slices are views found with a binary search instead of a full load. Each sync asks the
+exchange for trades since the last stored timestamp and only appends trades with a higher sequence number
+than the last one stored.
+
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 100  # Trades returned per request
+SEQUENCE_SCALE = 1000  # Trades without a sequence number get timestamp * SEQUENCE_SCALE + index within the ms
+
+TRADE_DTYPE = np.dtype([
+    ('timestamp', '<i8'),  # Milliseconds since epoch, as returned by the exchange
+    ('sequence', '<i8'),
+    ('price', '<f8'),
+    ('volume', '<f8'),
+    ('is_buy', '?'),
+])
+
+
+def _to_ms(value):
+    """Milliseconds since epoch from None, ms, or anything pandas.Timestamp accepts"""
+    if value is None or isinstance(value, (int, np.integer)):
+        return value
+    import pandas as pd
+
+    return int(pd.Timestamp(value).value // 10 ** 6)
+
+
+def synthetic(sequence, timestamp) -> bool:
+    """Whether a sequence number was made up by to_trades() instead of coming from the exchange"""
+    # sequence == timestamp: numbered by earlier versions
+    return sequence // SEQUENCE_SCALE == timestamp or sequence == timestamp
+
+
+def to_trades(trades: list):
+    """TRADE_DTYPE array from the trades of BitX.get_trades(), sorted oldest first
+
+    Trades without a sequence number are numbered by timestamp and their order within the millisecond
+    (timestamp * SEQUENCE_SCALE + index), so trades in the same millisecond don't look like duplicates.
+
+    """
+    rows = np.empty(len(trades), dtype=TRADE_DTYPE)
+    for i, trade in enumerate(trades):
+        rows[i] = (
+            int(trade['timestamp']), int(trade.get('sequence', -1)), float(trade['price']),
+            float(trade['volume']), bool(trade.get('is_buy', False)))
+
+    if len(rows) and (rows['sequence'] < 0).any():
+        # Number in the order the exchange returned them, oldest first. Newest first unless the timestamps
+        # say otherwise, like the exchange returns them.
+        if not rows['timestamp'][0] < rows['timestamp'][-1]:
+            rows = rows[::-1]
+        rows = rows[np.argsort(rows['timestamp'], kind='stable')]
+
+        timestamps = rows['timestamp']
+        positions = np.arange(len(rows))
+        first = np.maximum.accumulate(np.where(np.diff(timestamps, prepend=timestamps[0] - 1) != 0, positions, 0))
+        rows['sequence'] = timestamps * SEQUENCE_SCALE + (positions - first)
+
+    return rows[np.lexsort((rows['sequence'], rows['timestamp']))]
+
+
+class TradeStore:
+    """Trade history of one pair in directory/<pair>.trades"""
+
+    def __init__(self, directory: str, pair: str = 'XBTZAR'):
+        """
+
+        Args:
+            directory: Directory the history file is kept in.
+            pair: Default = XBTZAR.
+        """
+        self.pair = pair
+        self.path = os.path.join(directory, f'{pair}.trades')
+        os.makedirs(directory, exist_ok=True)
+
+        self.missing = 0  # Trades skipped between syncs, going by sequence numbers
+
+        self._map = None
+        self._map_rows = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return os.path.getsize(self.path) // TRADE_DTYPE.itemsize if os.path.exists(self.path) else 0
+
+    def __repr__(self):
+        return f'<TradeStore {self.pair}: {len(self)} trades>'
+
+    @property
+    def trades(self):
+        """Read only memory map of all stored trades, remapped when the file has grown"""
+        rows = len(self)
+        if rows != self._map_rows:
+            self._map = np.memmap(self.path, dtype=TRADE_DTYPE, mode='r', shape=(rows,)) if rows else None
+            self._map_rows = rows
+        return self._map if self._map is not None else np.empty(0, dtype=TRADE_DTYPE)
+
+    def last(self):
+        """Last stored trade, or None"""
+        trades = self.trades
+        return trades[-1] if len(trades) else None
+
+    def append(self, rows) -> int:
+        """Append the rows newer than the last stored trade
+
+        Args:
+            rows: TRADE_DTYPE array, oldest first.
+
+        Returns: Number of trades appended.
+
+        """
+        with self._lock:
+            last = self.last()
+            if last is not None:
+                rows = rows[(rows['timestamp'] > last['timestamp'])
+                            | ((rows['timestamp'] == last['timestamp']) & (rows['sequence'] > last['sequence']))]
+            # Duplicates within the batch, e.g. from overlapping pages
+            if len(rows):
+                keep = np.ones(len(rows), dtype=bool)
+                keep[1:] = (rows['sequence'][1:] != rows['sequence'][:-1]) | (
+                    rows['timestamp'][1:] != rows['timestamp'][:-1])
+                rows = rows[keep]
+
+            if len(rows):
+                if last is not None and not synthetic(last['sequence'], last['timestamp']):
+                    missing = int(rows['sequence'][0] - last['sequence'] - 1)
+                    if missing > 0:
+                        log.warning(
+                            '%s: %d trades missing before sequence %d', self.pair, missing, rows['sequence'][0])
+                        self.missing += missing
+
+                with open(self.path, 'ab') as f:
+                    f.write(rows.tobytes())
+
+        return len(rows)
+
+    def sync(self, client, since=None, max_pages: int = 100) -> int:
+        """Fetch and store the trades since the last stored one
+
+        Args:
+            client: BitX client for this pair.
+            since: Optional. Where to start if nothing is stored yet (ms or anything pandas.Timestamp
+                accepts). Default: the trades the exchange returns without since.
+            max_pages: Maximum number of requests.
+
+        Returns: Number of new trades stored.
+
+        """
+        last = self.last()
+        since = int(last['timestamp']) if last is not None else _to_ms(since)
+
+        added = 0
+        for _ in range(max_pages):
+            trades = client.get_trades(since=since, kind='basic')['trades'] or []
+            rows = to_trades(trades)
+            added += self.append(rows)
+
+            # A full page from since on means there may be more
+            if since is None or len(rows) < PAGE_SIZE or rows['timestamp'][-1] <= since:
+                break
+            since = int(rows['timestamp'][-1])
+
+        return added
+
+    def slice(self, start=None, end=None):
+        """View of the trades with start <= timestamp < end, without loading the rest
+
+        Args:
+            start: Optional. ms since epoch or anything pandas.Timestamp accepts.
+            end: Optional. ms since epoch or anything pandas.Timestamp accepts.
+
+        """
+        trades = self.trades
+        timestamps = trades['timestamp']
+        first = np.searchsorted(timestamps, _to_ms(start), side='left') if start is not None else 0
+        last = np.searchsorted(timestamps, _to_ms(end), side='left') if end is not None else len(trades)
+        return trades[first:last]
+
+    def frame(self, start=None, end=None):
+        """Trades between start and end as a DataFrame indexed by time, like BitX.get_trades_frame()"""
+        import pandas as pd
+
+        trades = self.slice(start, end)
+        df = pd.DataFrame(dict(
+            price=trades['price'], volume=trades['volume'], is_buy=trades['is_buy'], sequence=trades['sequence']))
+        df.index = pd.to_datetime(trades['timestamp'], unit='ms')
+        return df
+
+    def realized_volatility(self, start=None, end=None, interval: float = 300) -> float:
+        """Realized volatility of log returns between the last prices of each interval (seconds)
+
+        Returns: Standard deviation per interval, e.g. 0.01 for 1%. NaN with fewer than three intervals.
+
+        """
+        trades = self.slice(start, end)
+        if not len(trades):
+            return float('nan')
+
+        buckets = trades['timestamp'] // int(interval * 1000)
+        # Last trade in each bucket
+        last_in_bucket = np.flatnonzero(np.diff(buckets, append=buckets[-1] + 1))
+        prices = trades['price'][last_in_bucket]
+        if len(prices) < 3:
+            return float('nan')
+
+        return float(np.std(np.diff(np.log(prices)), ddof=1))
+
+    def volume_profile(self, start=None, end=None, bins: int = 20):
+        """Traded volume per price bin
+
+        Returns: Tuple of (bin_edges, volume) arrays.
+
+        """
+        trades = self.slice(start, end)
+        if not len(trades):
+            return np.empty(0), np.empty(0)
+        volume, edges = np.histogram(trades['price'], bins=bins, weights=trades['volume'])
+        return edges, volume
+
+    def vwap(self, start=None, end=None) -> float:
+        """Volume weighted average price"""
+        trades = self.slice(start, end)
+        volume = trades['volume'].sum()
+        return float((trades['price'] * trades['volume']).sum() / volume) if volume else float('nan')
@@ -48,7 +48,7 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['docs', 'tests']),
+    packages=find_packages(exclude=['docs', 'tests', 'benchmarks']),
 
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
@@ -70,6 +70,7 @@ setup(
         'krakenex>=0.1.4',
         'matplotlib',
         'seaborn',
+        'numpy',
         'pandas',
         'notebook',
         'lxml',
@@ -77,9 +78,7 @@ setup(
         'python-dotenv',
         'BeautifulSoup4',
         # API tools
-        'redis',  # Make optional?
         'requests>=2',
-        'requests-cache>=0.4.12',
         'requests-futures>=0.9.7',
     ],
 
@@ -92,9 +91,19 @@ setup(
             'wheel>=0.29.0',
             'python-dotenv>=0.5.1',
         ],
-        # 'test': [
-        #     'coverage',
-        # ],
+        'stream': [
+            'websocket-client',
+        ],
+        'fast_json': [
+            'orjson',
+        ],
+        'redis': [
+            'redis',
+        ],
+        'test': [
+            'fakeredis',
+            'pytest',
+        ],
     },
 
     # test_suite='nose.collector',
@@ -0,0 +1,143 @@
+import pytest
+
+from bitrader import api_cache
+from bitrader.api_cache import MemoryStore, RedisStore, SQLiteStore, TieredCache
+from bitrader.api_tools import Ice3xAPI
+
+
+class Clock:
+    def __init__(self, now=1000000.):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class Fetch:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return f'response {self.calls}'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(api_cache, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStore()
+    if request.param == 'sqlite':
+        return SQLiteStore(str(tmp_path / 'api_cache.sqlite'))
+
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisStore(connection=fakeredis.FakeStrictRedis())
+
+
+def wait_for_refresh(cache):
+    # One refresh worker, so this runs after the refresh it queued
+    cache._executor.submit(lambda: None).result(timeout=5)
+
+
+def test_store_roundtrip(store):
+    store.set('key', {'price': 1.5}, stored_at=10., expires_at=None)
+
+    assert store.get('key') == ({'price': 1.5}, 10.)
+
+    store.delete('key')
+    assert store.get('key') is None
+
+
+def test_fresh_values_come_from_the_cache(store, clock):
+    cache = TieredCache([store])
+    fetch = Fetch()
+
+    assert cache.get('key', fetch, ttl=60) == 'response 1'
+    clock.now += 30
+    assert cache.get('key', fetch, ttl=60) == 'response 1'
+
+    assert fetch.calls == 1
+    assert cache.stats()['hits'] == {store.name: 1}
+    assert cache.stats()['misses'] == 1
+
+
+def test_expired_values_are_fetched_again(store, clock):
+    cache = TieredCache([store])
+    fetch = Fetch()
+
+    cache.get('key', fetch, ttl=60)
+    clock.now += 61
+
+    assert cache.get('key', fetch, ttl=60) == 'response 2'
+    assert cache.stats()['misses'] == 2
+
+
+def test_stale_values_are_served_while_they_refresh(store, clock):
+    cache = TieredCache([store], refresh_workers=1)
+    fetch = Fetch()
+
+    cache.get('key', fetch, ttl=60, stale=30)
+    clock.now += 75
+
+    assert cache.get('key', fetch, ttl=60, stale=30) == 'response 1'
+    wait_for_refresh(cache)
+
+    assert cache.get('key', fetch, ttl=60, stale=30) == 'response 2'
+    assert fetch.calls == 2
+    assert cache.stats()['stale'] == 1
+    assert cache.stats()['refreshes'] == 1
+
+
+def test_uncacheable_values_are_not_stored(store, clock):
+    cache = TieredCache([store])
+    fetch = Fetch()
+
+    cache.get('key', fetch, ttl=60, cacheable=lambda value: False)
+    cache.get('key', fetch, ttl=60, cacheable=lambda value: False)
+
+    assert fetch.calls == 2
+
+
+def test_hits_are_counted_per_tier(store, clock):
+    if store.name == 'memory':
+        pytest.skip('needs a slower tier than memory')
+    memory = MemoryStore()
+    cache = TieredCache([memory, store])
+    fetch = Fetch()
+
+    cache.get('key', fetch, ttl=60)
+    memory.clear()
+
+    # From the slower tier, which copies it into memory for the next one
+    cache.get('key', fetch, ttl=60)
+    cache.get('key', fetch, ttl=60)
+
+    assert fetch.calls == 1
+    assert cache.stats()['hits'] == {'memory': 1, store.name: 1}
+    assert cache.stats()['hit_rate'] == pytest.approx(2 / 3)
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemoryStore(maxsize=2)
+    for key in ('a', 'b'):
+        store.set(key, key, stored_at=0.)
+    store.get('a')
+    store.set('c', 'c', stored_at=0.)
+
+    assert store.get('b') is None
+    assert store.get('a') == ('a', 0.)
+
+
+def test_cache_keys_leave_out_the_nonce():
+    api = Ice3xAPI(cache=False, future=False)
+
+    first = api.cache_key('https://www.ICE3X.com/api/v1/orderbook/info?nonce=1&type=bid&pair_id=6')
+    second = api.cache_key('https://www.ICE3X.com/api/v1/orderbook/info?nonce=2&type=bid&pair_id=6')
+
+    assert first == second == 'https://www.ICE3X.com/api/v1/orderbook/info?type=bid&pair_id=6'
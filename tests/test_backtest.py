@@ -0,0 +1,58 @@
+import numpy as np
+
+from bitrader.backtest import BacktestResult, backtest_segment, route_streams
+from bitrader.order_book import OrderBook
+from bitrader.recorder import Segment, SnapshotRecorder, segment_days
+
+DAY_START = 1700006400  # 2023-11-15 00:00 UTC
+AMOUNTS = np.array([10000., 50000., 200000.])
+
+
+def record_route(root, complete):
+    """Kraken asks for about R160000, deep Luno bids and a rate of 16 ZAR / EUR"""
+    recorder = SnapshotRecorder(root)
+    price = np.arange(5000., 5010.)
+    recorder.record(('kraken', 'asks', 'XBT'), OrderBook(price, np.full(10, .2), 'asks', complete=complete),
+                    DAY_START + 1)
+    recorder.record(('luno', 'bids', 'XBT'), OrderBook(price[::-1] * 20, np.full(10, 10.), 'bids'), DAY_START + 1)
+    recorder.record(('fnb', 'EUR', 'buy'), 16., DAY_START + 1)
+    recorder.close()
+
+    return Segment.open(root, segment_days(root)[0])
+
+
+def test_segment_loads_whether_a_book_is_complete(tmp_path):
+    segment = record_route(str(tmp_path), complete=False)
+
+    kraken = segment.load(segment.find('kraken', 'asks', 'XBT'))
+    luno = segment.load(segment.find('luno', 'bids', 'XBT'))
+
+    assert not kraken.complete
+    assert luno.complete
+
+
+def test_truncated_books_leave_roi_unknown(tmp_path):
+    results = {}
+    for complete in (True, False):
+        segment = record_route(str(tmp_path / str(complete)), complete)
+        times, roi, sample_complete = backtest_segment(
+            segment.path, route_streams('bitcoin', 'luno'), [DAY_START + 60], AMOUNTS)
+        results[complete] = BacktestResult(times, AMOUNTS, roi, complete=sample_complete)
+
+    # Same ROI either way, only the largest amount runs past the Kraken book
+    assert np.array_equal(results[True].roi, results[False].roi, equal_nan=True)
+    assert np.isnan(results[True].roi[0, -1]) and not np.isnan(results[True].roi[0, 0])
+
+    assert results[True].known().all()
+    assert results[False].known().tolist() == [[True, True, False]]
+    assert results[False].summary()['truncated'] == 1
+
+
+def test_result_keeps_complete_flags(tmp_path):
+    result = BacktestResult([1., 2.], AMOUNTS, np.zeros((2, 3)), meta=dict(coin='bitcoin'), complete=[True, False])
+    result.save(str(tmp_path / 'result.npz'))
+
+    loaded = BacktestResult.load(str(tmp_path / 'result.npz'))
+
+    assert loaded.complete.tolist() == [True, False]
+    assert loaded.meta == dict(coin='bitcoin')
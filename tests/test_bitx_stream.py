@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+import pytest
+
+from bitrader.bitx import OrderBookStream, ReplayFeed, SequenceGapError
+
+SNAPSHOT = {
+    'sequence': '10',
+    'timestamp': 1000,
+    'asks': [{'id': 'a1', 'price': '101.00', 'volume': '1.0'}, {'id': 'a2', 'price': '102.00', 'volume': '2.0'}],
+    'bids': [{'id': 'b1', 'price': '99.00', 'volume': '1.5'}, {'id': 'b2', 'price': '98.00', 'volume': '3.0'}],
+}
+
+
+def update(sequence, **kwargs):
+    return dict(sequence=str(sequence), timestamp=1000 + sequence, **kwargs)
+
+
+def create(order_id, order_type, price, volume):
+    return {'order_id': order_id, 'type': order_type, 'price': str(price), 'volume': str(volume)}
+
+
+def trade(maker_order_id, base):
+    return {'maker_order_id': maker_order_id, 'base': str(base), 'counter': '0'}
+
+
+def levels(stream, book_type):
+    book = stream.book(book_type)
+    return list(zip(np.asarray(book.price).tolist(), np.asarray(book.volume).tolist()))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stream():
+    stream = OrderBookStream('replay')
+    stream.load_snapshot(SNAPSHOT)
+    return stream
+
+
+def test_load_snapshot(stream):
+    assert stream.sequence == 10
+    assert stream.wait_ready(0)
+    assert levels(stream, 'asks') == [(101., 1.), (102., 2.)]
+    assert levels(stream, 'bids') == [(99., 1.5), (98., 3.)]
+
+
+def test_create_update(stream):
+    stream.apply(update(11, create_update=create('a3', 'ASK', 100.5, 0.5)))
+    stream.apply(update(12, create_update=create('b3', 'BID', 99.5, 0.25)))
+
+    assert stream.sequence == 12
+    assert levels(stream, 'asks')[0] == (100.5, 0.5)
+    assert levels(stream, 'bids')[0] == (99.5, 0.25)
+
+
+def test_delete_update(stream):
+    stream.apply(update(11, delete_update={'order_id': 'a1'}))
+
+    assert levels(stream, 'asks') == [(102., 2.)]
+    assert len(levels(stream, 'bids')) == 2
+
+
+def test_trade_updates(stream):
+    stream.apply(update(11, trade_updates=[trade('a1', 0.4), trade('b1', 1.5)]))
+
+    assert levels(stream, 'asks') == [(101., pytest.approx(0.6)), (102., 2.)]
+    assert levels(stream, 'bids') == [(98., 3.)]
+
+
+def test_books_are_not_modified_by_updates(stream):
+    before = stream.book('asks')
+    stream.apply(update(11, delete_update={'order_id': 'a1'}))
+
+    assert len(before) == 2
+    assert stream.book('asks') is not before
+    assert stream.book('asks') is stream.book('asks')
+
+
+def test_old_updates_are_ignored(stream):
+    stream.apply(update(10, delete_update={'order_id': 'a1'}))
+
+    assert stream.sequence == 10
+    assert len(levels(stream, 'asks')) == 2
+
+
+def test_sequence_gap(stream):
+    with pytest.raises(SequenceGapError):
+        stream.apply(update(12, delete_update={'order_id': 'a1'}))
+    assert stream.sequence == 10
+    assert len(levels(stream, 'asks')) == 2
+
+
+def test_gap_resyncs_from_new_snapshot():
+    resync = dict(SNAPSHOT, sequence='20', asks=[{'id': 'a9', 'price': '105.00', 'volume': '4.0'}])
+    feed = ReplayFeed(
+        [SNAPSHOT, update(11, delete_update={'order_id': 'a1'}), update(13, delete_update={'order_id': 'a2'})],
+        [resync, update(21, create_update=create('a10', 'ASK', 104, 1))],
+    )
+    stream = OrderBookStream('replay', auth=('key', 'secret'), connect=feed, reconnect_delay=0.01).start()
+    try:
+        wait_for(lambda: stream.sequence == 21)
+    finally:
+        stream.close()
+
+    assert stream.resyncs == 1
+    assert len(feed.connections) == 2
+    assert levels(stream, 'asks') == [(104., 1.), (105., 4.)]
+    assert '"api_key_id": "key"' in feed.connections[0].sent[0]
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / 'stream.jsonl')
+    messages = [SNAPSHOT, update(11, delete_update={'order_id': 'a1'}), update(12, trade_updates=[trade('b1', 1)])]
+
+    stream = OrderBookStream('replay', connect=ReplayFeed(messages), record=path).start()
+    try:
+        wait_for(lambda: stream.sequence == 12)
+    finally:
+        stream.close()
+
+    feed = ReplayFeed.load(path)
+    assert len(feed.sessions) == 1 and len(feed.sessions[0]) == 3
+
+    replayed = OrderBookStream('replay', connect=feed).start()
+    try:
+        wait_for(lambda: replayed.sequence == 12)
+    finally:
+        replayed.close()
+
+    for book_type in ('asks', 'bids'):
+        assert levels(replayed, book_type) == levels(stream, book_type)
@@ -0,0 +1,34 @@
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+import pytest
+
+from bitrader import forex, profiling
+from bitrader.arbitrage_tools import parse_fnb_forex
+
+PAGE = """<html><body><table>
+<tr><th>Currency</th><th>Code</th><th>Bank Selling Rate</th><th>Bank Buying Rate</th></tr>
+<tr><td>Euro</td><td>EUR</td><td>16.4831</td><td>15.9012</td></tr>
+<tr><td>Pound Sterling</td><td>GBP</td><td>18,501.2</td><td>17,990.5</td></tr>
+</table></body></html>"""
+
+
+@pytest.mark.parametrize('file', [StringIO(PAGE), BytesIO(PAGE.encode())], ids=['text', 'binary'])
+def test_parse_fnb_forex_reads_files(file):
+    assert parse_fnb_forex(file) == Decimal('16.4831')
+
+
+def test_read_chunks_decodes_characters_split_between_chunks(monkeypatch):
+    monkeypatch.setattr(forex, 'CHUNK_SIZE', 3)
+
+    assert ''.join(forex.read_chunks(BytesIO('Zürich €'.encode()))) == 'Zürich €'
+
+
+def test_refresh_records_the_fetch_time(monkeypatch):
+    monkeypatch.setattr(profiling, '_enabled', True)
+    count = profiling.stats().get('fetch.fnb', {}).get('count', 0)
+
+    provider = forex.ForexQuoteProvider(fetch=lambda: forex.parse_fnb_rates(PAGE))
+    assert provider.quote('GBP', 'sell')[0] == Decimal('17990.5000')
+
+    assert profiling.stats()['fetch.fnb']['count'] == count + 1
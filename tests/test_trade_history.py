@@ -0,0 +1,59 @@
+import numpy as np
+
+from bitrader.trade_history import TradeStore, to_trades
+
+
+def trade(timestamp, price, volume=1., is_buy=True, **kwargs):
+    return dict(timestamp=timestamp, price=str(price), volume=str(volume), is_buy=is_buy, **kwargs)
+
+
+class FakeClient:
+    def __init__(self, pages):
+        self.pages = list(pages)
+
+    def get_trades(self, since=None, kind='auth'):
+        return {'trades': self.pages.pop(0) if self.pages else []}
+
+
+def test_to_trades_sorts_oldest_first():
+    rows = to_trades([trade(3, 100, sequence=7), trade(1, 101, sequence=5), trade(2, 102, sequence=6)])
+
+    assert rows['timestamp'].tolist() == [1, 2, 3]
+    assert rows['sequence'].tolist() == [5, 6, 7]
+
+
+def test_same_millisecond_trades_without_sequence_are_kept(tmp_path):
+    # Newest first, like the exchange returns them
+    rows = to_trades([trade(2000, 100.5), trade(1000, 100.2, 0.5), trade(1000, 100.1, 0.25)])
+
+    assert len(np.unique(rows['sequence'])) == 3
+    assert rows['price'].tolist() == [100.1, 100.2, 100.5]
+
+    store = TradeStore(str(tmp_path))
+    assert store.append(rows) == 3
+    assert len(store) == 3
+
+
+def test_append_skips_stored_trades_of_the_same_millisecond(tmp_path):
+    store = TradeStore(str(tmp_path))
+    store.append(to_trades([trade(1000, 100.2), trade(1000, 100.1)]))
+
+    # The next page starts at the last stored timestamp again, with one more trade in that millisecond
+    added = store.append(to_trades([trade(2000, 101), trade(1000, 100.3), trade(1000, 100.2), trade(1000, 100.1)]))
+
+    assert added == 2
+    assert store.trades['price'].tolist() == [100.1, 100.2, 100.3, 101]
+    assert store.missing == 0
+
+
+def test_sync_pages_and_missing_sequences(tmp_path):
+    store = TradeStore(str(tmp_path))
+    client = FakeClient([
+        [trade(1000 + i, 100 + i, sequence=i) for i in range(3)],
+        [trade(2000, 200, sequence=5)],
+    ])
+
+    assert store.sync(client) == 3
+    assert store.sync(client) == 1
+    assert store.missing == 2
+    assert store.vwap() == np.mean([100, 101, 102, 200])